@@ -0,0 +1,90 @@
+# scaling benchmark of nnk simulations on generated bcc models
+# usage: python nnk_benchmark.py bench_inp
+
+import os
+import sys
+import json
+import time
+import subprocess
+import importlib.metadata
+
+import nnk.benchmark_module
+
+def run_worker(bench_inp, mode, num_of_cells):
+
+    # fresh process per case and stage so that peak rss is not inherited from previous cases
+    subprocess.run([sys.executable, os.path.abspath(__file__), bench_inp, mode, str(num_of_cells)], check=True, stdout=subprocess.DEVNULL)
+
+def get_version():
+
+    try:
+        version = importlib.metadata.version("nnk")
+    except importlib.metadata.PackageNotFoundError:
+        version = ""
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), \
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return version, commit
+
+def main():
+
+    bench_inp = sys.argv[1]
+    settings = nnk.benchmark_module.parse_bench_inp(bench_inp)
+
+    # worker processes run one simulation or its postprocessing
+    if len(sys.argv) > 2:
+        mode, num_of_cells = sys.argv[2], int(sys.argv[3])
+        case_dir = os.path.join(settings["work_dir"], "cells_{}".format(num_of_cells))
+        res_dir = os.path.join(case_dir, "res_data")
+        if mode == "simulate":
+            res = nnk.benchmark_module.run_simulation(os.path.join(case_dir, "user_inp"), res_dir, settings["seed"])
+        else:
+            dims = [num_of_cells * settings["lattice_constant"] for _ in range(3)]
+            res = nnk.benchmark_module.run_postprocess(res_dir, dims, settings["voxel_size"], settings["postprocess_interval"])
+        with open(os.path.join(case_dir, "{}.json".format(mode)), "w") as f:
+            json.dump(res, f, indent=2)
+        return
+
+    version, commit = get_version()
+    results = {"version": version, "commit": commit, "date": time.strftime("%Y-%m-%d %H:%M:%S"), \
+               "machine": nnk.benchmark_module.machine_info(), "settings": settings, "cases": []}
+
+    print("# cells atoms init_time(s) p50(ms) p90(ms) p99(ms) peak_rss(MB) reconstruct(jumps/s) analysis(jumps/s)")
+    for num_of_cells in settings["num_of_cells"]:
+        inp_file, inp = nnk.benchmark_module.create_case(settings, num_of_cells)
+        case_dir = os.path.dirname(inp_file)
+        for mode in ("simulate", "postprocess"):
+            run_worker(bench_inp, mode, num_of_cells)
+
+        with open(os.path.join(case_dir, "simulate.json"), "r") as f:
+            case = json.load(f)
+        with open(os.path.join(case_dir, "postprocess.json"), "r") as f:
+            case["postprocess"] = json.load(f)
+        case["num_of_cells"], case["num_of_atoms"] = num_of_cells, inp["num_of_atoms"]
+        results["cases"].append(case)
+
+        print("{:.0f} {:.0f} {:.3f} {:.3f} {:.3f} {:.3f} {:.1f} {:.0f} {:.0f}".format(num_of_cells, case["num_of_atoms"], case["init_time"], \
+              case["latency"]["p50"], case["latency"]["p90"], case["latency"]["p99"], case["peak_rss"], \
+              case["postprocess"]["reconstruct_jumps_per_s"], case["postprocess"]["analysis_jumps_per_s"]))
+
+    with open(settings["result_file"], "w") as f:
+        json.dump(results, f, indent=2)
+
+    # compare with results of a previous version
+    if settings["reference_file"] != "":
+        with open(settings["reference_file"], "r") as f:
+            reference = json.load(f)
+        for num_of_cells, jump_speedup, init_speedup in nnk.benchmark_module.compute_speedups(reference, results):
+            print("speedup: cells {:.0f} per jump {:.2f}x initialization {:.2f}x".format(num_of_cells, jump_speedup, init_speedup))
+        regressions = nnk.benchmark_module.compare_results(reference, results, settings["tolerance"])
+        for num_of_cells, metric, old, new, change in regressions:
+            print("regression: cells {:.0f} {} {:.4g} -> {:.4g} ({:+.1%})".format(num_of_cells, metric, old, new, change))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,37 @@
 # postprocess output from nnk simulation
 
 import nnk.process_module 
+import nnk.analysis_module
 
-map_file_name, nnk_log_file_name = "res_data/init_map.npy", "res_data/nnk.log"
+map_file_name, nnk_log_file_name = "res_data/init_map.bin", "res_data/nnk.log"
 
 neuron_map = nnk.process_module.load_map(map_file_name)
 nnk_log = nnk.process_module.load_nnk_log(nnk_log_file_name)
 
-# simulation box dimensions
-dims = [64.8 for _ in range(3)]
+# simulation box dimensions, stored with the initial map
+dims = neuron_map.box_lengths
 # dims = [<dim> for _ in range(3)] # replace <dim> with real dims
 
 
 # dump interval 
 interval = 1
 
-# scale or voxel size
-scale = 1.62
+# scale or voxel size, stored with the initial map
+scale = neuron_map.voxel_size
 
 # output all atoms when dumping configurations
 # nnk.process_module.reconstruct_full_configs(neuron_map, nnk_log, interval, dims, scale, "./res_data")
 
 # output atoms which moved during simulation when dumping configurations
 nnk.process_module.reconstruct_effective_configs(neuron_map, nnk_log, interval, dims, scale, "./res_data")
+
+# msd, diffusivity and correlation factor of vacancies and tracers every 100 jumps
+diffusion_analysis = nnk.analysis_module.diffusion_analysis(neuron_map, dims, scale)
+with open("./res_data/diffusion.dat", "w") as print_f:
+    diffusion_analysis.dump(diffusion_analysis.run(nnk_log, 100), print_f)
+
+# warren-cowley parameters of the first two neighbor shells every 100 jumps
+atom_ids, atom_types, site_index = nnk.process_module.create_config_arrays(neuron_map)
+sro = nnk.analysis_module.sro_tracker(site_index, atom_types, [round(dim / scale) for dim in dims], num_of_shells=2)
+with open("./res_data/sro_post.dat", "w") as print_f:
+    sro.dump(sro.run(atom_ids, site_index, nnk_log, 100), print_f)
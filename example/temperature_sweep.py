@@ -0,0 +1,12 @@
+# temperature sweep reusing lattice and model of one initialization
+
+import nnk.simulation_module
+
+# lattice, mesh and compiled model are built once from user input params
+simulation = nnk.simulation_module.Simulation("user_inp")
+
+# restore the initial lattice and run with new temperature, vacancy and seed
+for temperature in (500, 700, 900):
+    simulation.reset(vacancy_id=100, seed=0, temperature=temperature, res_dir="./res_data_{}".format(temperature))
+    summary = simulation.run()
+    print(temperature, summary["kmc_time"])
@@ -0,0 +1,317 @@
+# streaming diffusion and short-range order analysis from the jump log
+
+import os
+import numpy as np
+
+import nnk.process_module
+
+class diffusion_analysis:
+
+    def __init__(self, maps, dims, scale):
+        '''
+        Attributes:
+        maps: instance of init_map class with initial types and indexes of atoms, loaded by process_module.load_map;
+        mesh_dims: shape of neuron maps, array;
+        scale: voxel size, float;
+        squared_jump_length: squared length of one first nearest neighbor jump in voxels, float;
+        species: atom types other than vacancy, array;
+        species_counts: number of atoms of each species, array;
+        slots: dict mapping id of a moved atom or vacancy to its row in tracked lists;
+        tracked_index: current 3d indexes of tracked atoms, list;
+        displacements: unwrapped displacements of tracked atoms in voxels, list;
+        tracked_types: types of tracked atoms, vacancies have type 0, list;
+        num_of_jumps: number of jumps of each tracked atom, list;
+        kmc_time: accumulated kmc time, float;
+        num_of_events: number of processed jumps, int;
+
+        Methods:
+        track: return row of an atom in tracked lists, adding it on first use;
+        update: process a chunk of vacancy ids, jump ids and jump times;
+        sample: return msd, diffusivity and correlation factor of vacancies, all tracers and each species;
+        run: process a whole jump log and return samples of the initial state and every interval kmc steps;
+        dump: write samples as a table with a commented header line;
+        '''
+
+        self.maps = maps
+        self.scale = scale
+        self.mesh_dims = np.round(np.array(dims) / scale).astype(np.int64)
+        self.squared_jump_length = 3.0
+
+        # species counts of the whole model, vacancies excluded
+        atom_types = np.asarray(maps.atom_types)
+        self.species, self.species_counts = np.unique(atom_types[atom_types != 0], return_counts=True)
+
+        # tracked lists grow with the number of moved atoms, plain lists keep the per jump cost low
+        self.slots = {}
+        self.tracked_index, self.displacements, self.tracked_types, self.num_of_jumps = [], [], [], []
+        self.kmc_time, self.num_of_events = 0.0, 0
+
+    def track(self, atom_id):
+
+        slot = self.slots.get(atom_id)
+        if slot is not None:
+            return slot
+
+        slot = len(self.tracked_types)
+        atom_type, atom_index = self.maps[atom_id]
+        self.tracked_index.append([int(val) for val in atom_index])
+        self.displacements.append([0, 0, 0])
+        self.tracked_types.append(int(atom_type))
+        self.num_of_jumps.append(0)
+        self.slots[atom_id] = slot
+
+        return slot
+
+    def update(self, vacancy_ids, jump_ids, jump_times):
+
+        mesh_dims = self.mesh_dims.tolist()
+        for vacancy_id, jump_id, jump_time in zip(vacancy_ids.tolist(), jump_ids.tolist(), jump_times.tolist()):
+            self.kmc_time += jump_time
+
+            # lines dumping the initial vacancies are not jumps
+            if vacancy_id == jump_id:
+                continue
+
+            vacancy_slot, jump_slot = self.track(vacancy_id), self.track(jump_id)
+            vacancy_index, jump_index = self.tracked_index[vacancy_slot], self.tracked_index[jump_slot]
+            vacancy_disp, jump_disp = self.displacements[vacancy_slot], self.displacements[jump_slot]
+
+            # minimum image jump vector of the atom, the vacancy moves the opposite way
+            for axis in range(3):
+                half = mesh_dims[axis] // 2
+                jump_vect = (vacancy_index[axis] - jump_index[axis] + half) % mesh_dims[axis] - half
+                jump_disp[axis] += jump_vect
+                vacancy_disp[axis] -= jump_vect
+            self.num_of_jumps[jump_slot] += 1
+            self.num_of_jumps[vacancy_slot] += 1
+
+            self.tracked_index[vacancy_slot], self.tracked_index[jump_slot] = jump_index, vacancy_index
+            self.num_of_events += 1
+
+    def sample(self):
+
+        types = np.array(self.tracked_types, dtype=np.int64)
+        squared = np.sum(np.array(self.displacements, dtype=np.float64).reshape(-1, 3) ** 2, axis=1) * self.scale ** 2
+        jumps = np.array(self.num_of_jumps, dtype=np.int64)
+        time = max(self.kmc_time, np.finfo(float).tiny)
+
+        res = {"num_of_events": self.num_of_events, "kmc_time": self.kmc_time}
+
+        # vacancies
+        vacancy = types == 0
+        res["vacancy_msd"] = np.mean(squared[vacancy]) if np.any(vacancy) else 0.0
+        res["vacancy_diffusivity"] = res["vacancy_msd"] / (6 * time)
+
+        # tracers, unmoved atoms count with zero displacement
+        tracer = ~vacancy
+        res["tracer_msd"] = np.sum(squared[tracer]) / np.sum(self.species_counts)
+        res["tracer_diffusivity"] = res["tracer_msd"] / (6 * time)
+        res["correlation_factor"] = np.sum(squared[tracer]) / max(np.sum(jumps[tracer]) * self.squared_jump_length * self.scale ** 2, np.finfo(float).tiny)
+
+        for cur_type, cur_count in zip(self.species, self.species_counts):
+            cur_tracer = types == cur_type
+            res["msd_{}".format(cur_type)] = np.sum(squared[cur_tracer]) / cur_count
+            res["diffusivity_{}".format(cur_type)] = res["msd_{}".format(cur_type)] / (6 * time)
+            res["correlation_factor_{}".format(cur_type)] = np.sum(squared[cur_tracer]) / \
+                max(np.sum(jumps[cur_tracer]) * self.squared_jump_length * self.scale ** 2, np.finfo(float).tiny)
+
+        return res
+
+    def run(self, nnk_log, interval):
+
+        vacancy_ids, jump_ids = nnk.process_module.split_nnk_log(nnk_log)
+        jump_times = nnk_log[:, -1]
+
+        # log lines ending every interval kmc steps, zero-time lines dump the initial vacancies or superbasin transits
+        is_step = jump_times > 0
+        stops = np.flatnonzero(is_step & (np.cumsum(is_step) % interval == 0)) + 1
+
+        # one pass over the log, sampling the initial state and every interval kmc steps
+        samples, start = [self.sample()], 0
+        for stop in stops.tolist():
+            self.update(vacancy_ids[start: stop], jump_ids[start: stop], jump_times[start: stop])
+            samples.append(self.sample())
+            start = stop
+
+        return samples
+
+    def dump(self, samples, print_f):
+
+        keys = [*samples[0].keys()]
+        print("# " + " ".join(keys), file=print_f)
+        for res in samples:
+            print(" ".join("{:.6e}".format(res[key]) for key in keys), file=print_f)
+
+
+class sro_tracker:
+
+    def __init__(self, site_index, site_types, mesh_dims, num_of_shells=2):
+        '''
+        Attributes:
+        mesh_dims: shape of neuron maps, array;
+        num_of_shells: number of neighbor shells, int;
+        num_of_types: number of types including vacancy type 0, int;
+        types: 1d array of types on the full mesh, empty voxels and vacancies are 0;
+        shell_offsets: 2d array of 3d offsets of neighbor sites of all shells;
+        offset_shells: shell index of each neighbor offset;
+        strides: flat index strides of the full mesh, list;
+        wrap_offsets: list of three arrays, wrapped flat offsets of neighbor sites for every voxel index along each dimension;
+        pair_counts: 3d array of ordered pair counts by shell, center type and neighbor type;
+        print_f: file for in-loop samples, None in postprocessing;
+
+        Methods:
+        build_shells: return neighbor offsets of the first shells and their shell index;
+        count_pairs: return pair counts of sites around given 3d indexes by shell and neighbor type;
+        update: move an atom to the vacancy site and update pair counts of the two sites;
+        sample: return warren-cowley parameters by shell and pair of species;
+        run: process a whole jump log and return samples of the initial state and every interval kmc steps;
+        format_header: return commented header line of samples;
+        format_sample: return one line of warren-cowley parameters;
+        sample_keys: return shell and species pair of each column;
+        dump: write samples as a table with a commented header line;
+        get_state: flush print_f and return its size for checkpoint;
+        set_state: nothing to restore, pair counts are rebuilt from the restored lattice;
+        '''
+
+        self.mesh_dims = np.array(mesh_dims)
+        self.num_of_shells = num_of_shells
+        self.print_f = None
+        self.num_of_types = int(np.max(site_types)) + 1
+        self.types = np.zeros(np.prod(self.mesh_dims), dtype=np.int8)
+        self.types[np.ravel_multi_index(site_index.T, self.mesh_dims)] = site_types
+
+        # neighbor tables on the voxel mesh
+        self.shell_offsets, self.offset_shells = self.build_shells(site_index, site_types)
+        self.strides = [int(self.mesh_dims[1] * self.mesh_dims[2]), int(self.mesh_dims[2]), 1]
+        strides = self.strides
+        self.wrap_offsets = [((np.arange(self.mesh_dims[axis]).reshape(-1, 1) + self.shell_offsets[:, axis]) % self.mesh_dims[axis]) * strides[axis] \
+                             for axis in range(3)]
+
+        # pair counts of all sites, one offset at a time
+        self.pair_counts = np.zeros((num_of_shells, self.num_of_types, self.num_of_types), dtype=np.int64)
+        center_types = self.types[np.ravel_multi_index(site_index.T, self.mesh_dims)].astype(np.int64)
+        for offset, shell in zip(self.shell_offsets, self.offset_shells):
+            neigh_index = np.ravel_multi_index(((site_index + offset) % self.mesh_dims).T, self.mesh_dims)
+            self.pair_counts[shell] += np.bincount(center_types * self.num_of_types + self.types[neigh_index], \
+                                                   minlength=self.num_of_types ** 2).reshape(self.num_of_types, self.num_of_types)
+
+        # pairs with vacancies are not counted
+        self.pair_counts[:, 0, :], self.pair_counts[:, :, 0] = 0, 0
+
+    def build_shells(self, site_index, site_types):
+
+        # lattice sites around a reference site grouped by distance
+        occupied = np.zeros(np.prod(self.mesh_dims), dtype=bool)
+        occupied[np.ravel_multi_index(site_index.T, self.mesh_dims)] = True
+        radius = 2 * self.num_of_shells + 1
+        grid = np.arange(-radius, radius + 1)
+        offsets = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1).reshape(-1, 3)
+        offsets = offsets[np.any(offsets != 0, axis=1)]
+        offsets = offsets[occupied[np.ravel_multi_index(((site_index[0] + offsets) % self.mesh_dims).T, self.mesh_dims)]]
+
+        distances = np.sum(offsets ** 2, axis=1)
+        shell_distances = np.unique(distances)[: self.num_of_shells]
+        assert len(shell_distances) == self.num_of_shells
+        selected = np.isin(distances, shell_distances)
+
+        return offsets[selected], np.searchsorted(shell_distances, distances[selected])
+
+    def count_pairs(self, index):
+
+        neigh_types = self.types[self.wrap_offsets[0][index[0]] + self.wrap_offsets[1][index[1]] + self.wrap_offsets[2][index[2]]]
+
+        return np.bincount(self.offset_shells * self.num_of_types + neigh_types, \
+                           minlength=self.num_of_shells * self.num_of_types).reshape(self.num_of_shells, self.num_of_types)
+
+    def update(self, from_index, to_index):
+
+        # only pairs of the moving atom change, the vacancy has no pairs
+        from_flat = from_index[0] * self.strides[0] + from_index[1] * self.strides[1] + from_index[2]
+        to_flat = to_index[0] * self.strides[0] + to_index[1] * self.strides[1] + to_index[2]
+        atom_type = self.types[from_flat]
+        counts = - self.count_pairs(from_index)
+
+        self.types[from_flat], self.types[to_flat] = 0, atom_type
+        counts += self.count_pairs(to_index)
+
+        counts[:, 0] = 0
+        self.pair_counts[:, atom_type, :] += counts
+        self.pair_counts[:, :, atom_type] += counts
+
+    def sample(self):
+
+        # alpha = 1 - P(j around i) / c_j over species, vacancies excluded
+        pair_counts = self.pair_counts[:, 1:, 1:].astype(np.float64)
+        species_counts = np.bincount(self.types, minlength=self.num_of_types)[1:]
+        concs = species_counts / np.sum(species_counts)
+        probs = pair_counts / np.maximum(np.sum(pair_counts, axis=2, keepdims=True), 1)
+
+        return 1 - probs / concs
+
+    def run(self, atom_ids, site_index, nnk_log, interval):
+
+        vacancy_ids, jump_ids = nnk.process_module.split_nnk_log(nnk_log)
+        jump_times = nnk_log[:, -1]
+
+        # current 3d index of each atom id
+        atom_index = np.zeros((np.max(atom_ids) + 1, 3), dtype=np.int64)
+        atom_index[atom_ids] = site_index
+
+        # one pass over the log, sampling the initial state and every interval kmc steps as the in-loop samples
+        samples, kmc_time, num_of_steps = [(0, 0.0, self.sample())], 0.0, 0
+        for vacancy_id, jump_id, jump_time in zip(vacancy_ids.tolist(), jump_ids.tolist(), jump_times.tolist()):
+            kmc_time += jump_time
+            if vacancy_id != jump_id:
+                from_index, to_index = atom_index[jump_id].tolist(), atom_index[vacancy_id].tolist()
+                self.update(from_index, to_index)
+                atom_index[jump_id], atom_index[vacancy_id] = to_index, from_index
+
+            # zero-time lines dump the initial vacancies or superbasin transits preceding the jump of a step
+            if jump_time == 0:
+                continue
+
+            num_of_steps += 1
+            if num_of_steps % interval == 0:
+                samples.append((num_of_steps, kmc_time, self.sample()))
+
+        return samples
+
+    def format_header(self):
+
+        # one column per shell and pair of species i <= j
+        return "# num_of_events kmc_time " + " ".join("alpha_{}_{}_{}".format(shell + 1, i, j) for shell, i, j in self.sample_keys())
+
+    def format_sample(self, num_of_events, kmc_time, alpha):
+
+        return "{:.0f} {:.6e} ".format(num_of_events, kmc_time) + " ".join("{:.6e}".format(alpha[shell, i - 1, j - 1]) for shell, i, j in self.sample_keys())
+
+    def sample_keys(self):
+
+        species = range(1, self.num_of_types)
+        return [(shell, i, j) for shell in range(self.num_of_shells) for i in species for j in species if i <= j]
+
+    def dump(self, samples, print_f):
+
+        print(self.format_header(), file=print_f)
+        for sample in samples:
+            print(self.format_sample(*sample), file=print_f)
+
+    def get_state(self):
+
+        # pair counts are recomputed exactly from the restored lattice, only the output is truncated on restart
+        self.print_f.flush()
+        return {"sro_size": os.fstat(self.print_f.fileno()).st_size}
+
+    def set_state(self, state):
+
+        pass
+
+
+def neuron_map_sites(neuron_map):
+
+    # 3d indexes and types of all atoms in neuron maps
+    flat_index = neuron_map.id_to_type_index.flat_index
+    flat_index = flat_index[flat_index >= 0]
+    site_index = np.column_stack(neuron_map.unravel_index(flat_index.astype(np.int64)))
+
+    return site_index, neuron_map.type_neuron_map.reshape(-1)[flat_index]
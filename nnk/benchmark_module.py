@@ -0,0 +1,234 @@
+# scaling benchmark of initialization, jump latency, memory and postprocessing
+
+import os
+import json
+import time
+import random
+import contextlib
+import resource
+import platform
+import numpy as np
+
+import nnk.utils
+import nnk.process_module
+import nnk.analysis_module
+import nnk.simulation_module
+
+'''
+parse_bench_inp: return benchmark settings from a key: value input file;
+weight_shapes: return shapes of the arrays of a weights file;
+create_synthetic_weights: return random weights with the layer structure of given shapes and barriers around barrier_mean;
+write_inp: write user input file of one benchmark case;
+create_case: build the bcc model, synthetic weights and user input of one benchmark case;
+run_simulation: run one seeded simulation in this process and return timing, latency percentiles and peak rss;
+run_postprocess: return throughput of configuration reconstruction and diffusion analysis of a simulation;
+latency_stats: return mean and percentiles of per-jump latencies in ms;
+peak_rss: return peak resident set size of this process in MB;
+machine_info: return python/numpy versions and machine description stored with results;
+compare_results: return cases and metrics of new results slower than reference results beyond tolerance;
+compute_speedups: return per-case ratios of reference to new wall time per jump and initialization time;
+'''
+
+def parse_bench_inp(bench_inp):
+
+    key_int = {"num_of_steps", "seed", "postprocess_interval", "lookahead"}
+    key_float = {"lattice_constant", "voxel_size", "cutoff", "temperature", "barrier_mean", "barrier_spread", "tolerance"}
+    key_list_int = {"num_of_cells", "elements"}
+    key_list_float = {"concs"}
+    settings = {"num_of_cells": [10, 20, 40], "lattice_constant": 3.24, "elements": [1, 2, 3], "concs": [1/3, 1/3, 1/3], \
+                "voxel_size": 1.62, "cutoff": 7.5, "temperature": 2000.0, "num_of_steps": 1000, "seed": 0, \
+                "model_dtype": "float32", "local_map_mode": "gather", "lattice_layout": "full", "lookahead": 0, \
+                "reference_weights": "../example/weights.npy", "barrier_mean": 1.0, "barrier_spread": 0.1, \
+                "postprocess_interval": 100, "work_dir": "./bench_data", "result_file": "bench_results.json", \
+                "reference_file": "", "tolerance": 0.2}
+
+    with open(bench_inp, "r") as f:
+        for line in f:
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            key, val = line.replace(" ", "").strip().split(":", 1)
+            if key in key_int:
+                val = int(val)
+            if key in key_float:
+                val = float(val)
+            if key in key_list_int:
+                val = [int(cur_val) for cur_val in val.split(",")]
+            if key in key_list_float:
+                val = [float(cur_val) for cur_val in val.split(",")]
+            settings[key] = val
+
+    assert len(settings["elements"]) == len(settings["concs"])
+
+    return settings
+
+def weight_shapes(weight_file):
+
+    return [np.shape(weight) for weight in np.load(weight_file, allow_pickle=True)]
+
+def create_synthetic_weights(shapes, barrier_mean=1.0, barrier_spread=0.1, seed=0):
+
+    # dense layers are a 2d weight and a bias, each followed by batch normalization (gamma, beta, mean, variance)
+    rng = np.random.default_rng(seed)
+    weights, index = [], 0
+    while index < len(shapes):
+        fan_in, fan_out = shapes[index]
+        last = index + 2 == len(shapes)
+        if last == True:
+            # output layer sets the scale of energy barriers
+            weights.append(rng.normal(0.0, barrier_spread / fan_in ** 0.5, size=shapes[index]))
+            weights.append(np.full(shapes[index+1], barrier_mean))
+            index += 2
+        else:
+            weights.append(rng.normal(0.0, (2.0 / fan_in) ** 0.5, size=shapes[index]))
+            weights += [np.zeros(fan_out), np.ones(fan_out), np.zeros(fan_out), np.zeros(fan_out), np.ones(fan_out)]
+            index += 6
+
+    model_weights = np.empty(len(weights), dtype=object)
+    model_weights[:] = weights
+
+    return model_weights
+
+def write_inp(inp_file, inp):
+
+    with open(inp_file, "w") as f:
+        for key, val in inp.items():
+            print("{}: {}".format(key, ",".join(str(cur_val) for cur_val in val) if isinstance(val, list) else val), file=f)
+
+def create_case(settings, num_of_cells):
+
+    case_dir = os.path.join(settings["work_dir"], "cells_{}".format(num_of_cells))
+    os.makedirs(case_dir, exist_ok=True)
+
+    # model of the same composition and seed for every size
+    dump_file = os.path.join(case_dir, "initial.dump")
+    np.random.seed(settings["seed"])
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        nnk.utils.build_model("bcc", settings["lattice_constant"], [num_of_cells for _ in range(3)], settings["elements"], settings["concs"], dump_file)
+
+    # synthetic weights with the layer structure of the reference weights
+    weight_file = os.path.join(settings["work_dir"], "synthetic_weights.npy")
+    if not os.path.exists(weight_file):
+        model_weights = create_synthetic_weights(weight_shapes(settings["reference_weights"]), settings["barrier_mean"], \
+                                                 settings["barrier_spread"], settings["seed"])
+        np.save(weight_file, model_weights, allow_pickle=True)
+
+    num_of_atoms = 2 * num_of_cells ** 3
+    inp = {"init_config_dump": dump_file, "num_of_atoms": num_of_atoms, \
+           "cutoff": settings["cutoff"], "voxel_size": settings["voxel_size"], "flatten": 1, \
+           "local_map_mode": settings["local_map_mode"], "lattice_layout": settings["lattice_layout"], \
+           "init_step": 1, "num_of_steps": settings["num_of_steps"], "dump_vacancy_id": 1, "random_vacancy": 0, \
+           "vacancy_id": num_of_atoms // 2, "num_of_cpus": 1, "log_file": "nnk.log", "res_dir": os.path.join(case_dir, "res_data"), \
+           "temperature": settings["temperature"], "model_dtype": settings["model_dtype"], "ml_model_weight": weight_file, \
+           "lookahead": settings["lookahead"], "dump_cache": 0, "timing": 1}
+    inp_file = os.path.join(case_dir, "user_inp")
+    write_inp(inp_file, inp)
+
+    return inp_file, inp
+
+def run_simulation(inp_file, res_dir, seed=0):
+
+    # per-jump latency from the wall time between consecutive step hooks
+    step_ends = []
+    def record_step(step, vacancy_id, jump_id, jump_time):
+        step_ends.append(time.perf_counter())
+
+    random.seed(seed)
+    np.random.seed(seed)
+    start = time.perf_counter()
+    nnk.simulation_module.Simulation(inp_file).run(hooks=[record_step])
+    wall_time = time.perf_counter() - start
+
+    with open(os.path.join(res_dir, "timing.json"), "r") as f:
+        timing = json.load(f)
+
+    # the first step has no preceding step end and is left out
+    init_time = sum(timing["init"].values())
+    latencies = np.diff(np.array(step_ends)) * 1e3
+
+    return {"wall_time": wall_time, "init_time": init_time, "init": timing["init"], \
+            "steps": {stage: val["mean"] * 1e3 for stage, val in timing["steps"].items()}, \
+            "latency": latency_stats(latencies), "num_of_steps": len(step_ends), "peak_rss": peak_rss()}
+
+def run_postprocess(res_dir, dims, scale, interval):
+
+    maps = nnk.process_module.load_map(os.path.join(res_dir, "init_map.bin"))
+    nnk_log = nnk.process_module.load_nnk_log(os.path.join(res_dir, "nnk.log"))
+    num_of_jumps = len(nnk_log)
+
+    # configuration dumps of atoms which moved
+    dump_dir = os.path.join(res_dir, "configs")
+    os.makedirs(dump_dir, exist_ok=True)
+    start = time.perf_counter()
+    num_of_frames = nnk.process_module.reconstruct_effective_configs(maps, nnk_log, interval, dims, scale, dump_dir)
+    reconstruct_time = time.perf_counter() - start
+
+    # msd and diffusivity samples
+    start = time.perf_counter()
+    analysis = nnk.analysis_module.diffusion_analysis(maps, dims, scale)
+    analysis.run(nnk_log, interval)
+    analysis_time = time.perf_counter() - start
+
+    return {"num_of_jumps": num_of_jumps, "num_of_frames": num_of_frames, \
+            "reconstruct_time": reconstruct_time, "reconstruct_jumps_per_s": num_of_jumps / reconstruct_time, \
+            "analysis_time": analysis_time, "analysis_jumps_per_s": num_of_jumps / analysis_time, "peak_rss": peak_rss()}
+
+def latency_stats(latencies):
+
+    if len(latencies) == 0:
+        return {}
+
+    stats = {"mean": float(np.mean(latencies)), "max": float(np.max(latencies))}
+    for percentile in (50, 90, 99):
+        stats["p{}".format(percentile)] = float(np.percentile(latencies, percentile))
+
+    return stats
+
+def peak_rss():
+
+    # kilobytes on linux, bytes on macos
+    scale = 1 / 1024 ** 2 if platform.system() == "Darwin" else 1 / 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def machine_info():
+
+    return {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(), \
+            "processor": platform.processor(), "system": platform.platform(), "cpu_count": os.cpu_count()}
+
+def compare_results(reference, results, tolerance=0.2):
+
+    # larger is worse for times and memory, smaller is worse for throughput
+    metrics = [(("init_time",), 1), (("latency", "p50"), 1), (("latency", "p99"), 1), (("peak_rss",), 1), \
+               (("postprocess", "reconstruct_jumps_per_s"), -1), (("postprocess", "analysis_jumps_per_s"), -1)]
+    reference_cases = {case["num_of_cells"]: case for case in reference["cases"]}
+
+    regressions = []
+    for case in results["cases"]:
+        if case["num_of_cells"] not in reference_cases:
+            continue
+        for keys, sign in metrics:
+            old, new = reference_cases[case["num_of_cells"]], case
+            for key in keys:
+                old, new = old.get(key), new.get(key)
+                if old is None or new is None:
+                    break
+            if old is None or new is None or old == 0:
+                continue
+            change = sign * (new - old) / old
+            if change > tolerance:
+                regressions.append((case["num_of_cells"], ".".join(keys), old, new, change))
+
+    return regressions
+
+def compute_speedups(reference, results):
+
+    # mean latency, steps alternating between cheap and expensive are not described by the median
+    reference_cases = {case["num_of_cells"]: case for case in reference["cases"]}
+    speedups = []
+    for case in results["cases"]:
+        old = reference_cases.get(case["num_of_cells"])
+        if old is None:
+            continue
+        speedups.append((case["num_of_cells"], old["latency"]["mean"] / case["latency"]["mean"], old["init_time"] / case["init_time"]))
+
+    return speedups
@@ -0,0 +1,118 @@
+# lock-step ensemble of independent kinetic monte carlo replicas
+
+import os
+import copy
+import numpy as np
+
+import nnk.kmc_module
+import nnk.log_module
+import nnk.neuron_map
+import nnk.utils
+
+class ensemble:
+
+    def __init__(self, params, neuron_map, predict_fn):
+        '''
+        Attributes:
+        params: instance of params class;
+        neuron_map: instance of neuron_map class built in the gather mode, shared tables of all replicas;
+        predict_fn: function predicting energy barriers of a batch of images;
+        num_of_replicas: number of replicas, int;
+        rngs: list of independent random generators, one per replica;
+        vacancy_ids: array of vacancy ids of replicas;
+        replicas: list of neuron_map copies holding lattice state of each replica;
+        kinetics: list of kmc instances, one per replica;
+        files: list of log files, one per replica;
+
+        Methods:
+        create_replica: return a neuron_map copy with the vacancy moved to vacancy_id;
+        step: advance all replicas by one jump with a single batched prediction;
+        close: close log files of replicas;
+        '''
+
+        assert params.local_map_mode == "gather"
+        assert params.restart == False and params.checkpoint_interval == 0 and params.trajectory_interval == 0 \
+               and params.sro_interval == 0 and params.superbasin == 0 \
+               and params.lookahead == 0 and params.block_rng == 0
+        assert params.log_format == "text"
+
+        self.params = params
+        self.neuron_map = neuron_map
+        self.predict_fn = predict_fn
+        self.num_of_replicas = params.num_of_replicas
+
+        # independent and reproducible random streams
+        seed_sequence = np.random.SeedSequence(params.ensemble_seed)
+        self.rngs = [np.random.default_rng(cur_seed) for cur_seed in seed_sequence.spawn(self.num_of_replicas)]
+
+        # vacancy of each replica
+        if len(params.replica_vacancy_ids) > 0:
+            assert len(params.replica_vacancy_ids) == self.num_of_replicas
+            self.vacancy_ids = np.array(params.replica_vacancy_ids)
+        elif params.random_vacancy == True:
+            self.vacancy_ids = np.array([rng.integers(1, params.num_of_atoms + 1) for rng in self.rngs])
+        else:
+            self.vacancy_ids = np.full(self.num_of_replicas, params.vacancy_id)
+
+        # lattice state, kinetics and log file of each replica
+        self.replicas, self.kinetics, self.files = [], [], []
+        log_name, log_ext = os.path.splitext(params.log_file)
+        for replica_index, vacancy_id in enumerate(self.vacancy_ids):
+            replica = self.create_replica(vacancy_id)
+            self.replicas.append(replica)
+            self.kinetics.append(nnk.kmc_module.kmc(params, replica))
+            self.files.append(open(os.path.join(params.res_dir, "{}_{}{}".format(log_name, replica_index, log_ext)), "w"))
+
+            # replicas starting from another vacancy get their own initial map
+            if vacancy_id != params.vacancy_id:
+                nnk.log_module.write_map(os.path.join(params.res_dir, "init_map_{}.bin".format(replica_index)), \
+                                         *replica.id_to_type_index.to_columns(), params.box_lengths, params.voxel_size, replica.mesh_info[1])
+
+            if params.dump_vacancy_id == True:
+                nnk.utils.dump_id(vacancy_id, 0, self.files[-1])
+
+    def create_replica(self, vacancy_id):
+
+        # share mask and gather tables, copy lattice state
+        replica = copy.copy(self.neuron_map)
+        replica.id_neuron_map, replica.type_neuron_map = self.neuron_map.id_neuron_map.copy(), self.neuron_map.type_neuron_map.copy()
+        replica.id_to_type_index = self.neuron_map.id_to_type_index.copy(replica)
+        replica.index_to_id_type = nnk.neuron_map.index_id_map(replica)
+
+        # restore the type of the reference vacancy and remove the replica vacancy
+        if vacancy_id != self.params.vacancy_id:
+            for cur_id, cur_type in ((self.params.vacancy_id, self.params.init_config[self.params.vacancy_id-1, 1]), (vacancy_id, 0)):
+                cur_type = np.int32(cur_type)
+                cur_index = replica.id_to_type_index[cur_id][1]
+                replica.type_neuron_map[cur_index] = cur_type
+                replica.id_to_type_index[cur_id] = [cur_type, cur_index]
+                replica.index_to_id_type[cur_index] = [cur_id, cur_type]
+
+        return replica
+
+    def step(self):
+
+        # aggregate local neuron maps of all replicas and predict in one batch
+        neigh_ids, img_vects = [], []
+        for replica, vacancy_id in zip(self.replicas, self.vacancy_ids):
+            cur_neigh_ids, cur_img_vects = replica.gather_local_neuron_map(vacancy_id)
+            neigh_ids.append(cur_neigh_ids)
+            img_vects.append(cur_img_vects)
+        energy_barriers = np.reshape(self.predict_fn(np.concatenate(img_vects)), (self.num_of_replicas, -1))
+
+        # sample jump of each replica from its own random stream
+        for replica_index, rng in enumerate(self.rngs):
+            kinetics = self.kinetics[replica_index]
+            rates = kinetics.compute_jump_rates(energy_barriers[replica_index])
+            rates_sum = np.sum(rates)
+            path_index = rng.choice(len(rates), p=rates / rates_sum)
+            jump_id = int(neigh_ids[replica_index][path_index])
+            jump_time = - np.log(1.0 - rng.random()) / rates_sum
+
+            kinetics.update_neuron_map(jump_id, self.vacancy_ids[replica_index])
+            nnk.utils.dump_id(jump_id, jump_time, self.files[replica_index])
+
+    def close(self):
+
+        for print_f in self.files:
+            print_f.close()
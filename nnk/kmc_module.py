@@ -1,7 +1,9 @@
 # kinetic monte carlo simulation
 
 import random
+from collections import OrderedDict
 import numpy as np
+import scipy.linalg
 
 class kmc:
 
@@ -9,6 +11,12 @@ class kmc:
 
         self.params = params
         self.neuron_map = neuron_map
+        self.path_index, self.energy_barrier = -1, np.nan
+
+        # seeded block sampler, or global random modules
+        self.sampler = None
+        if params.block_rng:
+            self.sampler = block_sampler(params.rng_seed, params.rng_stream, params.rng_block_size)
 
     def compute_jump_rates(self, energy_barriers):
 
@@ -19,28 +27,39 @@ class kmc:
         return np.random.choice(a=self.neuron_map.neigh_ids, size=1, p=rates / rates_sum).astype(np.int32)[0]
 
     def compute_jump_timescale(self, rates_sum):
+
+        if self.sampler is not None:
+            return - np.log(1.0 - self.sampler.uniform()) / rates_sum
         
         return - np.log(random.uniform(0, 1)) / rates_sum
 
-    def update_neuron_map(self, jump_id):
+    def update_neuron_map(self, jump_id, vacancy_id=None):
+
+        if vacancy_id is None:
+            vacancy_id = self.params.vacancy_id
         
         # vacancy id, type, index; jump atom id, type, index
-        vacancy_type, vacancy_index = self.neuron_map.id_to_type_index[self.params.vacancy_id]
+        vacancy_type, vacancy_index = self.neuron_map.id_to_type_index[vacancy_id]
         # print(self.neuron_map.id_to_type_index[jump_id])
         jump_type, jump_index = self.neuron_map.id_to_type_index[jump_id]
         
-        # update id_to_type_index_map
-        self.neuron_map.id_to_type_index[self.params.vacancy_id], self.neuron_map.id_to_type_index[jump_id] = \
-        (vacancy_type, jump_index), (jump_type, vacancy_index)
-
-        # update index_to_id_type map
-        self.neuron_map.index_to_id_type[vacancy_index], self.neuron_map.index_to_id_type[jump_index] = \
-        (jump_id, jump_type), (self.params.vacancy_id, vacancy_type)
+        # update id/type - index maps
+        self.update_index_maps(jump_id, vacancy_id)
 
         # update id/type neuron map
-        self.neuron_map.id_neuron_map[vacancy_index], self.neuron_map.id_neuron_map[jump_index] = jump_id, self.params.vacancy_id
+        self.neuron_map.id_neuron_map[vacancy_index], self.neuron_map.id_neuron_map[jump_index] = jump_id, vacancy_id
         self.neuron_map.type_neuron_map[vacancy_index], self.neuron_map.type_neuron_map[jump_index] = jump_type, vacancy_type
 
+    def update_index_maps(self, jump_id, vacancy_id):
+
+        # vacancy id, type, index; jump atom id, type, index
+        vacancy_type, vacancy_index = self.neuron_map.id_to_type_index[vacancy_id]
+        jump_type, jump_index = self.neuron_map.id_to_type_index[jump_id]
+
+        # update id_to_type_index_map, index_to_id_type map reads id/type neuron maps directly
+        self.neuron_map.id_to_type_index[vacancy_id], self.neuron_map.id_to_type_index[jump_id] = \
+        (vacancy_type, jump_index), (jump_type, vacancy_index)
+
     def execute_kmc(self, kmc_inp):
         
         # load kmc inp params 
@@ -51,12 +70,513 @@ class kmc:
         rates_sum = np.sum(rates)
         
         # sample jump id
-        jump_id = self.compute_jump_id(rates, rates_sum)
+        if self.sampler is None:
+            jump_id = self.compute_jump_id(rates, rates_sum)
+            self.path_index = np.flatnonzero(np.asarray(neigh_ids) == jump_id)[0]
+        else:
+            self.path_index = self.sampler.search(rates)
+            jump_id = int(neigh_ids[self.path_index])
         
         # sample jump time
         jump_time = self.compute_jump_timescale(rates_sum)
 
+        # energy barrier of the chosen path
+        self.energy_barrier = energy_barriers[self.path_index]
+
         # update neuron map
         self.update_neuron_map(jump_id)
 
         return jump_id, jump_time
+
+    def get_state(self):
+
+        # the state of single-vacancy kinetics is fully held by neuron maps and the sampler
+        if self.sampler is not None:
+            return self.sampler.get_state()
+
+        return {}
+
+    def set_state(self, state):
+
+        if self.sampler is not None:
+            self.sampler.set_state(state)
+
+
+class block_sampler:
+
+    def __init__(self, seed=0, stream=0, block_size=4096):
+        '''
+        Attributes:
+        seed: seed of the generator, int;
+        stream: independent stream of the seed, int;
+        block_size: number of uniforms drawn per block, int;
+        rng: numpy generator of the stream;
+        block: list of uniforms in [0, 1) of the current block;
+        pos: index of the next uniform in block, int;
+        num_of_blocks: number of drawn blocks, int;
+
+        Methods:
+        draw_block: draw the next block of uniforms;
+        uniform: return the next uniform in [0, 1);
+        search: return index of the weight whose cumulative interval contains a uniform fraction of the total weight;
+        get_state: return seed, stream and draw counters for checkpoint;
+        set_state: restore generator and block position from checkpoint;
+        '''
+
+        self.seed, self.stream, self.block_size = seed, stream, max(block_size, 1)
+        self.rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(stream,))))
+        self.block, self.pos, self.num_of_blocks = [], 0, 0
+
+    def draw_block(self):
+
+        # python floats, indexing a list is cheaper than indexing an array
+        self.block = self.rng.random(self.block_size).tolist()
+        self.pos = 0
+        self.num_of_blocks += 1
+
+    def uniform(self):
+
+        if self.pos == len(self.block):
+            self.draw_block()
+        self.pos += 1
+
+        return self.block[self.pos - 1]
+
+    def search(self, weights):
+
+        # zero weights are never selected, the last positive weight takes values rounded up to the total
+        cumulative = np.cumsum(weights)
+        index = int(np.searchsorted(cumulative, self.uniform() * cumulative[-1], side="right"))
+        if index == len(cumulative):
+            index = int(np.flatnonzero(np.asarray(weights) > 0)[-1])
+
+        return index
+
+    def get_state(self):
+
+        return {"rng_stream": np.array([self.seed, self.stream, self.block_size]), "rng_counters": np.array([self.num_of_blocks, self.pos])}
+
+    def set_state(self, state):
+
+        assert [int(val) for val in state["rng_stream"]] == [self.seed, self.stream, self.block_size]
+
+        # every uniform is one 64-bit draw, replay the drawn blocks by advancing the generator
+        num_of_blocks, pos = [int(val) for val in state["rng_counters"]]
+        self.rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(self.seed, spawn_key=(self.stream,))))
+        self.block, self.pos, self.num_of_blocks = [], 0, 0
+        if num_of_blocks > 0:
+            self.rng.bit_generator.advance((num_of_blocks - 1) * self.block_size)
+            self.draw_block()
+            self.num_of_blocks, self.pos = num_of_blocks, pos
+
+
+class rate_tree:
+
+    def __init__(self, num_of_rates):
+        '''
+        Attributes:
+        num_of_rates: number of rates in the catalog, int;
+        num_of_leaves: number of leaves, smallest power of two not less than num_of_rates, int;
+        tree: 1d array of partial rate sums, node n has children 2n and 2n+1, leaves start at num_of_leaves;
+
+        Methods:
+        update: set rates and update partial sums of their ancestors;
+        total: return sum of all rates;
+        search: return index of the rate whose cumulative interval contains a value;
+        '''
+
+        self.num_of_rates = num_of_rates
+        self.num_of_leaves = 1 << max(num_of_rates - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.num_of_leaves)
+
+    def update(self, rate_index, rates):
+
+        nodes = np.asarray(rate_index) + self.num_of_leaves
+        self.tree[nodes] = rates
+
+        # update ancestors level by level
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def total(self):
+
+        return self.tree[1]
+
+    def search(self, value):
+
+        node = 1
+        while node < self.num_of_leaves:
+            left = 2 * node
+            if value < self.tree[left] or self.tree[left + 1] == 0:
+                node = left
+            else:
+                value -= self.tree[left]
+                node = left + 1
+
+        return node - self.num_of_leaves
+
+
+class multi_vacancy_kmc(kmc):
+
+    def __init__(self, params, neuron_map, predict_fn):
+        '''
+        Attributes:
+        params: instance of params class;
+        neuron_map: instance of neuron_map class, built in the gather mode;
+        predict_fn: function predicting energy barriers of a batch of images;
+        vacancy_ids: array of vacancy ids;
+        vacancy_index: 2d array of vacancy indexes in neuron map;
+        neigh_ids: 2d array of first nearest neighbor ids of each vacancy;
+        rate_tree: instance of rate_tree class storing rates of all vacancy x path events;
+
+        Methods:
+        predict_vacancies: predict energy barriers of vacancies and update their rates in rate catalog;
+        compute_affected_vacancies: return slots of vacancies whose local window contains changed sites;
+        execute_kmc: sample one event from rate catalog, update neuron map and affected rates;
+        get_state: return neigh ids and rate catalog for checkpoint;
+        set_state: restore neigh ids and rate catalog from checkpoint;
+        '''
+
+        super().__init__(params, neuron_map)
+        assert self.params.local_map_mode == "gather"
+
+        self.predict_fn = predict_fn
+        self.vacancy_ids = np.array(self.params.vacancy_ids)
+        self.vacancy_index = np.array([self.neuron_map.id_to_type_index[vacancy_id][1] for vacancy_id in self.vacancy_ids])
+        self.neigh_ids = np.zeros((len(self.vacancy_ids), len(self.params.path_vects)), dtype=np.int64)
+
+        # rate catalog of all vacancies
+        self.rate_tree = rate_tree(len(self.vacancy_ids) * len(self.params.path_vects))
+        self.predict_vacancies(np.arange(len(self.vacancy_ids)))
+
+    def predict_vacancies(self, slots):
+
+        # aggregate local neuron maps of vacancies in one batch
+        num_of_paths = len(self.params.path_vects)
+        img_vects, vacancy_neigh = [], []
+        for slot in slots:
+            neigh_ids, cur_img_vects = self.neuron_map.gather_local_neuron_map(self.vacancy_ids[slot])
+            self.neigh_ids[slot] = neigh_ids
+            img_vects.append(cur_img_vects)
+            vacancy_neigh.append(np.isin(neigh_ids, self.vacancy_ids))
+
+        energy_barriers = np.atleast_1d(self.predict_fn(np.concatenate(img_vects)))
+
+        # exchanges between two vacancies are not allowed
+        rates = self.compute_jump_rates(energy_barriers)
+        rates[np.concatenate(vacancy_neigh)] = 0
+
+        rate_index = (np.array(slots).reshape(-1, 1) * num_of_paths + np.arange(num_of_paths)).reshape(-1)
+        self.rate_tree.update(rate_index, rates)
+
+    def compute_affected_vacancies(self, changed_index):
+
+        # periodic chebyshev distance between vacancies and changed sites in voxels
+        mesh_dims = np.array(self.neuron_map.mesh_info[1])
+        half_width = np.array(self.params.local_neuron_map_center_index)
+        affected = np.zeros(len(self.vacancy_ids), dtype=bool)
+        for cur_index in changed_index:
+            diff = np.abs(self.vacancy_index - np.array(cur_index))
+            diff = np.minimum(diff, mesh_dims - diff)
+            affected |= np.all(diff <= half_width, axis=1)
+
+        return np.flatnonzero(affected)
+
+    def execute_kmc(self):
+
+        # sample event from rate catalog
+        rates_sum = self.rate_tree.total()
+        if self.sampler is None:
+            event = self.rate_tree.search(np.random.uniform(0, rates_sum))
+        else:
+            event = self.rate_tree.search(self.sampler.uniform() * rates_sum)
+        slot, path_index = divmod(event, len(self.params.path_vects))
+        vacancy_id, jump_id = self.vacancy_ids[slot], int(self.neigh_ids[slot, path_index])
+
+        # sample jump time
+        jump_time = self.compute_jump_timescale(rates_sum)
+
+        # chosen path and its energy barrier recovered from the rate
+        self.path_index = path_index
+        self.energy_barrier = - np.log(self.rate_tree.tree[self.rate_tree.num_of_leaves + event] / self.params.attempt_frequency) \
+                              * self.params.boltzmann_constant * self.params.temperature
+
+        # update neuron map
+        vacancy_index = self.neuron_map.id_to_type_index[vacancy_id][1]
+        jump_index = self.neuron_map.id_to_type_index[jump_id][1]
+        self.update_neuron_map(jump_id, vacancy_id)
+        self.vacancy_index[slot] = jump_index
+
+        # re-predict vacancies whose local window overlaps the changed sites
+        self.predict_vacancies(self.compute_affected_vacancies([vacancy_index, jump_index]))
+
+        return vacancy_id, jump_id, jump_time
+
+    def get_state(self):
+
+        # rates are restored rather than re-predicted, batch size may change float rounding
+        state = super().get_state()
+        state.update({"kmc_neigh_ids": self.neigh_ids, "kmc_rate_tree": self.rate_tree.tree})
+
+        return state
+
+    def set_state(self, state):
+
+        super().set_state(state)
+        self.neigh_ids[...] = state["kmc_neigh_ids"]
+        self.rate_tree.tree[...] = state["kmc_rate_tree"]
+
+
+class superbasin_kmc(kmc):
+
+    def __init__(self, params, neuron_map):
+        '''
+        Attributes:
+        params: instance of params class;
+        neuron_map: instance of neuron_map class;
+        num_of_visits: number of visits after which a state joins transient basins, int;
+        max_basin_states: largest number of states solved as one basin, int;
+        capacity: largest number of cached states, int;
+        states: ordered dict mapping state hash to [neigh ids, energy barriers, rates, hashes of neighbor states, visits];
+        state_hash: hash of the current lattice state relative to the initial one, int;
+        transit_jumps: list of (jump id, path index, energy barrier, from index, to index) of zero-time jumps moving the vacancy 
+                       to the exit state of the last basin, empty for normal jumps;
+        num_of_exits: number of basin exits, int;
+        num_of_basin_states: total number of states of exited basins, int;
+        num_of_hits: number of steps using cached rates, int;
+
+        Methods:
+        compute_site_keys: return random 64-bit keys of atoms at flat indexes;
+        lookup_state: return True and restore neigh ids if rates of the current state are cached;
+        insert_state: cache neigh ids, energy barriers, rates and neighbor state hashes of the current state;
+        update_neuron_map: update state hash and neuron maps;
+        execute_kmc: execute a normal jump, or an exit event of the transient basin holding the current state;
+        find_basin: return hashes of frequently visited states connected to the current state;
+        exit_basin: sample exit time and exit event of the basin, move the vacancy to the exit state and jump out;
+        sample_exit_time: return exit time and occupation probabilities of basin states at that time;
+        find_transit_path: return (state, path index) pairs leading from the current state to a basin state;
+        move_vacancy: jump the vacancy along a path of a cached state;
+        summary: return cache and basin counters as a string;
+        get_state: return cached states and state hash for checkpoint;
+        set_state: restore cached states and state hash from checkpoint;
+        '''
+
+        super().__init__(params, neuron_map)
+        assert params.multi_vacancy == False and params.trajectory_interval == 0
+
+        self.num_of_visits = params.superbasin_visits
+        self.max_basin_states = params.superbasin_max_states
+        self.capacity = params.superbasin_cache_size
+        self.states = OrderedDict()
+        self.state_hash = 0
+        self.transit_jumps = []
+        self.num_of_exits, self.num_of_basin_states, self.num_of_hits = 0, 0, 0
+
+    def compute_site_keys(self, atom_ids, flat_index):
+
+        # splitmix64 of atom id and flat index, exchanges update hashes by xor
+        keys = (np.asarray(atom_ids, dtype=np.uint64) << np.uint64(32)) ^ np.asarray(flat_index, dtype=np.uint64)
+        keys = keys + np.uint64(0x9E3779B97F4A7C15)
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+        return keys ^ (keys >> np.uint64(31))
+
+    def lookup_state(self):
+
+        state = self.states.get(self.state_hash)
+        if state is None:
+            return False
+
+        self.states.move_to_end(self.state_hash)
+        self.neuron_map.neigh_ids = state[0]
+        self.num_of_hits += 1
+
+        return True
+
+    def insert_state(self, neigh_ids, energy_barriers):
+
+        # hashes of the states reached by each path
+        neigh_ids = np.array(neigh_ids, dtype=np.int64)
+        flat_index = self.neuron_map.id_to_type_index.flat_index
+        vacancy_id = np.full(len(neigh_ids), self.params.vacancy_id)
+        vacancy_index, jump_index = np.full(len(neigh_ids), flat_index[self.params.vacancy_id]), flat_index[neigh_ids]
+        neigh_hashes = np.uint64(self.state_hash) ^ self.compute_site_keys(vacancy_id, vacancy_index) ^ self.compute_site_keys(neigh_ids, jump_index) \
+                       ^ self.compute_site_keys(vacancy_id, jump_index) ^ self.compute_site_keys(neigh_ids, vacancy_index)
+
+        energy_barriers = np.array(energy_barriers).reshape(-1)
+        self.states[self.state_hash] = [neigh_ids, energy_barriers, self.compute_jump_rates(energy_barriers), neigh_hashes, 0]
+        self.neuron_map.neigh_ids = neigh_ids
+        if len(self.states) > self.capacity:
+            self.states.popitem(last=False)
+
+    def update_neuron_map(self, jump_id, vacancy_id=None):
+
+        # exchange of vacancy and jump atom
+        flat_index = self.neuron_map.id_to_type_index.flat_index
+        atom_ids = np.array([self.params.vacancy_id, jump_id, self.params.vacancy_id, jump_id])
+        atom_index = flat_index[atom_ids[[0, 1, 1, 0]]]
+        self.state_hash ^= int(np.bitwise_xor.reduce(self.compute_site_keys(atom_ids, atom_index)))
+
+        super().update_neuron_map(jump_id, vacancy_id)
+
+    def execute_kmc(self, kmc_inp=None):
+
+        # rates of the current state are predicted, or cached when kmc_inp is None
+        self.transit_jumps = []
+        if kmc_inp is not None:
+            self.insert_state(*kmc_inp)
+        state = self.states[self.state_hash]
+        state[4] += 1
+
+        basin = self.find_basin() if state[4] >= self.num_of_visits else []
+        if len(basin) < 2:
+            return super().execute_kmc([state[0], state[1]])
+
+        return self.exit_basin(basin)
+
+    def find_basin(self):
+
+        # breadth-first search over frequently visited cached states
+        basin, members = [self.state_hash], {self.state_hash}
+        for cur_hash in basin:
+            for neigh_hash in self.states[cur_hash][3].tolist():
+                if len(basin) == self.max_basin_states:
+                    return basin
+                neigh_state = self.states.get(neigh_hash)
+                if neigh_hash not in members and neigh_state is not None and neigh_state[4] >= self.num_of_visits:
+                    basin.append(neigh_hash)
+                    members.add(neigh_hash)
+
+        return basin
+
+    def exit_basin(self, basin):
+
+        # rates between basin states and rates of exit events, path targets -1 leave the basin
+        basin_index = {cur_hash: index for index, cur_hash in enumerate(basin)}
+        rates = np.array([self.states[cur_hash][2] for cur_hash in basin])
+        targets = np.array([[basin_index.get(neigh_hash, -1) for neigh_hash in self.states[cur_hash][3].tolist()] for cur_hash in basin])
+        internal = targets >= 0
+
+        # generator of the continuous-time markov chain restricted to the basin
+        generator = np.zeros((len(basin), len(basin)))
+        np.add.at(generator, (np.nonzero(internal)[0], targets[internal]), rates[internal])
+        generator[np.diag_indices(len(basin))] -= np.sum(rates, axis=1)
+        exit_rates = np.where(internal, 0.0, rates)
+
+        # exit time, then exit event from the occupation of basin states at that time
+        jump_time, occupation = self.sample_exit_time(generator)
+        weights = (occupation.reshape(-1, 1) * exit_rates).reshape(-1)
+        if self.sampler is None:
+            exit_index, path_index = divmod(np.random.choice(a=len(weights), p=weights / np.sum(weights)), rates.shape[1])
+        else:
+            exit_index, path_index = divmod(self.sampler.search(weights), rates.shape[1])
+
+        # zero-time transit to the exit state keeps the log replayable
+        for cur_index, cur_path in self.find_transit_path(targets, exit_index):
+            self.transit_jumps.append(self.move_vacancy(self.states[basin[cur_index]], cur_path))
+        jump_id = self.move_vacancy(self.states[basin[exit_index]], path_index)[0]
+
+        self.num_of_exits += 1
+        self.num_of_basin_states += len(basin)
+
+        return jump_id, jump_time
+
+    def sample_exit_time(self, generator):
+
+        # survival probability of the chain started in the current state, the first basin state
+        eigenvalues, eigenvectors = np.linalg.eig(generator)
+        if np.linalg.cond(eigenvectors) < 1e8:
+            inverse = np.linalg.inv(eigenvectors)
+            occupation_fn = lambda t: np.real((eigenvectors[0] * np.exp(eigenvalues * t)) @ inverse)
+        else:
+            occupation_fn = lambda t: scipy.linalg.expm(generator * t)[0]
+
+        # invert the survival probability by safeguarded newton steps, its derivative is minus the exit flux
+        survival = random.uniform(0, 1) if self.sampler is None else 1.0 - self.sampler.uniform()
+        exit_flux = np.sum(generator, axis=1)
+        lower, upper = 0.0, np.linalg.solve(-generator, np.ones(len(generator)))[0]
+        while occupation_fn(upper).sum() > survival:
+            lower, upper = upper, 2 * upper
+        exit_time = upper
+        for _ in range(100):
+            occupation = occupation_fn(exit_time)
+            residual = occupation.sum() - survival
+            if residual > 0:
+                lower = exit_time
+            else:
+                upper = exit_time
+            if abs(residual) < 1e-12 or upper - lower < 1e-12 * upper:
+                break
+            exit_time -= residual / (occupation @ exit_flux)
+            if not lower < exit_time < upper:
+                exit_time = 0.5 * (lower + upper)
+
+        return exit_time, np.maximum(occupation, 0.0)
+
+    def find_transit_path(self, targets, exit_index):
+
+        # breadth-first search over paths between basin states
+        parents = {0: None}
+        queue = [0]
+        for cur_index in queue:
+            if cur_index == exit_index:
+                break
+            for path_index, target in enumerate(targets[cur_index]):
+                if target >= 0 and target not in parents:
+                    parents[target] = (cur_index, path_index)
+                    queue.append(target)
+
+        transit_path = []
+        cur_index = exit_index
+        while parents[cur_index] is not None:
+            transit_path.append(parents[cur_index])
+            cur_index = parents[cur_index][0]
+
+        return transit_path[::-1]
+
+    def move_vacancy(self, state, path_index):
+
+        jump_id = int(state[0][path_index])
+        vacancy_index = self.neuron_map.id_to_type_index[self.params.vacancy_id][1]
+        jump_index = self.neuron_map.id_to_type_index[jump_id][1]
+
+        self.path_index, self.energy_barrier = path_index, state[1][path_index]
+        self.neuron_map.neigh_ids = state[0]
+        self.update_neuron_map(jump_id)
+
+        # the jump atom moved from jump index to vacancy index
+        return jump_id, path_index, self.energy_barrier, jump_index, vacancy_index
+
+    def summary(self):
+
+        return "superbasin: cached states {:.0f} cache hits {:.0f} basin exits {:.0f} mean basin size {:.2f}".format( \
+               len(self.states), self.num_of_hits, self.num_of_exits, self.num_of_basin_states / max(self.num_of_exits, 1))
+
+    def get_state(self):
+
+        num_of_paths = len(self.params.path_vects)
+        states = list(self.states.values())
+        state = super().get_state()
+        state.update({"superbasin_hashes": np.array(list(self.states.keys()), dtype=np.uint64), \
+                "superbasin_neigh_ids": np.array([state[0] for state in states], dtype=np.int64).reshape(-1, num_of_paths), \
+                "superbasin_barriers": np.array([state[1] for state in states]).reshape(-1, num_of_paths), \
+                "superbasin_neigh_hashes": np.array([state[3] for state in states], dtype=np.uint64).reshape(-1, num_of_paths), \
+                "superbasin_visits": np.array([state[4] for state in states], dtype=np.int64), \
+                "superbasin_state_hash": np.uint64(self.state_hash), \
+                "superbasin_counters": np.array([self.num_of_exits, self.num_of_basin_states, self.num_of_hits])})
+
+        return state
+
+    def set_state(self, state):
+
+        super().set_state(state)
+        self.states = OrderedDict()
+        for cur_hash, neigh_ids, energy_barriers, neigh_hashes, visits in zip(state["superbasin_hashes"].tolist(), state["superbasin_neigh_ids"], \
+                                                                              state["superbasin_barriers"], state["superbasin_neigh_hashes"], \
+                                                                              state["superbasin_visits"].tolist()):
+            self.states[cur_hash] = [neigh_ids, energy_barriers, self.compute_jump_rates(energy_barriers), neigh_hashes, visits]
+        self.state_hash = int(state["superbasin_state_hash"])
+        self.num_of_exits, self.num_of_basin_states, self.num_of_hits = [int(val) for val in state["superbasin_counters"]]
@@ -0,0 +1,274 @@
+# buffered binary jump log written by a background thread, keyframed binary trajectory and columnar initial map
+
+import os
+import json
+import zlib
+import queue
+import threading
+import numpy as np
+
+'''
+create_record_dtype: return numpy dtype of one jump record;
+write_header: write magic, header length and json header describing records;
+write_json_header: write magic, header length and padded json header;
+read_header: return json header and offset of the first record;
+write_map: write initial atom ids, types and 3d indexes as columns with box and voxel metadata;
+'''
+
+magic = b"NNKLOG01"
+map_magic = b"NNKMAP01"
+
+def create_record_dtype(log_details=False):
+
+    fields = [("vacancy_id", np.uint32), ("jump_id", np.uint32), ("jump_time", np.float64)]
+    if log_details == True:
+        fields += [("path_index", np.int8), ("energy_barrier", np.float32)]
+
+    return np.dtype(fields)
+
+def write_header(f, record_dtype, multi_vacancy):
+
+    write_json_header(f, {"descr": record_dtype.descr, "multi_vacancy": bool(multi_vacancy)})
+
+def write_json_header(f, header, file_magic=magic):
+
+    header = json.dumps(header).encode()
+
+    # pad so that records start at a multiple of 64 bytes
+    header += b" " * (-(len(file_magic) + 8 + len(header)) % 64)
+    f.write(file_magic + np.uint64(len(header)).tobytes() + header)
+
+def read_header(f, file_magic=magic):
+
+    assert f.read(len(file_magic)) == file_magic
+    header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+    header = json.loads(f.read(header_size))
+    if "descr" in header:
+        header["dtype"] = np.dtype([tuple(field) for field in header["descr"]])
+
+    return header, len(file_magic) + 8 + header_size
+
+def write_map(map_file, atom_ids, atom_types, site_index, box_lengths, voxel_size, mesh_dims):
+
+    # columns ordered by atom id in the smallest unsigned type holding their values
+    order = np.argsort(atom_ids, kind="stable")
+    columns = [("id", atom_ids), ("type", atom_types)] + [(axis, index) for axis, index in zip(("ix", "iy", "iz"), site_index)]
+    columns = [(name, np.asarray(column)[order].astype(np.min_scalar_type(max(int(np.max(column, initial=0)), 0)))) for name, column in columns]
+
+    # each column starts at a multiple of 64 bytes after the header
+    descr, offset = [], 0
+    for name, column in columns:
+        descr.append([name, column.dtype.str, offset])
+        offset += column.nbytes + (-column.nbytes % 64)
+
+    with open(map_file, "wb") as f:
+        write_json_header(f, {"num_of_atoms": len(order), "columns": descr, "box_lengths": [float(val) for val in box_lengths], \
+                              "voxel_size": float(voxel_size), "mesh_dims": [int(val) for val in mesh_dims]}, map_magic)
+        for name, column in columns:
+            f.write(column.tobytes())
+            f.write(b"\0" * (-column.nbytes % 64))
+
+
+class binary_log:
+
+    def __init__(self, log_file, multi_vacancy=False, log_details=False, block_size=4096, num_of_blocks=4, restart_size=None):
+        '''
+        Attributes:
+        log_file: binary log file name, string;
+        log_details: also record chosen path index and energy barrier, boolean;
+        record_dtype: numpy dtype of one jump record;
+        block_size: number of records written to file at once, int;
+        num_of_blocks: number of blocks in ring buffer, int;
+        ring: 1d structured array of num_of_blocks x block_size records;
+        block: index of the block being filled, int;
+        position: number of records in the block being filled, int;
+        free_blocks: semaphore counting blocks not waiting for the writer;
+        blocks: queue of filled blocks handed to the writer thread;
+        writer: background thread writing blocks to file;
+        error: exception raised in the writer thread;
+        f: binary log file;
+
+        Methods:
+        append: add one jump record to ring buffer;
+        flush: write all buffered records and return file size in bytes;
+        close: flush records, stop the writer thread and close file;
+        get_state: flush records and return file size for checkpoint;
+        set_state: nothing to restore, records after the checkpoint are dropped on opening;
+        write_blocks: writer thread loop;
+        '''
+
+        self.log_file = log_file
+        self.log_details = log_details
+        self.record_dtype = create_record_dtype(log_details)
+        self.block_size, self.num_of_blocks = block_size, num_of_blocks
+        self.ring = np.zeros(block_size * num_of_blocks, dtype=self.record_dtype)
+        self.block, self.position = 0, 0
+
+        # restart drops records written after the checkpoint and appends
+        if restart_size is None:
+            self.f = open(log_file, "wb")
+            write_header(self.f, self.record_dtype, multi_vacancy)
+        else:
+            os.truncate(log_file, restart_size)
+            self.f = open(log_file, "ab")
+
+        self.free_blocks = threading.Semaphore(num_of_blocks)
+        self.blocks = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self.write_blocks, daemon=True)
+        self.writer.start()
+
+    def append(self, vacancy_id, jump_id, jump_time, path_index=-1, energy_barrier=np.nan):
+
+        # wait for the writer only when all blocks are pending
+        if self.position == 0:
+            self.free_blocks.acquire()
+
+        if self.log_details == True:
+            self.ring[self.block * self.block_size + self.position] = (vacancy_id, jump_id, jump_time, path_index, energy_barrier)
+        else:
+            self.ring[self.block * self.block_size + self.position] = (vacancy_id, jump_id, jump_time)
+        self.position += 1
+
+        if self.position == self.block_size:
+            self.blocks.put((self.block, self.position))
+            self.block, self.position = (self.block + 1) % self.num_of_blocks, 0
+
+    def flush(self):
+
+        # hand over the partially filled block and wait for the writer
+        if self.position > 0:
+            self.blocks.put((self.block, self.position))
+            self.block, self.position = (self.block + 1) % self.num_of_blocks, 0
+        self.blocks.join()
+        if self.error is not None:
+            raise self.error
+        self.f.flush()
+
+        return os.fstat(self.f.fileno()).st_size
+
+    def close(self):
+
+        self.flush()
+        self.blocks.put(None)
+        self.writer.join()
+        self.f.close()
+
+    def get_state(self):
+
+        return {"binary_log_size": self.flush()}
+
+    def set_state(self, state):
+
+        pass
+
+    def write_blocks(self):
+
+        while True:
+            item = self.blocks.get()
+            if item is None:
+                self.blocks.task_done()
+                break
+
+            block, num_of_records = item
+            try:
+                start = block * self.block_size
+                self.f.write(self.ring[start: start + num_of_records].tobytes())
+            except Exception as error:
+                self.error = error
+            self.free_blocks.release()
+            self.blocks.task_done()
+
+
+class trajectory_writer:
+
+    def __init__(self, res_dir, neuron_map, interval, step, restart_state=None):
+        '''
+        Attributes:
+        neuron_map: instance of neuron_map class;
+        interval: number of jump steps between keyframes, int;
+        header_file: static trajectory information including box, voxel size, mesh dims and atom types, string;
+        data_file: compressed keyframes and jump blocks, string;
+        index_file: one record per segment of a keyframe and the jumps following it, string;
+        keyframe: step, offset and size of the keyframe of the open segment, list;
+        jumps: vacancy id and jump atom id of each step after the keyframe, list;
+        data_f: file of keyframes and jump blocks;
+        index_f: file of segment records;
+
+        Methods:
+        append: add one jump, close the segment and write a keyframe every interval steps;
+        write_keyframe: write the compressed flat index of every atom;
+        write_segment: write jumps of the open segment and its index record;
+        close: write the last segment and close files;
+        get_state: flush files and return file sizes and the open segment for checkpoint;
+        set_state: nothing to restore, the open segment is restored on opening;
+        '''
+
+        self.neuron_map = neuron_map
+        self.interval = interval
+        self.header_file = os.path.join(res_dir, "trajectory.npz")
+        self.data_file = os.path.join(res_dir, "trajectory.bin")
+        self.index_file = os.path.join(res_dir, "trajectory.idx")
+
+        if restart_state is None:
+            # atom types never change, vacancies have type 0, missing ids -1
+            flat_index = self.neuron_map.id_to_type_index.flat_index
+            atom_types = np.full(len(flat_index), -1, dtype=np.int8)
+            atom_types[flat_index >= 0] = self.neuron_map.type_neuron_map.reshape(-1)[flat_index[flat_index >= 0]]
+            np.savez(self.header_file, box_lengths=neuron_map.params.box_lengths, voxel_size=neuron_map.params.voxel_size, \
+                     mesh_dims=neuron_map.mesh_info[1], atom_types=atom_types, interval=interval)
+
+            self.data_f, self.index_f = open(self.data_file, "wb"), open(self.index_file, "wb")
+            self.write_keyframe(step)
+        else:
+            # drop data written after the checkpoint and reopen the segment
+            os.truncate(self.data_file, int(restart_state["trajectory_data_size"]))
+            os.truncate(self.index_file, int(restart_state["trajectory_index_size"]))
+            self.data_f, self.index_f = open(self.data_file, "ab"), open(self.index_file, "ab")
+            self.keyframe = [int(val) for val in restart_state["trajectory_keyframe"]]
+            self.jumps = [tuple(jump) for jump in restart_state["trajectory_jumps"].tolist()]
+
+    def append(self, vacancy_id, jump_id, step):
+
+        self.jumps.append((vacancy_id, jump_id))
+        if step % self.interval == 0:
+            self.write_segment()
+            self.write_keyframe(step)
+
+    def write_keyframe(self, step):
+
+        # flat index in the full layout, independent of the storage of neuron maps
+        flat_index = self.neuron_map.id_to_type_index.flat_index.astype(np.int64)
+        if not isinstance(self.neuron_map.type_neuron_map, np.ndarray):
+            present = flat_index >= 0
+            flat_index[present] = np.ravel_multi_index(self.neuron_map.unravel_index(flat_index[present]), self.neuron_map.mesh_info[1])
+
+        data = zlib.compress(flat_index.tobytes(), 1)
+        self.keyframe = [step, self.data_f.tell(), len(data)]
+        self.data_f.write(data)
+        self.jumps = []
+
+    def write_segment(self):
+
+        jumps = np.array(self.jumps, dtype=np.uint32).reshape(-1, 2)
+        record = np.array(self.keyframe + [self.data_f.tell(), len(jumps)], dtype=np.int64)
+        self.data_f.write(jumps.tobytes())
+        self.index_f.write(record.tobytes())
+
+    def close(self):
+
+        self.write_segment()
+        self.data_f.close()
+        self.index_f.close()
+
+    def get_state(self):
+
+        self.data_f.flush()
+        self.index_f.flush()
+
+        return {"trajectory_data_size": os.fstat(self.data_f.fileno()).st_size, "trajectory_index_size": os.fstat(self.index_f.fileno()).st_size, \
+                "trajectory_keyframe": np.array(self.keyframe), "trajectory_jumps": np.array(self.jumps, dtype=np.uint32).reshape(-1, 2)}
+
+    def set_state(self, state):
+
+        pass
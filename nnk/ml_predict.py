@@ -1,5 +1,9 @@
 # deep neural network predicting energy barriers
 
+import time
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 
 def linear_combination(data, parameters):
@@ -39,3 +43,370 @@ def predict(model_weights, input_data):
     linear_combination_output = linear_combination(input_data, model_weights[num_of_layers*group_size+0: num_of_layers*group_size+2])
     
     return np.squeeze(linear_combination_output)[()]
+
+class CompiledModel:
+
+    def __init__(self, model_weights, dtype="float32"):
+        '''
+        Attributes:
+        dtype: numeric type of weights and work buffers, "float64", "float32", "float16" or "int8", string;
+               max absolute errors against the float64 reference are below 1e-10 (float64), 1e-5 (float32), 1e-2 (float16) and 1e-1 (int8) eV;
+        weights: list of contiguous weight matrices with batch normalization folded in;
+        biases: list of bias vectors with batch normalization folded in;
+        buffers: dict mapping batch size to preallocated input and layer output buffers;
+
+        Methods:
+        fold_batchnormalization: return weights/biases of a dense layer followed by batch normalization;
+        cast: return weights cast to the storage type, int8 weights are quantized per output neuron;
+        allocate_buffers: return work buffers for a batch size;
+        predict: predict energy barriers using preallocated buffers and in-place activations;
+        forward: run the layers after the first dense layer on its output stored in the work buffers;
+        validate: return max absolute error against the reference predict function with float64 weights;
+        '''
+
+        # int8 weights are computed in float32
+        self.dtype = dtype
+        compute_dtype = np.float32 if dtype == "int8" else np.dtype(dtype)
+
+        # fold batch normalization of hidden layers into dense layers
+        group_size = 6
+        num_of_layers = len(model_weights) // group_size
+        self.weights, self.biases = [], []
+        for index in range(num_of_layers):
+            weights, biases = self.fold_batchnormalization(model_weights[index*group_size+0: (index+1)*group_size])
+            self.weights.append(self.cast(weights, compute_dtype))
+            self.biases.append(biases.astype(compute_dtype))
+
+        # output layer
+        weights, biases = [np.asarray(parameter, dtype=np.float64) for parameter in model_weights[num_of_layers*group_size+0: num_of_layers*group_size+2]]
+        self.weights.append(self.cast(weights, compute_dtype))
+        self.biases.append(biases.astype(compute_dtype))
+
+        self.buffers = {}
+
+    def fold_batchnormalization(self, parameters):
+
+        # fold in float64, weights files are stored in float32
+        weights, biases, gamma, beta, mean, variance = [np.asarray(parameter, dtype=np.float64) for parameter in parameters]
+        scale = gamma / (variance + 0.001) ** 0.5
+
+        return weights * scale, (biases - mean) * scale + beta
+
+    def cast(self, weights, compute_dtype):
+
+        if self.dtype == "int8":
+            scale = np.abs(weights).max(axis=0) / 127
+            scale[scale == 0] = 1
+            weights = np.round(weights / scale).astype(np.int8) * scale
+
+        return np.ascontiguousarray(weights, dtype=compute_dtype)
+
+    def allocate_buffers(self, batch_size):
+
+        compute_dtype = self.weights[0].dtype
+        buffers = [np.empty((batch_size, self.weights[0].shape[0]), dtype=compute_dtype)]
+        for weights in self.weights:
+            buffers.append(np.empty((batch_size, weights.shape[1]), dtype=compute_dtype))
+        self.buffers[batch_size] = buffers
+
+        return buffers
+
+    def predict(self, input_data):
+
+        batch_size = len(input_data)
+        buffers = self.buffers.get(batch_size)
+        if buffers is None:
+            buffers = self.allocate_buffers(batch_size)
+
+        # copy input into work buffer
+        np.copyto(buffers[0], input_data.reshape(batch_size, -1))
+
+        # first layer
+        np.dot(buffers[0], self.weights[0], out=buffers[1])
+        buffers[1] += self.biases[0]
+
+        return self.forward(buffers)
+
+    def forward(self, buffers):
+
+        # remaining hidden layers and output layer, first layer output is stored in buffers[1]
+        data = buffers[1]
+        for index in range(1, len(self.weights)):
+            np.maximum(data, 0, out=data)
+            output = buffers[index+1]
+            np.dot(data, self.weights[index], out=output)
+            output += self.biases[index]
+            data = output
+
+        return np.squeeze(data.astype(np.float64))[()]
+
+    def validate(self, model_weights, input_data):
+
+        model_weights = [np.asarray(parameter, dtype=np.float64) for parameter in model_weights]
+
+        return np.max(np.abs(self.predict(input_data) - predict(model_weights, input_data.astype(np.float64))))
+
+class IncrementalModel:
+
+    def __init__(self, compiled_model, gather_table, refresh_interval=1000, max_changed_fraction=0.2):
+        '''
+        Attributes:
+        compiled_model: instance of CompiledModel class;
+        site_weights: 2d array of first layer weights rearranged to mask sites x (paths x hidden neurons);
+        accumulators: 2d array of first layer outputs without biases for eight paths;
+        buffers: preallocated work buffers of compiled_model for eight paths;
+        site_vect: type vector of mask sites used by the last prediction;
+        refresh_interval: number of incremental updates between full recomputes, int;
+        max_changed_fraction: fraction of changed mask sites above which the accumulators are fully recomputed, float;
+        num_of_updates: number of incremental updates since the last full recompute, int;
+
+        Methods:
+        predict_sites: predict energy barriers from the type vector of mask sites;
+        get_state: return accumulators and last type vector for checkpoint;
+        set_state: restore accumulators and last type vector from checkpoint;
+        '''
+
+        self.compiled_model = compiled_model
+        self.refresh_interval = refresh_interval
+        self.max_changed_fraction = max_changed_fraction
+
+        # first layer weights of each path in mask site order, the last site is the vacancy with zero weights
+        weights = compiled_model.weights[0]
+        num_of_paths, num_of_sites = len(gather_table), gather_table.max() + 1
+        site_weights = np.zeros((num_of_sites, num_of_paths, weights.shape[1]), dtype=weights.dtype)
+        for path_index, cur_table in enumerate(gather_table):
+            pixel_index = np.flatnonzero(cur_table < num_of_sites - 1)
+            site_weights[cur_table[pixel_index], path_index] = weights[pixel_index]
+        self.site_weights = site_weights.reshape(num_of_sites, -1)
+
+        self.accumulators = np.zeros((num_of_paths, weights.shape[1]), dtype=weights.dtype)
+        self.buffers = compiled_model.buffers.get(num_of_paths)
+        if self.buffers is None:
+            self.buffers = compiled_model.allocate_buffers(num_of_paths)
+        self.site_vect = None
+        self.num_of_updates = 0
+
+    def predict_sites(self, site_vect):
+
+        # the changed sites update costs as much as a full recompute when about a fifth (float32) to a third (float64) of the sites change
+        changed = None
+        if self.site_vect is not None and self.num_of_updates < self.refresh_interval:
+            changed = np.flatnonzero(site_vect != self.site_vect)
+            if len(changed) > self.max_changed_fraction * len(site_vect):
+                changed = None
+
+        if changed is None:
+            # full recompute of first layer accumulators
+            np.dot(site_vect.astype(self.accumulators.dtype), self.site_weights, out=self.accumulators.reshape(-1))
+            self.num_of_updates = 0
+        else:
+            # update first layer accumulators by changed sites only
+            diff = site_vect[changed].astype(self.accumulators.dtype) - self.site_vect[changed].astype(self.accumulators.dtype)
+            self.accumulators += np.dot(diff, self.site_weights[changed]).reshape(self.accumulators.shape)
+            self.num_of_updates += 1
+        self.site_vect = site_vect.copy()
+
+        # first layer output and remaining layers
+        np.add(self.accumulators, self.compiled_model.biases[0], out=self.buffers[1])
+
+        return self.compiled_model.forward(self.buffers)
+
+    def get_state(self):
+
+        # incremental accumulators carry rounding history, a full recompute would not match
+        if self.site_vect is None:
+            return {}
+
+        return {"incremental_accumulators": self.accumulators, "incremental_site_vect": self.site_vect, \
+                "incremental_num_of_updates": self.num_of_updates}
+
+    def set_state(self, state):
+
+        if "incremental_site_vect" in state:
+            self.accumulators[...] = state["incremental_accumulators"]
+            self.site_vect = state["incremental_site_vect"].copy()
+            self.num_of_updates = int(state["incremental_num_of_updates"])
+
+class barrier_cache:
+
+    def __init__(self, predict_fn, capacity):
+        '''
+        Attributes:
+        predict_fn: function predicting energy barriers of a batch of images;
+        capacity: maximum number of cached energy barriers, int;
+        barriers: ordered dict mapping image hash to energy barrier, least recently used first;
+        hits: number of images served from cache, int;
+        misses: number of images predicted by predict_fn, int;
+
+        Methods:
+        compute_key: return compact hash of the type vector of one image;
+        predict: return energy barriers of images, predicting only images missing from cache;
+        summary: return hit/miss counters as a string;
+        get_state: return cached keys, barriers and counters for checkpoint;
+        set_state: restore cached keys, barriers and counters from checkpoint;
+        '''
+
+        self.predict_fn = predict_fn
+        self.capacity = capacity
+        self.barriers = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def compute_key(self, img):
+
+        return hashlib.blake2b(img.astype(np.int8).tobytes(), digest_size=16).digest()
+
+    def predict(self, img_vects):
+
+        # look up each path separately
+        keys = [self.compute_key(img) for img in img_vects]
+        energy_barriers = np.zeros(len(keys))
+        miss_index = []
+        for index, key in enumerate(keys):
+            if key in self.barriers:
+                self.barriers.move_to_end(key)
+                energy_barriers[index] = self.barriers[key]
+            else:
+                miss_index.append(index)
+
+        # predict missing paths in one batch
+        if len(miss_index) > 0:
+            energy_barriers[miss_index] = np.atleast_1d(self.predict_fn(img_vects[miss_index]))
+            for index in miss_index:
+                self.barriers[keys[index]] = energy_barriers[index]
+
+            # evict least recently used barriers
+            while len(self.barriers) > self.capacity:
+                self.barriers.popitem(last=False)
+
+        self.hits += len(keys) - len(miss_index)
+        self.misses += len(miss_index)
+
+        return energy_barriers
+
+    def summary(self):
+
+        total = max(self.hits + self.misses, 1)
+        return "barrier cache: capacity {:.0f} size {:.0f} hits {:.0f} misses {:.0f} hit rate {:.4f}".format( \
+               self.capacity, len(self.barriers), self.hits, self.misses, self.hits / total)
+
+    def get_state(self):
+
+        keys = np.frombuffer(b"".join(self.barriers.keys()), dtype=np.uint8).reshape(-1, 16)
+        return {"cache_keys": keys, "cache_barriers": np.array(list(self.barriers.values())), \
+                "cache_counters": np.array([self.hits, self.misses])}
+
+    def set_state(self, state):
+
+        # keys in least recently used order
+        self.barriers = OrderedDict(zip([key.tobytes() for key in state["cache_keys"]], state["cache_barriers"]))
+        self.hits, self.misses = [int(counter) for counter in state["cache_counters"]]
+
+class lookahead_model:
+
+    def __init__(self, neuron_map, predict_fn):
+        '''
+        Attributes:
+        neuron_map: instance of neuron_map class built in the gather mode;
+        predict_fn: function predicting energy barriers of a batch of images;
+        candidates: neigh ids and energy barriers of the states after each jump of the last predicted state, None if used;
+        next_state: neigh ids and energy barriers of the current state taken from candidates, None if unknown;
+        num_of_calls: number of predict_fn calls, int;
+        num_of_images: number of images predicted by predict_fn, int;
+        num_of_hits: number of steps without inference, int;
+        predict_time: wall time of predict_fn calls, float;
+        single_state_time: mean wall time of predicting the current state alone as without lookahead, nan unless measured, float;
+
+        Methods:
+        predict: return neigh ids and energy barriers of the current state, predicting it with all candidate next states 
+                 in one batch unless known from the previous step;
+        advance: keep the candidate of the chosen path as the next state;
+        measure_single_state_time: time predictions of the current state alone, the per step cost without lookahead;
+        summary: return inference counters and per step predict time with and without lookahead as a string;
+        get_state: return the next state and inference counters for checkpoint;
+        set_state: restore the next state and inference counters from checkpoint;
+        '''
+
+        params = neuron_map.params
+        assert params.local_map_mode == "gather" and params.incremental_first_layer == False
+        assert params.multi_vacancy == False and params.superbasin == False
+
+        self.neuron_map = neuron_map
+        self.predict_fn = predict_fn
+        self.candidates, self.next_state = None, None
+        self.num_of_calls, self.num_of_images, self.num_of_hits = 0, 0, 0
+        self.predict_time = 0.0
+        self.single_state_time = np.nan
+
+    def predict(self):
+
+        # the current state was predicted as a candidate of the previous step
+        if self.next_state is not None:
+            neigh_ids, energy_barriers = self.next_state
+            self.neuron_map.neigh_ids = neigh_ids
+            self.next_state = None
+            self.num_of_hits += 1
+            return neigh_ids, energy_barriers
+
+        # current and candidate images in one batch
+        neigh_ids, site_vect = self.neuron_map.gather_local_sites()
+        candidate_neigh_ids, candidate_site_vects = self.neuron_map.gather_candidate_sites()
+        num_of_paths = len(self.neuron_map.gather_table)
+        img_vects = np.concatenate([site_vect.reshape(1, -1), candidate_site_vects])[:, self.neuron_map.gather_table]
+        img_vects = img_vects.reshape(-1, self.neuron_map.gather_table.shape[1])
+        if self.neuron_map.params.flatten == False:
+            img_vects = img_vects.reshape([len(img_vects), *self.neuron_map.params.local_neuron_map_dims])
+
+        start = time.perf_counter()
+        energy_barriers = np.atleast_1d(self.predict_fn(img_vects))
+        self.predict_time += time.perf_counter() - start
+        self.num_of_calls += 1
+        self.num_of_images += len(img_vects)
+
+        self.candidates = (candidate_neigh_ids, energy_barriers[num_of_paths:].reshape(num_of_paths, num_of_paths))
+
+        return neigh_ids, energy_barriers[:num_of_paths]
+
+    def advance(self, path_index):
+
+        if self.candidates is not None:
+            self.next_state = (self.candidates[0][path_index], self.candidates[1][path_index])
+            self.candidates = None
+
+    def measure_single_state_time(self, predict_fn, num_of_repeats=20):
+
+        # predict_fn should have no side effects such as cache counters, the first call allocates work buffers
+        _, img_vects = self.neuron_map.gather_local_neuron_map()
+        predict_fn(img_vects)
+        start = time.perf_counter()
+        for _ in range(num_of_repeats):
+            predict_fn(img_vects)
+        self.single_state_time = (time.perf_counter() - start) / num_of_repeats
+
+    def summary(self):
+
+        # lookahead pays off only if a batch of the current and all candidate states costs less than two single state calls
+        num_of_steps = max(self.num_of_calls + self.num_of_hits, 1)
+        return "lookahead: inference calls {:.0f} images {:.0f} steps without inference {:.0f} mean call time {:.4f} ms " \
+               "predict time per step {:.4f} ms without lookahead {:.4f} ms".format(self.num_of_calls, self.num_of_images, self.num_of_hits, \
+               1e3 * self.predict_time / max(self.num_of_calls, 1), 1e3 * self.predict_time / num_of_steps, 1e3 * self.single_state_time)
+
+    def get_state(self):
+
+        state = {"lookahead_counters": np.array([self.num_of_calls, self.num_of_images, self.num_of_hits]), \
+                 "lookahead_predict_time": np.array(self.predict_time)}
+
+        # an empty next state means the current state is predicted at the next step
+        if self.next_state is None:
+            state.update({"lookahead_neigh_ids": np.zeros(0, dtype=np.int64), "lookahead_barriers": np.zeros(0)})
+        else:
+            state.update({"lookahead_neigh_ids": np.asarray(self.next_state[0]), "lookahead_barriers": np.asarray(self.next_state[1])})
+
+        return state
+
+    def set_state(self, state):
+
+        self.candidates, self.next_state = None, None
+        if len(state["lookahead_neigh_ids"]) > 0:
+            self.next_state = (state["lookahead_neigh_ids"], state["lookahead_barriers"])
+        self.num_of_calls, self.num_of_images, self.num_of_hits = [int(counter) for counter in state["lookahead_counters"]]
+        self.predict_time = float(state["lookahead_predict_time"])
@@ -13,51 +13,83 @@ class neuron_map:
         '''
         Attributes:
         params: instance of params class;
-        mesh_info: mesh information summary including mesh, mesh_dims, mesh_size;
-        id_neuron_map: 3d array of atom ids;
-        type_neuron_map: 3d array of atom types;
-        id_to_type_index: dict mapping atom id to type and index;
-        type_neuron_map: dict mapping atom index to id and type;
+        mesh_info: mesh information summary including mesh (None unless materialized), mesh_dims, mesh_size;
+        id_neuron_map: 3d uint32 array of atom ids, or bcc_packed_map instance;
+        type_neuron_map: 3d int8 array of atom types, or bcc_packed_map instance;
+        id_to_type_index: instance of id_index_map class mapping atom id to type and index;
+        index_to_id_type: instance of index_id_map class mapping atom index to id and type;
         nonzero_mask: mask indicating the index of nonzero values in local neuron map;
         neigh_index: index of first nearest neighbors;
         rotation_maps: list of eight arrays, each array contains the atom index from corresponding operation;
+        gather_wrap_offsets: list of three arrays, wrapped flat offsets of mask sites along each dimension;
+        gather_table: 2d array mapping each flattened image pixel of eight paths to its mask site;
+        gather_neigh_sites: mask site index of first nearest neighbors;
 
         Methods:
         detect_local_neuron_map_nonzero_site: find the index of nonzero values in local neuron map;
         create_local_neuron_map: return local neuron map encoding local atomistic environment(3d array);
         aggregate_local_neuron_map: return aggregated local neuron maps corresponding to eight difusion paths; 4d array with dims 8xnxnxn
+        build_gather_index: precompute wrapped offset and permutation tables for the gather mode;
+        gather_local_sites: return neigh ids and types of mask sites followed by the vacancy site;
+        gather_local_neuron_map: return neigh ids and aggregated local neuron maps via a single gather;
+        gather_candidate_sites: return neigh ids and types of mask sites of the states after each first nearest neighbor jump;
+        load_maps: return id/type neuron maps of the configured layout from their flat vectors;
+        ravel_index: return flat index in neuron maps of 3d index;
+        unravel_index: return 3d index of flat index in neuron maps;
         '''
         
         # params class instance
         self.params = params
 
         # mesh
-        self.mesh_info = nnk.utils.create_mesh(box_lengths=self.params.box_lengths, voxel_size=self.params.voxel_size)
+        timer = self.params.timer
+        start = timer.tic()
+        self.mesh_info = nnk.utils.create_mesh(box_lengths=self.params.box_lengths, voxel_size=self.params.voxel_size, materialize=False)
+        
+        timer.toc("create_mesh", start, init=True)
         
         # get and store initial index 
-        self.id_neuron_map, self.type_neuron_map = nnk.utils.assign_atom_to_mesh(atoms=self.params.config, mesh_args=self.mesh_info)
+        start = timer.tic()
+        if self.params.restart == True:
+            self.id_neuron_map, self.type_neuron_map = self.load_maps(self.params.checkpoint["id_neuron_map"], \
+                                                                      self.params.checkpoint["type_neuron_map"])
+        elif self.params.lattice_layout == "bcc_packed":
+            mesh_index = nnk.utils.compute_mesh_index(atoms=self.params.config, mesh_args=self.mesh_info, number_of_cpus=self.params.num_of_cpus)
+            mesh_index = np.unravel_index(mesh_index, self.mesh_info[1])
+            self.id_neuron_map = bcc_packed_map(self.mesh_info[1], np.uint32, mesh_index, self.params.config[:, 0])
+            self.type_neuron_map = bcc_packed_map(self.mesh_info[1], np.int8, mesh_index, self.params.config[:, 1])
+        else:
+            self.id_neuron_map, self.type_neuron_map = nnk.utils.assign_atom_to_mesh(atoms=self.params.config, mesh_args=self.mesh_info, \
+                                                                                     number_of_cpus=self.params.num_of_cpus)
+        timer.toc("assign_atom_to_mesh", start, init=True)
 
         # build (id, type) - index maps
-        self.id_to_type_index = {}
-        self.index_to_id_type = {}
-        for i in range(self.id_neuron_map.shape[0]):
-            for j in range(self.id_neuron_map.shape[1]):
-                for k in range(self.id_neuron_map.shape[2]):
-                    cur_id, cur_type = self.id_neuron_map[i, j, k], self.type_neuron_map[i, j, k]
-                    if cur_id != 0:
-                        self.id_to_type_index[cur_id] = [cur_type, (i, j, k)]
-                        self.index_to_id_type[(i, j, k)] = [cur_id, cur_type]
+        start = timer.tic()
+        self.id_to_type_index = id_index_map(self)
+        self.index_to_id_type = index_id_map(self)
+        timer.toc("build_index_maps", start, init=True)
 
         # build local neuron map mask
+        start = timer.tic()
         self.nonzero_mask = self.detect_local_neuron_map_nonzero_site()
+        timer.toc("detect_mask", start, init=True)
 
         # build full rotation maps for all diffusion paths 
+        start = timer.tic()
         self.neigh_index = []
         self.rotation_maps = []
         for cur_vect in self.params.path_vects:
             self.neigh_index.append(nnk.utils.compute_neigh_index(center=self.params.local_neuron_map_center_index, vect=cur_vect))
             self.rotation_maps.append(nnk.utils.rotate_mirror_data(data=self.nonzero_mask, vect=cur_vect)+ \
             np.array(self.params.local_neuron_map_center_index))
+        timer.toc("build_rotation_maps", start, init=True)
+
+        # build gather tables
+        start = timer.tic()
+        assert self.params.local_map_mode in ("loop", "gather")
+        if self.params.local_map_mode == "gather":
+            self.build_gather_index()
+        timer.toc("build_gather_index", start, init=True)
     
     def detect_local_neuron_map_nonzero_site(self):
         
@@ -74,7 +106,8 @@ class neuron_map:
                     wrap_i, wrap_j, wrap_k = (i + vacancy_index[0]) % nx, (j + vacancy_index[1]) % ny, \
                     (k + vacancy_index[2]) % nz
                     
-                    if (self.type_neuron_map[wrap_i, wrap_j, wrap_k] != 0) & (dist(i, j, k) < self.params.cutoff):
+                    # other vacancies have type 0 but remain lattice sites
+                    if (self.id_neuron_map[wrap_i, wrap_j, wrap_k] != 0) & ((i, j, k) != (0, 0, 0)) & (dist(i, j, k) < self.params.cutoff):
                         nonzero_mask.append((i, j, k))
 
         return np.array(nonzero_mask)        
@@ -84,8 +117,8 @@ class neuron_map:
         # build local id/type neuron map
         vacancy_index = self.id_to_type_index[self.params.vacancy_id][1]
         lx, ly, lz = center=self.params.local_neuron_map_center_index
-        self.local_id_neuron_map = np.zeros(self.params.local_neuron_map_dims)
-        self.local_type_neuron_map = np.zeros(self.params.local_neuron_map_dims)
+        self.local_id_neuron_map = np.zeros(self.params.local_neuron_map_dims, dtype=self.id_neuron_map.dtype)
+        self.local_type_neuron_map = np.zeros(self.params.local_neuron_map_dims, dtype=self.type_neuron_map.dtype)
         for i, j, k in self.nonzero_mask:
             wrap_i, wrap_j, wrap_k = (i + vacancy_index[0]) % self.mesh_info[1][0], (j + vacancy_index[1]) % self.mesh_info[1][1], \
             (k + vacancy_index[2]) % self.mesh_info[1][2]
@@ -116,3 +149,265 @@ class neuron_map:
 
         return np.array(img_vects)
 
+    def build_gather_index(self):
+
+        # mask sites followed by the vacancy site, which always has type 0 and fills the empty pixels
+        sites = np.r_[self.nonzero_mask, np.zeros((1, 3), dtype=self.nonzero_mask.dtype)]
+        num_of_sites = len(sites)
+
+        # wrapped flat offsets of mask sites for every voxel index along each dimension
+        mesh_dims = self.mesh_info[1]
+        strides = [mesh_dims[1] * mesh_dims[2], mesh_dims[2], 1]
+        self.gather_wrap_offsets = []
+        for axis in range(3):
+            voxel_index = np.arange(mesh_dims[axis]).reshape(-1, 1)
+            wrap_index = (voxel_index + sites[:, axis]) % mesh_dims[axis]
+            if isinstance(self.type_neuron_map, bcc_packed_map):
+                self.gather_wrap_offsets.append(self.type_neuron_map.axis_offsets(axis, wrap_index))
+            else:
+                self.gather_wrap_offsets.append(wrap_index * strides[axis])
+
+        # permutation table of flattened images, pixels outside the mask point to the vacancy site
+        num_of_pixels = np.prod(self.params.local_neuron_map_dims)
+        self.gather_table = np.full((len(self.rotation_maps), num_of_pixels), num_of_sites - 1)
+        for path_index, cur_map in enumerate(self.rotation_maps):
+            pixel_index = np.ravel_multi_index(cur_map.T, self.params.local_neuron_map_dims)
+            self.gather_table[path_index, pixel_index] = np.arange(len(cur_map))
+
+        # mask site of first nearest neighbors
+        self.gather_neigh_sites = np.array([np.flatnonzero(np.all(self.nonzero_mask == vect, axis=1))[0] \
+                                            for vect in self.params.path_vects])
+
+    def gather_local_sites(self, vacancy_id=None, vacancy_index=None):
+
+        if vacancy_id is None:
+            vacancy_id = self.params.vacancy_id
+
+        # flat index of mask sites around the vacancy
+        if vacancy_index is None:
+            vacancy_index = self.id_to_type_index[vacancy_id][1]
+        i, j, k = vacancy_index
+        id_vect, type_vect = self.id_neuron_map.reshape(-1), self.type_neuron_map.reshape(-1)
+        sites = self.gather_wrap_offsets[0][i] + self.gather_wrap_offsets[1][j] + self.gather_wrap_offsets[2][k]
+
+        # gather neigh ids and types of mask sites
+        self.neigh_ids = id_vect[sites[self.gather_neigh_sites]]
+
+        return self.neigh_ids, type_vect[sites]
+
+    def gather_local_neuron_map(self, vacancy_id=None, vacancy_index=None):
+
+        # aggregated local type neuron maps from types of mask sites
+        neigh_ids, site_vect = self.gather_local_sites(vacancy_id, vacancy_index)
+        img_vects = site_vect[self.gather_table]
+
+        if self.params.flatten == False:
+            img_vects = img_vects.reshape([len(img_vects), *self.params.local_neuron_map_dims])
+
+        return neigh_ids, img_vects
+
+    def gather_candidate_sites(self, vacancy_id=None):
+
+        if vacancy_id is None:
+            vacancy_id = self.params.vacancy_id
+
+        # flat index of mask sites around each first nearest neighbor, the last site is the neighbor itself
+        vacancy_index = np.array(self.id_to_type_index[vacancy_id][1])
+        neigh_index = (vacancy_index + np.array(self.params.path_vects)) % np.array(self.mesh_info[1])
+        sites = self.gather_wrap_offsets[0][neigh_index[:, 0]] + self.gather_wrap_offsets[1][neigh_index[:, 1]] \
+                + self.gather_wrap_offsets[2][neigh_index[:, 2]]
+        id_vect, type_vect = self.id_neuron_map.reshape(-1), self.type_neuron_map.reshape(-1)
+        ids, types = id_vect[sites], type_vect[sites]
+
+        # exchange the vacancy and the jump atom in the gathered copies only
+        moved_in = sites == self.id_to_type_index.flat_index[vacancy_id]
+        moved_out = sites == sites[:, -1:]
+        ids[moved_in], types[moved_in] = np.broadcast_to(ids[:, -1:], ids.shape)[moved_in], np.broadcast_to(types[:, -1:], types.shape)[moved_in]
+        ids[moved_out], types[moved_out] = vacancy_id, 0
+
+        return ids[:, self.gather_neigh_sites], types
+
+    def load_maps(self, id_vect, type_vect):
+
+        if self.params.lattice_layout == "bcc_packed":
+            return bcc_packed_map(self.mesh_info[1], id_vect.dtype, data=id_vect), bcc_packed_map(self.mesh_info[1], type_vect.dtype, data=type_vect)
+
+        return id_vect.reshape(self.mesh_info[1]), type_vect.reshape(self.mesh_info[1])
+
+    def ravel_index(self, index):
+
+        if isinstance(self.type_neuron_map, bcc_packed_map):
+            return self.type_neuron_map.ravel_index(index)
+
+        return np.ravel_multi_index(index, self.type_neuron_map.shape)
+
+    def unravel_index(self, flat_index):
+
+        if isinstance(self.type_neuron_map, bcc_packed_map):
+            return self.type_neuron_map.unravel_index(flat_index)
+
+        _, ny, nz = self.type_neuron_map.shape
+        i, rest = divmod(flat_index, ny * nz)
+        j, k = divmod(rest, nz)
+
+        return i, j, k
+
+class id_index_map:
+
+    def __init__(self, neuron_map, flat_index=None):
+        '''
+        Attributes:
+        neuron_map: instance of neuron_map class holding id/type neuron maps;
+        flat_index: 1d array mapping atom id to flat index in neuron maps, -1 for missing ids;
+
+        Methods:
+        copy: return a copy bound to another neuron_map instance;
+        to_columns: return atom ids in ascending order with their types and 3d indexes;
+        '''
+
+        self.neuron_map = neuron_map
+
+        # flat index of every atom id built from id neuron map
+        if flat_index is None:
+            id_vect = neuron_map.id_neuron_map.reshape(-1)
+            voxel_index = np.flatnonzero(id_vect)
+            index_dtype = np.int32 if id_vect.size < np.iinfo(np.int32).max else np.int64
+            flat_index = np.full(id_vect.max() + 1, -1, dtype=index_dtype)
+            flat_index[id_vect[voxel_index]] = voxel_index
+        self.flat_index = flat_index
+
+    def __getitem__(self, atom_id):
+
+        flat_index = int(self.flat_index[atom_id])
+
+        return self.neuron_map.type_neuron_map.reshape(-1)[flat_index], self.neuron_map.unravel_index(flat_index)
+
+    def __setitem__(self, atom_id, type_index):
+
+        # atom type is stored in type neuron map
+        self.flat_index[atom_id] = self.neuron_map.ravel_index(type_index[1])
+
+    def __len__(self):
+
+        return np.count_nonzero(self.flat_index >= 0)
+
+    def copy(self, neuron_map):
+
+        return id_index_map(neuron_map, self.flat_index.copy())
+
+    def to_columns(self):
+
+        # atoms ordered by id
+        atom_ids = np.flatnonzero(self.flat_index >= 0)
+        index = self.neuron_map.unravel_index(self.flat_index[atom_ids])
+        atom_types = self.neuron_map.type_neuron_map.reshape(-1)[self.flat_index[atom_ids]]
+
+        return atom_ids, atom_types, index
+
+
+class index_id_map:
+
+    def __init__(self, neuron_map):
+        '''
+        Attributes:
+        neuron_map: instance of neuron_map class holding id/type neuron maps;
+        '''
+
+        self.neuron_map = neuron_map
+
+    def __getitem__(self, index):
+
+        return self.neuron_map.id_neuron_map[index], self.neuron_map.type_neuron_map[index]
+
+    def __setitem__(self, index, id_type):
+
+        self.neuron_map.id_neuron_map[index], self.neuron_map.type_neuron_map[index] = id_type
+
+
+class bcc_packed_map:
+
+    def __init__(self, shape, dtype, index=None, values=None, data=None):
+        '''
+        Attributes:
+        shape: shape of the full neuron map, all dims even, tuple;
+        dtype: numeric type of stored values;
+        sublattice_dims: shape of each of the two bcc sublattices, tuple;
+        sublattice_size: number of sites of one sublattice, int;
+        data: 1d array of values on bcc sites, sublattice of even indexes first;
+
+        Methods:
+        ravel_index: return packed flat index of 3d index on bcc sites;
+        unravel_index: return 3d index of packed flat index;
+        axis_offsets: return additive packed flat offsets of indexes along one dimension;
+        reshape: return packed flat data, only shape -1 is supported;
+        copy: return a copy;
+        '''
+
+        # voxels of bcc sites have three even or three odd indexes
+        assert all(dim % 2 == 0 for dim in shape)
+        self.shape = tuple(int(dim) for dim in shape)
+        self.dtype = np.dtype(dtype)
+        self.sublattice_dims = tuple(dim // 2 for dim in self.shape)
+        self.sublattice_size = int(np.prod(self.sublattice_dims))
+
+        if data is None:
+            data = np.zeros(2 * self.sublattice_size, dtype=self.dtype)
+            if index is not None:
+                assert np.all((index[0] % 2 == index[1] % 2) & (index[1] % 2 == index[2] % 2))
+                data[self.ravel_index(index)] = values
+        self.data = data
+
+    @property
+    def nbytes(self):
+
+        return self.data.nbytes
+
+    def ravel_index(self, index):
+
+        i, j, k = index
+        _, ny, nz = self.sublattice_dims
+
+        return (i % 2) * self.sublattice_size + ((i // 2) * ny + j // 2) * nz + k // 2
+
+    def unravel_index(self, flat_index):
+
+        _, ny, nz = self.sublattice_dims
+        sublattice, rest = divmod(flat_index, self.sublattice_size)
+        i, rest = divmod(rest, ny * nz)
+        j, k = divmod(rest, nz)
+
+        return 2 * i + sublattice, 2 * j + sublattice, 2 * k + sublattice
+
+    def axis_offsets(self, axis, index):
+
+        _, ny, nz = self.sublattice_dims
+        if axis == 0:
+            return (index % 2) * self.sublattice_size + (index // 2) * ny * nz
+        if axis == 1:
+            return (index // 2) * nz
+
+        return index // 2
+
+    def __getitem__(self, index):
+
+        # voxels between bcc sites are always empty
+        i, j, k = index
+        if i % 2 != j % 2 or j % 2 != k % 2:
+            return self.dtype.type(0)
+
+        return self.data[self.ravel_index(index)]
+
+    def __setitem__(self, index, value):
+
+        i, j, k = index
+        assert i % 2 == j % 2 == k % 2
+        self.data[self.ravel_index(index)] = value
+
+    def reshape(self, shape):
+
+        assert shape == -1
+        return self.data
+
+    def copy(self):
+
+        return bcc_packed_map(self.shape, self.dtype, data=self.data.copy())
@@ -0,0 +1,277 @@
+# synchronous sublattice kinetic monte carlo on shared memory neuron maps
+
+import os
+import copy
+import time
+import types
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+import nnk.kmc_module
+import nnk.ml_predict
+import nnk.utils
+
+'''
+init_worker: attach shared neuron maps and build the deep neural network in a worker process;
+run_sector: advance the vacancies of one active sector until the sub-cycle time window is used up;
+'''
+
+worker_state = {}
+
+def init_worker(shm_names, shapes, dtypes, template, model_weight, model_dtype):
+
+    # attach shared id/type neuron maps
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    template.id_neuron_map = np.ndarray(shapes[0], dtype=dtypes[0], buffer=shms[0].buf)
+    template.type_neuron_map = np.ndarray(shapes[1], dtype=dtypes[1], buffer=shms[1].buf)
+
+    worker_state["shms"] = shms
+    worker_state["neuron_map"] = template
+    worker_state["kinetics"] = nnk.kmc_module.kmc(template.params, template)
+    worker_state["model"] = nnk.ml_predict.CompiledModel(model_weight, dtype=model_dtype)
+
+def run_sector(task):
+
+    start_time = time.perf_counter()
+    vacancy_ids, vacancy_index, lower, upper, time_window, seed = task
+    neuron_map, kinetics, model = worker_state["neuron_map"], worker_state["kinetics"], worker_state["model"]
+    mesh_dims = np.array(neuron_map.mesh_info[1])
+    path_vects = neuron_map.params.path_vects
+    rng = np.random.default_rng(seed)
+
+    # advance active vacancies until the time window is used up or all left the sector
+    events, local_time = [], 0.0
+    active = list(range(len(vacancy_ids)))
+    while len(active) > 0:
+        neigh_ids, img_vects, vacancy_neigh = [], [], []
+        for slot in active:
+            cur_neigh_ids, cur_site_vect = neuron_map.gather_local_sites(vacancy_index=vacancy_index[slot])
+            neigh_ids.append(cur_neigh_ids)
+            img_vects.append(cur_site_vect[neuron_map.gather_table])
+            vacancy_neigh.append(cur_site_vect[neuron_map.gather_neigh_sites] == 0)
+        rates = kinetics.compute_jump_rates(np.atleast_1d(model.predict(np.concatenate(img_vects))))
+        rates[np.concatenate(vacancy_neigh)] = 0
+        rates_sum = np.sum(rates)
+
+        # reject the event exceeding the time window
+        jump_time = - np.log(1.0 - rng.random()) / rates_sum
+        if local_time + jump_time > time_window:
+            break
+        local_time += jump_time
+
+        # select event and swap vacancy and jump atom in shared neuron maps
+        event = min(np.searchsorted(np.cumsum(rates), rng.random() * rates_sum, side="right"), len(rates) - 1)
+        active_index, path_index = divmod(event, len(path_vects))
+        slot = active[active_index]
+        jump_id = int(neigh_ids[active_index][path_index])
+        old_index, new_index = tuple(vacancy_index[slot]), tuple((vacancy_index[slot] + path_vects[path_index]) % mesh_dims)
+        for cur_map in (neuron_map.id_neuron_map, neuron_map.type_neuron_map):
+            cur_map[old_index], cur_map[new_index] = cur_map[new_index], cur_map[old_index]
+        vacancy_index[slot] = new_index
+        events.append((local_time, vacancy_ids[slot], jump_id))
+
+        # vacancies leaving the active sector stop for this sub-cycle
+        if np.any(vacancy_index[slot] < lower) or np.any(vacancy_index[slot] >= upper):
+            active.remove(slot)
+
+    return events, vacancy_index, time.perf_counter() - start_time
+
+
+class parallel_kmc:
+
+    def __init__(self, params, neuron_map, kinetics):
+        '''
+        Attributes:
+        params: instance of params class;
+        neuron_map: instance of neuron_map class built in the gather mode;
+        kinetics: instance of kmc class used to update id/type - index maps;
+        num_of_workers: number of worker processes, int;
+        domain_bounds: list of three arrays, voxel bounds of sub-domains along each dimension;
+        sector_bounds: list of three arrays, voxel bounds of sectors, each sub-domain holds 2x2x2 sectors;
+        ghost_width: width of ghost region read around an active sector in voxels, int;
+        vacancy_ids: array of vacancy ids;
+        vacancy_index: 2d array of vacancy indexes in neuron map;
+        time_window: kmc time of one sub-cycle, float;
+        shms: shared memory blocks of id/type neuron maps;
+        pool: pool of worker processes;
+        seed_sequence: seed sequence of random streams of sub-cycle tasks;
+        print_f: file for storing parallel efficiency of each sub-cycle;
+
+        Methods:
+        create_sectors: return domain/sector bounds and check sectors are wider than ghost regions;
+        create_shared_maps: move id/type neuron maps to shared memory;
+        estimate_time_window: return sub-cycle time window from the largest initial vacancy rate;
+        compute_sector: return domain index and sector index of vacancies;
+        run: run sub-cycles until the number of events is reached and dump events to log file or binary jump log;
+        close: stop worker processes and release shared memory, terminate workers on errors;
+        '''
+
+        assert len(params.vacancy_ids) > 0, "parallel_kmc requires vacancy_ids"
+        assert params.local_map_mode == "gather" and params.lattice_layout == "full"
+        assert params.restart == False and params.checkpoint_interval == 0 and params.trajectory_interval == 0 \
+               and params.sro_interval == 0 and params.superbasin == 0 \
+               and params.lookahead == 0 and params.block_rng == 0
+
+        self.params = params
+        self.neuron_map = neuron_map
+        self.kinetics = kinetics
+        self.num_of_workers = params.num_of_cpus
+        self.vacancy_ids = np.array(params.vacancy_ids)
+        self.vacancy_index = np.array([neuron_map.id_to_type_index[vacancy_id][1] for vacancy_id in self.vacancy_ids])
+        self.seed_sequence = np.random.SeedSequence(params.parallel_seed)
+
+        # sub-domains, sectors and time window
+        self.ghost_width = params.local_neuron_map_center_index[0] + 1
+        self.domain_bounds, self.sector_bounds = self.create_sectors()
+        self.time_window = params.sublattice_time_window
+        if self.time_window <= 0:
+            self.time_window = self.estimate_time_window()
+
+        # worker processes attached to shared neuron maps, partially created resources are released on errors
+        self.shms, self.pool, self.print_f = [], None, None
+        try:
+            self.create_shared_maps()
+            template = copy.copy(neuron_map)
+            template.params = types.SimpleNamespace(local_map_mode="gather", vacancy_id=None, flatten=params.flatten, \
+                                                    local_neuron_map_dims=params.local_neuron_map_dims, path_vects=params.path_vects, \
+                                                    attempt_frequency=params.attempt_frequency, boltzmann_constant=params.boltzmann_constant, \
+                                                    temperature=params.temperature, block_rng=0)
+            template.mesh_info = (None, neuron_map.mesh_info[1], neuron_map.mesh_info[2])
+            template.id_to_type_index, template.index_to_id_type = None, None
+            template.id_neuron_map, template.type_neuron_map = None, None
+            shapes = [self.neuron_map.id_neuron_map.shape, self.neuron_map.type_neuron_map.shape]
+            dtypes = [self.neuron_map.id_neuron_map.dtype, self.neuron_map.type_neuron_map.dtype]
+            self.pool = multiprocessing.Pool(self.num_of_workers, initializer=init_worker, \
+                                             initargs=([shm.name for shm in self.shms], shapes, dtypes, template, \
+                                                       params.model_weight, params.model_dtype))
+
+            self.print_f = open(os.path.join(params.res_dir, "parallel.log"), "w")
+            print("# cycle sector num_of_events wall_time busy_time efficiency", file=self.print_f)
+        except BaseException:
+            self.close(terminate=True)
+            raise
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close(terminate=exc_type is not None)
+
+    def create_sectors(self):
+
+        domain_bounds, sector_bounds = [], []
+        for axis in range(3):
+            num_of_voxels, num_of_domains = self.neuron_map.mesh_info[1][axis], self.params.domain_grid[axis]
+            cur_bounds = np.arange(2 * num_of_domains + 1) * num_of_voxels // (2 * num_of_domains)
+
+            # sectors of the same index in neighboring domains must not see each others changes
+            assert np.min(np.diff(cur_bounds)) > self.ghost_width
+            domain_bounds.append(cur_bounds[::2])
+            sector_bounds.append(cur_bounds)
+
+        return domain_bounds, sector_bounds
+
+    def create_shared_maps(self):
+
+        self.shms = []
+        for key in ("id_neuron_map", "type_neuron_map"):
+            cur_map = getattr(self.neuron_map, key)
+            shm = shared_memory.SharedMemory(create=True, size=cur_map.nbytes)
+            self.shms.append(shm)
+            shared_map = np.ndarray(cur_map.shape, dtype=cur_map.dtype, buffer=shm.buf)
+            shared_map[...] = cur_map
+            setattr(self.neuron_map, key, shared_map)
+
+    def estimate_time_window(self):
+
+        # on average at most one event per vacancy and sub-cycle
+        model = nnk.ml_predict.CompiledModel(self.params.model_weight, dtype=self.params.model_dtype)
+        img_vects = [self.neuron_map.gather_local_neuron_map(vacancy_id)[1] for vacancy_id in self.vacancy_ids]
+        rates = self.kinetics.compute_jump_rates(model.predict(np.concatenate(img_vects))).reshape(len(self.vacancy_ids), -1)
+
+        return 1 / np.max(np.sum(rates, axis=1))
+
+    def compute_sector(self):
+
+        domain_index, sector_index = np.zeros(len(self.vacancy_ids), dtype=np.int64), np.zeros(len(self.vacancy_ids), dtype=np.int64)
+        for axis in range(3):
+            cur_sector = np.searchsorted(self.sector_bounds[axis], self.vacancy_index[:, axis], side="right") - 1
+            domain_index = domain_index * self.params.domain_grid[axis] + cur_sector // 2
+            sector_index += (cur_sector % 2) << axis
+
+        return domain_index, sector_index
+
+    def run(self, num_of_events, print_f, jump_log=None):
+
+        cycle, event_count, cycle_start = 0, 0, 0.0
+        last_time = 0.0
+        while event_count < num_of_events:
+            active_sector = cycle % 8
+            domain_index, sector_index = self.compute_sector()
+
+            # one task per sub-domain with vacancies in the active sector
+            tasks, task_slots = [], []
+            for cur_domain in np.unique(domain_index[sector_index == active_sector]):
+                slots = np.flatnonzero((domain_index == cur_domain) & (sector_index == active_sector))
+                domain_coords = np.unravel_index(cur_domain, self.params.domain_grid)
+                sector_coords = [2 * domain_coords[axis] + ((active_sector >> axis) & 1) for axis in range(3)]
+                lower = np.array([self.sector_bounds[axis][sector_coords[axis]] for axis in range(3)])
+                upper = np.array([self.sector_bounds[axis][sector_coords[axis] + 1] for axis in range(3)])
+                seed = self.seed_sequence.spawn(1)[0].generate_state(1)[0]
+                tasks.append((self.vacancy_ids[slots], self.vacancy_index[slots].copy(), lower, upper, self.time_window, seed))
+                task_slots.append(slots)
+
+            # run sectors in parallel
+            wall_start = time.perf_counter()
+            results = self.pool.map(run_sector, tasks) if len(tasks) > 0 else []
+            wall_time = time.perf_counter() - wall_start
+
+            # merge events in kmc time order
+            events, busy_time = [], 0.0
+            for slots, (cur_events, cur_vacancy_index, cur_busy_time) in zip(task_slots, results):
+                self.vacancy_index[slots] = cur_vacancy_index
+                events.extend(cur_events)
+                busy_time += cur_busy_time
+            events.sort(key=lambda event: event[0])
+
+            for local_time, vacancy_id, jump_id in events:
+                self.kinetics.update_index_maps(jump_id, vacancy_id)
+                if jump_log is None:
+                    nnk.utils.dump_vacancy_jump(vacancy_id, jump_id, cycle_start + local_time - last_time, print_f)
+                else:
+                    jump_log.append(vacancy_id, jump_id, cycle_start + local_time - last_time)
+                last_time = cycle_start + local_time
+            event_count += len(events)
+
+            # parallel efficiency of the sub-cycle
+            efficiency = busy_time / (self.num_of_workers * wall_time) if wall_time > 0 else 0.0
+            print("{:.0f} {:.0f} {:.0f} {:.3e} {:.3e} {:.3f}".format(cycle, active_sector, len(events), wall_time, busy_time, efficiency), file=self.print_f)
+
+            cycle += 1
+            cycle_start += self.time_window
+
+    def close(self, terminate=False):
+
+        # workers may be busy with tasks of a failed sub-cycle
+        if self.pool is not None:
+            if terminate == True:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.print_f is not None:
+            self.print_f.close()
+            self.print_f = None
+
+        # copy neuron maps back to private memory
+        if len(self.shms) > 0:
+            self.neuron_map.id_neuron_map = self.neuron_map.id_neuron_map.copy()
+            self.neuron_map.type_neuron_map = self.neuron_map.type_neuron_map.copy()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
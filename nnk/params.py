@@ -5,35 +5,78 @@ import shutil
 import random
 import numpy as np
 
+import nnk.utils
+import nnk.timing_module
+
 class params:
 
-    def __init__(self):
+    def __init__(self, inp=None):
         '''
         Attributes:
+        inp: user input file name, dict of user input params, or None for the file given on the command line;
         attempt_frequency: attempt jump frequency, float value;
         boltzmann_constant: boltzmann constant, float value;
-        params_inp_name: user input file name, string;
-        dim_row: line number of simulation box dimensions in lammps dump file, int;
-        dim_row_num: number of lines for simulation box dimensions in lammps dump file, int;
-        config_row: line number of atomic information in lammps dump file, int;
-        num_of_atoms: number of atoms, int;
-        init_step: initial jump step, int;
-        num_of_steps: number of jump steps, int;
+        params_inp_name: user input file name, None for dict input, string;
+        dim_row: line number of simulation box dimensions in lammps dump file, unused since the header is parsed, int;
+        dim_row_num: number of lines for simulation box dimensions in lammps dump file, unused since the header is parsed, int;
+        config_row: line number of atomic information in lammps dump file, unused since the header is parsed, int;
+        num_of_atoms: number of atoms, read from lammps dump file, int;
+        dump_cache: keep a memory-mapped binary copy of the initial dump next to it, int(boolean);
+        init_step: initial jump step, the step after the checkpoint in restart, int;
+        num_of_steps: number of jump steps, remaining steps in restart, int;
+        checkpoint_interval: number of jump steps between checkpoints, 0 disables checkpoints, int;
+        checkpoint_file: checkpoint file name in res_dir, string;
+        restart: resume from checkpoint_file instead of init_config_dump and append to log file, int(boolean);
+        checkpoint: arrays loaded from checkpoint_file in restart, dict;
         random_vacancy: generate a vacancy id randomly, int(boolean);
         vacancy_id: user specified vacancy id, int;
+        vacancy_ids: user specified vacancy ids for multi-vacancy simulation, comma separated list of int;
+        multi_vacancy: simulate all vacancies in vacancy_ids, boolean;
+        num_of_replicas: number of lock-step ensemble replicas, 0 disables the ensemble, int;
+        ensemble_seed: seed of random streams of ensemble replicas, int;
+        replica_vacancy_ids: vacancy ids of ensemble replicas, comma separated list of int;
+        parallel_kmc: run multi-vacancy simulation with synchronous sublattice kmc on num_of_cpus processes, int(boolean);
+        domain_grid: number of sub-domains along each dimension, comma separated list of int;
+        sublattice_time_window: kmc time of one sub-cycle, 0 estimates it from initial rates, float;
+        parallel_seed: seed of random streams of parallel sub-cycles, int;
         dump_vacancy_id: dump vacancy id, int(boolean);
         num_of_cpus: number of cpus, int;
         flatten: flatten local neuron maps, int(boolean);
+        barrier_cache_size: capacity of energy barrier cache, 0 disables the cache, int;
+        model_dtype: numeric type of compiled deep neural network, "float64", "float32", "float16" or "int8", string;
+        incremental_first_layer: update first layer outputs by changed mask sites, requires gather local_map_mode, int(boolean);
+        first_layer_refresh_interval: number of incremental first layer updates between full recomputes, int;
+        lattice_layout: storage of id/type neuron maps, "full" or "bcc_packed" (gather/loop local_map_mode), string;
+        local_map_mode: local neuron map construction mode, "loop" or "gather", string;
         cutoff: cutoff distance, float;
         voxel_size: voxel size for building up neuron map, float;
         temperature: simulation temperature, float;
         init_config_dump: initial dump file name, string;
         ml_model_weight: deep neural network weights file name, string;
         log_file: log file name, string;
+        log_format: jump log format, "text" or "binary" (jumps go to <log_file stem>.bin, comments stay in log_file), string;
+        trajectory_interval: number of jump steps between keyframes of binary trajectory in res_dir, 0 disables the trajectory, int;
+        sro_interval: number of jump steps between warren-cowley samples written to sro.dat in res_dir, 0 disables tracking, int;
+        sro_shells: number of neighbor shells of warren-cowley parameters, int;
+        lookahead: predict the current state with all candidate next states in one batch so that every other step needs no inference, 
+                   single vacancy in gather local_map_mode only, useful only when batch inference is cheap, compare the per step predict times 
+                   with and without lookahead in the log summary, int(boolean);
+        superbasin: solve transient basins of frequently revisited states and jump out in one exit event, single vacancy only, int(boolean);
+        superbasin_visits: number of visits after which a state joins transient basins, int;
+        superbasin_max_states: largest number of states solved as one basin, int;
+        superbasin_cache_size: largest number of states whose rates are cached, int;
+        block_rng: sample jump paths and times from blocks of uniforms of a seeded generator instead of the global random modules, int(boolean);
+        rng_seed: seed of the block sampler, int;
+        rng_stream: independent stream of the block sampler for the same seed, int;
+        rng_block_size: number of uniforms drawn per block, int;
+        timing: time initialization and step stages, summary written to timing.txt/timing.json in res_dir, int(boolean);
+        timing_interval: time every timing_interval-th step only, int;
+        timer: instance of stage_timer class;
+        log_details: also record chosen path index and energy barrier in binary jump log, int(boolean);
         res_dir: output directory name, string;
         dims: simulation box dimensions, array;
-        init_config: initial atomic configuration, array;
-        config: current atomic configuration, array;
+        init_config: initial atomic configuration rounded to 0.01, read-only memory map of the dump cache if used, None in restart, array;
+        config: current atomic configuration, None in restart, array;
         box_lengths: simulation box length, array;
         path_vects: vectors indicating diffusion path directions, array;
         local_neuron_map_dims: shape of local neuron map, list;
@@ -44,43 +87,88 @@ class params:
 
         Method:
         add_param: add attributes to the params class;
-        parse_inp: load user input parameters;
+        parse_inp: load user input parameters as (key, value) pairs from file or dict;
+        convert_param: convert a user input value given as string to the type of its key;
         parse_config: load atomic information;
+        load_checkpoint: load box, vacancies and steps from checkpoint;
+        open_log: create res_dir and open log file, or truncate log file to its checkpointed size on restart;
         load_path_vects: generate and load path vectors;
         '''
 
         # predefined params
         self.attempt_frequency = 1e13
         self.boltzmann_constant = 8.617333e-5
-        self.params_inp_name = sys.argv[1]
+        if inp is None:
+            inp = sys.argv[1]
+        self.params_inp_name = inp if isinstance(inp, str) else None
+        self.inp = inp
         
         # load user input params 
-        key_int = {"dim_row", "dim_row_num", "config_row", "num_of_atoms", \
+        self.key_int = key_int = {"dim_row", "dim_row_num", "config_row", "num_of_atoms", \
                    "init_step", "num_of_steps", \
                    "random_vacancy", "vacancy_id", "dump_vacancy_id", \
-                   "num_of_cpus", "flatten"}
+                   "num_of_cpus", "flatten", "barrier_cache_size", \
+                   "incremental_first_layer", "first_layer_refresh_interval", \
+                   "num_of_replicas", "ensemble_seed", "parallel_kmc", "parallel_seed", "dump_cache", \
+                   "checkpoint_interval", "restart", "log_details", "trajectory_interval", \
+                   "sro_interval", "sro_shells", "timing", "timing_interval", \
+                   "lookahead", "superbasin", "superbasin_visits", "superbasin_max_states", "superbasin_cache_size", \
+                   "block_rng", "rng_seed", "rng_stream", "rng_block_size"}
+
+        self.key_float = key_float = {"cutoff", "voxel_size", "temperature", "sublattice_time_window"}
 
-        key_float = {"cutoff", "voxel_size", "temperature"}
+        self.key_list_int = key_list_int = {"vacancy_ids", "replica_vacancy_ids", "domain_grid"}
 
-        key_str = {"init_config_dump", "ml_model_weight", "log_file", "res_dir"}
+        key_str = {"init_config_dump", "ml_model_weight", "log_file", "res_dir", \
+                   "local_map_mode", "model_dtype", "lattice_layout", "checkpoint_file", "log_format"}
+
+        # default values of optional user input params
+        key_default = {"local_map_mode": "loop", "barrier_cache_size": 0, "model_dtype": "float32", \
+                       "incremental_first_layer": 0, "first_layer_refresh_interval": 1000, \
+                       "vacancy_ids": [], "num_of_replicas": 0, "ensemble_seed": 0, "replica_vacancy_ids": [], \
+                       "parallel_kmc": 0, "domain_grid": [1, 1, 1], "sublattice_time_window": 0.0, "parallel_seed": 0, \
+                       "dump_cache": 1, "lattice_layout": "full", \
+                       "checkpoint_interval": 0, "checkpoint_file": "checkpoint.npz", "restart": 0, \
+                       "log_format": "text", "log_details": 0, "trajectory_interval": 0, \
+                       "sro_interval": 0, "sro_shells": 2, "timing": 0, "timing_interval": 1, \
+                       "lookahead": 0, "superbasin": 0, "superbasin_visits": 4, "superbasin_max_states": 64, "superbasin_cache_size": 65536, \
+                       "block_rng": 0, "rng_seed": 0, "rng_stream": 0, "rng_block_size": 4096}
+        for key, val in key_default.items():
+            self.add_param(key=key, val=val)
         
         for key, val in self.parse_inp():
-            if key in key_int:
-                val = int(val)
-            if key in key_float:
-                val = float(val)
-            self.add_param(key=key, val=val)
+            self.add_param(key=key, val=self.convert_param(key, val))
+
+        # stage timer, started once user input params are known
+        self.timer = nnk.timing_module.stage_timer(self.timing, self.timing_interval)
         
-        # generate a random vacancy
-        if self.random_vacancy == True:
-            self.vacancy_id = random.randint(1, self.num_of_atoms)
-
-        # load configs 
-        self.dims, self.init_config = self.parse_config()
-        self.dims, self.init_config = self.dims.round(2), self.init_config.round(2)
-        self.config = self.init_config.copy()
-        self.config[self.vacancy_id-1, 1] = 0
+        start = self.timer.tic()
+        if self.restart == True:
+            # lattice state is restored from checkpoint, skip parsing the dump
+            self.load_checkpoint()
+            self.multi_vacancy = len(self.vacancy_ids) > 0
+            self.init_config, self.config = None, None
+        else:
+            # load configs, number of atoms is read from the dump header
+            self.dims, self.init_config = self.parse_config()
+            self.num_of_atoms = len(self.init_config)
+
+            # generate a random vacancy
+            if self.random_vacancy == True:
+                self.vacancy_id = random.randint(1, self.num_of_atoms)
+
+            # the first vacancy acts as the reference vacancy in multi-vacancy simulation
+            self.multi_vacancy = len(self.vacancy_ids) > 0
+            if self.multi_vacancy == True:
+                self.vacancy_id = self.vacancy_ids[0]
+
+            # configs are rounded by load_dump, init_config may be a read-only memmap of the cache, config is a writable copy
+            self.config = self.init_config.copy()
+            self.config[self.vacancy_id-1, 1] = 0
+            for vacancy_id in self.vacancy_ids:
+                self.config[vacancy_id-1, 1] = 0
         self.box_lengths = self.dims[:, 1] - self.dims[:, 0]
+        self.timer.toc("parse_config", start, init=True)
         
         # load vects of diffusion paths
         self.path_vects = self.load_path_vects()
@@ -90,30 +178,64 @@ class params:
         self.local_neuron_map_center_index = [dim // 2 for dim in self.local_neuron_map_dims]
 
         # load model weights
+        start = self.timer.tic()
         self.model_weight = np.load(self.ml_model_weight, allow_pickle=True)
+        self.timer.toc("load_model_weight", start, init=True)
+
+    def open_log(self):
         
-        # create directory for storing results
-        if os.path.exists(self.res_dir):
-            shutil.rmtree(self.res_dir)
-        os.mkdir(self.res_dir)
+        if self.restart == True:
+            # drop log lines written after the checkpoint and append
+            os.truncate(os.path.join(self.res_dir, self.log_file), int(self.checkpoint["log_size"]))
+            self.f = open(os.path.join(self.res_dir, self.log_file), "a")
+        else:
+            # create directory for storing results
+            if os.path.exists(self.res_dir):
+                shutil.rmtree(self.res_dir)
+            os.mkdir(self.res_dir)
         
-        # open log file
-        self.f = open(os.path.join(self.res_dir, self.log_file), "w")
+            # open log file
+            self.f = open(os.path.join(self.res_dir, self.log_file), "w")
 
     def add_param(self, key, val):
         setattr(self, key, val)
     
     def parse_inp(self):
+        if self.params_inp_name is None:
+            return list(self.inp.items())
         f = open(self.params_inp_name, "r")
         lines = [line.replace(" ", "").strip().split(":") for line in f.readlines() if line != "\n"]
         return lines
+
+    def convert_param(self, key, val):
+        # values of dict input may already be typed
+        if not isinstance(val, str):
+            return val
+        if key in self.key_int:
+            val = int(val)
+        if key in self.key_float:
+            val = float(val)
+        if key in self.key_list_int:
+            val = [int(cur_val) for cur_val in val.split(",")]
+        return val
     
     def parse_config(self):
-        dims = np.loadtxt(self.init_config_dump, delimiter=" ", skiprows=self.dim_row-1, max_rows=self.dim_row_num)
-        configs = np.loadtxt(self.init_config_dump, delimiter=" ", skiprows=self.config_row-1, max_rows=self.num_of_atoms)
+        dims, configs = nnk.utils.load_dump(self.init_config_dump, cache=self.dump_cache)
 
         return dims, configs
 
+    def load_checkpoint(self):
+        self.checkpoint = nnk.utils.load_checkpoint(os.path.join(self.res_dir, self.checkpoint_file))
+        assert str(self.checkpoint["lattice_layout"]) == self.lattice_layout
+
+        self.dims, self.num_of_atoms = self.checkpoint["dims"], int(self.checkpoint["num_of_atoms"])
+        self.vacancy_id, self.vacancy_ids = int(self.checkpoint["vacancy_id"]), [int(cur_id) for cur_id in self.checkpoint["vacancy_ids"]]
+
+        # continue right after the checkpointed step
+        end_step = self.init_step + self.num_of_steps
+        self.init_step = int(self.checkpoint["step"]) + 1
+        self.num_of_steps = end_step - self.init_step
+
     def load_path_vects(self):
 
         path_vects = []
@@ -1,77 +1,365 @@
 # 
 import os
+import zlib
+import shutil
+import multiprocessing
 import numpy as np
 
-def reconstruct_full_configs(maps, nnk_log, interval, dims, scale, res_dir):
+import nnk.log_module
 
-    # create dump file
-    filepath = os.path.join(res_dir, "full_configs.dump")
-    if os.path.exists(filepath):
-        os.remove(filepath)
-    dump = open(filepath, "a")
+worker_state = {}
 
-    jump_ids = nnk_log[:, 0].astype(np.int32)
-    vacancy_id = jump_ids[0]
-    num_of_atoms = len(maps)
-    for i in range(len(jump_ids)):
-        if i == 0:
-            dump_config(maps, dump, i, num_of_atoms, dims, scale)
-        else:
-            jump_id = jump_ids[i]
-            maps[vacancy_id][1], maps[jump_id][1] = maps[jump_id][1], maps[vacancy_id][1]
+def reconstruct_full_configs(maps, nnk_log, interval, dims, scale, res_dir, num_of_cpus=1):
 
-            if i % interval == 0:
-                dump_config(maps, dump, i, num_of_atoms, dims, scale)
+    vacancy_ids, jump_ids = split_nnk_log(nnk_log)
+    return reconstruct_configs(maps, vacancy_ids, jump_ids, interval, dims, scale, os.path.join(res_dir, "full_configs.dump"), num_of_cpus)
 
 
-def reconstruct_effective_configs(maps, nnk_log, interval, dims, scale, res_dir):
+def reconstruct_effective_configs(maps, nnk_log, interval, dims, scale, res_dir, num_of_cpus=1):
 
-    # create dump file
-    filepath = os.path.join(res_dir, "effective_configs.dump")
-    if os.path.exists(filepath):
-        os.remove(filepath)
-    dump = open(filepath, "a")
+    # only atoms taking part in jumps
+    vacancy_ids, jump_ids = split_nnk_log(nnk_log)
+    effective_maps = maps.select(np.unique(np.r_[vacancy_ids, jump_ids]))
 
-    jump_ids = nnk_log[:, 0].astype(np.int32)
-    effective_ids = np.unique(jump_ids)
-    effective_maps = {}
-    for cur_id in effective_ids:
-        effective_maps[cur_id] = maps[cur_id]
+    return reconstruct_configs(effective_maps, vacancy_ids, jump_ids, interval, dims, scale, os.path.join(res_dir, "effective_configs.dump"), num_of_cpus)
+
+
+def reconstruct_configs(maps, vacancy_ids, jump_ids, interval, dims, scale, filepath, num_of_cpus=1):
+
+    # atoms ordered by id, each atom starts on its own site
+    atom_ids, atom_types, site_index = create_config_arrays(maps)
+    atom_rows = np.searchsorted(atom_ids, np.r_[vacancy_ids, jump_ids]).reshape(2, -1)
+    lines = create_atom_lines(atom_ids, atom_types, site_index, scale)
+    header = [dims, len(atom_ids)]
+
+    # dumped frames, the first line of the log is the initial vacancy
+    frames = np.r_[0, np.arange(interval, len(jump_ids), interval)]
+
+    if num_of_cpus <= 1:
+        write_frames(atom_rows, lines, header, np.arange(len(atom_ids)), 0, frames, filepath)
+        return len(frames)
+
+    # replay once and keep site snapshots at the first frame of each task
+    tasks = []
+    sites = np.arange(len(atom_ids))
+    step = 0
+    for task_index, task_frames in enumerate(np.array_split(frames, min(len(frames), 4 * num_of_cpus))):
+        replay_jumps(sites, atom_rows, step, task_frames[0])
+        step = task_frames[0]
+        tasks.append((sites.copy(), step, task_frames, "{}.part{}".format(filepath, task_index)))
+
+    with multiprocessing.Pool(num_of_cpus, initializer=init_worker, initargs=(atom_rows, lines, header)) as pool:
+        part_files = pool.map(run_frames, tasks)
+
+    # concatenate parts in frame order
+    with open(filepath, "wb") as dump:
+        for part_file in part_files:
+            with open(part_file, "rb") as part:
+                shutil.copyfileobj(part, dump, 1 << 24)
+            os.remove(part_file)
+
+    return len(frames)
+
+
+def init_worker(atom_rows, lines, header):
+
+    worker_state["atom_rows"], worker_state["lines"], worker_state["header"] = atom_rows, lines, header
+
+def run_frames(task):
+
+    sites, step, frames, part_file = task
+    write_frames(worker_state["atom_rows"], worker_state["lines"], worker_state["header"], sites, step, frames, part_file)
+
+    return part_file
+
+def write_frames(atom_rows, lines, header, sites, step, frames, filepath):
+
+    # replay jumps between frames and write each frame as one block
+    dims, num_of_atoms = header
+    with open(filepath, "wb") as dump:
+        for frame in frames:
+            replay_jumps(sites, atom_rows, step, frame)
+            step = frame
+            dump.write(format_header(frame, num_of_atoms, dims).encode())
+            dump.write(format_atom_lines(lines, sites))
+
+def replay_jumps(sites, atom_rows, start, stop):
+
+    # swap sites of vacancy and jump atom, the log line of the start step is already applied
+    for vacancy_row, jump_row in zip(atom_rows[0, start + 1: stop + 1].tolist(), atom_rows[1, start + 1: stop + 1].tolist()):
+        sites[vacancy_row], sites[jump_row] = sites[jump_row], sites[vacancy_row]
+
+def create_config_arrays(maps):
+
+    # columns are ordered by atom id, indexes are widened for arithmetic
+    return np.asarray(maps.atom_ids), np.asarray(maps.atom_types), np.column_stack(maps.site_index).astype(np.int64).reshape(-1, 3)
+
+def create_atom_lines(atom_ids, atom_types, site_index, scale):
+
+    # "id type " of each atom and "x y z\n" of each site as byte tokens in one pool
+    prefix = ["{:.0f} {:.0f} ".format(atom_id, atom_type).encode() for atom_id, atom_type in zip(atom_ids, atom_types)]
+    coords = [["{:.2f}{}".format(i * scale, " " if axis < 2 else "\n").encode() for i in range(np.max(site_index[:, axis]) + 1)] \
+              for axis in range(3)]
+    coord_pool, coord_start, coord_len = pool_tokens(coords[0] + coords[1] + coords[2])
+    coord_tokens = site_index + np.cumsum([0, len(coords[0]), len(coords[1])])
+    suffix = [gather_tokens(coord_pool, coord_start[cur_tokens].reshape(-1), coord_len[cur_tokens].reshape(-1)) \
+              for cur_tokens in np.array_split(coord_tokens, max(len(coord_tokens) // 262144, 1))]
+    suffix_len = coord_len[coord_tokens].sum(axis=1)
+
+    prefix_pool, prefix_start, prefix_len = pool_tokens(prefix)
+    suffix_start = len(prefix_pool) + np.cumsum(suffix_len) - suffix_len
+
+    return np.concatenate([prefix_pool] + suffix), prefix_start, prefix_len, suffix_start, suffix_len
+
+def pool_tokens(tokens):
+
+    token_len = np.array([len(token) for token in tokens], dtype=np.int64)
+
+    return np.frombuffer(b"".join(tokens), dtype=np.uint8), np.cumsum(token_len) - token_len, token_len
+
+def gather_tokens(pool, token_start, token_len):
+
+    # byte index of every output byte, tokens are copied back to back
+    out_start = np.cumsum(token_len) - token_len
+    return pool[np.repeat(token_start - out_start, token_len) + np.arange(np.sum(token_len))]
+
+def format_header(frame, num_of_atoms, dims):
+
+    return "ITEM: TIMESTEP\n{:.0f}\nITEM: NUMBER OF ATOMS\n{:.0f}\nITEM: BOX BOUNDS pp pp pp\n".format(frame, num_of_atoms) + \
+           "".join("0 {:.2f}\n".format(dims[i]) for i in range(3)) + "ITEM: ATOMS id type x y z\n"
+
+def format_atom_lines(lines, sites, chunk_size=262144):
+
+    # interleave atom prefixes and suffixes of their current sites chunk by chunk
+    pool, prefix_start, prefix_len, suffix_start, suffix_len = lines
+    blocks = []
+    for start in range(0, len(sites), chunk_size):
+        cur_sites = sites[start: start + chunk_size]
+        token_start = np.column_stack([prefix_start[start: start + chunk_size], suffix_start[cur_sites]]).reshape(-1)
+        token_len = np.column_stack([prefix_len[start: start + chunk_size], suffix_len[cur_sites]]).reshape(-1)
+        blocks.append(gather_tokens(pool, token_start, token_len).tobytes())
+
+    return b"".join(blocks)
+
+
+class init_map:
+
+    def __init__(self, atom_ids, atom_types, site_index, box_lengths=None, voxel_size=None, mesh_dims=None):
+        '''
+        Attributes:
+        atom_ids: ids of atoms in ascending order, array backed by a memory map or in memory;
+        atom_types: initial types of atoms, array;
+        site_index: initial ix, iy, iz of atoms in neuron maps, tuple of three arrays;
+        box_lengths: simulation box lengths, None for maps converted from dict, array;
+        voxel_size: voxel size, None for maps converted from dict, float;
+        mesh_dims: shape of neuron maps, None for maps converted from dict, array;
+
+        Methods:
+        __getitem__: return type and 3d index of an atom id;
+        find_rows: return rows of atom ids in columns;
+        select: return init_map of a subset of atom ids with in-memory columns;
+        from_dict: return init_map of a dict mapping atom id to type and 3d index;
+        '''
+
+        # plain array views of memory maps skip the per-call overhead of the memmap subclass
+        self.atom_ids, self.atom_types = np.asarray(atom_ids), np.asarray(atom_types)
+        self.site_index = tuple(np.asarray(index) for index in site_index)
+        self.box_lengths, self.voxel_size, self.mesh_dims = box_lengths, voxel_size, mesh_dims
+
+    def __len__(self):
+
+        return len(self.atom_ids)
+
+    def __getitem__(self, atom_id):
+
+        row = int(np.searchsorted(self.atom_ids, atom_id))
+        assert row < len(self.atom_ids) and self.atom_ids[row] == atom_id
+
+        return self.atom_types[row], tuple(int(index[row]) for index in self.site_index)
 
-    vacancy_id = jump_ids[0]
-    num_of_atoms = len(effective_maps)
-    for i in range(len(jump_ids)):
-        if i == 0:
-            dump_config(effective_maps, dump, i, num_of_atoms, dims, scale)
-        else:
-            jump_id = jump_ids[i]
-            effective_maps[vacancy_id][1], effective_maps[jump_id][1] = effective_maps[jump_id][1], effective_maps[vacancy_id][1]
+    def find_rows(self, atom_ids):
 
-            if i % interval == 0:
-                dump_config(effective_maps, dump, i, num_of_atoms, dims, scale)
+        rows = np.searchsorted(self.atom_ids, atom_ids)
+        assert np.all(np.asarray(self.atom_ids[np.minimum(rows, len(self.atom_ids) - 1)]) == atom_ids)
 
+        return rows
+
+    def select(self, atom_ids):
+
+        rows = self.find_rows(np.sort(atom_ids))
+        return init_map(self.atom_ids[rows], self.atom_types[rows], [index[rows] for index in self.site_index], \
+                        self.box_lengths, self.voxel_size, self.mesh_dims)
+
+    @staticmethod
+    def from_dict(maps):
+
+        atom_ids = np.sort(np.array([*maps.keys()]))
+        site_index = np.array([maps[atom_id][1] for atom_id in atom_ids]).reshape(-1, 3)
+        return init_map(atom_ids, np.array([maps[atom_id][0] for atom_id in atom_ids]), site_index.T)
+
+
+class trajectory:
+
+    def __init__(self, res_dir):
+        '''
+        Attributes:
+        res_dir: directory holding trajectory.npz/bin/idx written by the simulation, string;
+        box_lengths: simulation box lengths, array;
+        voxel_size: voxel size, float;
+        mesh_dims: shape of neuron maps, array;
+        atom_ids: ids of all atoms, array;
+        atom_types: types of all atoms, array;
+        segments: structured array of keyframe step, keyframe offset/size, jump offset and number of jumps of each segment;
+        data: memory-mapped keyframes and jump blocks;
+
+        Methods:
+        get_frame: return atom ids, types and 3d indexes at a step;
+        iter_frames: yield step, atom ids, types and 3d indexes over a step range;
+        dump_frames: write frames over a step range as lammps dump;
+        load_keyframe: return flat index of every atom id at the keyframe of a segment;
+        load_jumps: return vacancy and jump atom ids of a segment;
+        replay_jumps: swap flat indexes of vacancies and jump atoms;
+        '''
+
+        self.res_dir = res_dir
+        with np.load(os.path.join(res_dir, "trajectory.npz")) as header:
+            self.box_lengths, self.voxel_size, self.mesh_dims = header["box_lengths"], float(header["voxel_size"]), header["mesh_dims"]
+            atom_types = header["atom_types"]
+        self.atom_ids = np.flatnonzero(atom_types >= 0)
+        self.atom_types = atom_types[self.atom_ids]
+
+        segment_dtype = np.dtype([("step", np.int64), ("keyframe_offset", np.int64), ("keyframe_size", np.int64), \
+                                  ("jump_offset", np.int64), ("num_of_jumps", np.int64)])
+        self.segments = np.fromfile(os.path.join(res_dir, "trajectory.idx"), dtype=segment_dtype)
+        self.data = np.memmap(os.path.join(res_dir, "trajectory.bin"), dtype=np.uint8, mode="r")
+
+    def get_frame(self, step):
+
+        # nearest keyframe at or before the step
+        segment = np.searchsorted(self.segments["step"], step, side="right") - 1
+        assert segment >= 0 and step <= self.segments["step"][segment] + self.segments["num_of_jumps"][segment]
+
+        flat_index = self.load_keyframe(segment)
+        self.replay_jumps(flat_index, self.load_jumps(segment)[: step - self.segments["step"][segment]])
+
+        return self.atom_ids, self.atom_types, np.column_stack(np.unravel_index(flat_index[self.atom_ids], self.mesh_dims))
+
+    def iter_frames(self, start, stop, interval=1):
+
+        # seek once, then replay forward across segments
+        segment = np.searchsorted(self.segments["step"], start, side="right") - 1
+        assert segment >= 0
+        flat_index, step = self.load_keyframe(segment), self.segments["step"][segment]
+        for cur_step in range(start, stop, interval):
+            while cur_step > step:
+                if step == self.segments["step"][segment] + self.segments["num_of_jumps"][segment]:
+                    segment += 1
+                    assert segment < len(self.segments)
+                jumps = self.load_jumps(segment)[step - self.segments["step"][segment]: cur_step - self.segments["step"][segment]]
+                self.replay_jumps(flat_index, jumps)
+                step += len(jumps)
+
+            yield cur_step, self.atom_ids, self.atom_types, np.column_stack(np.unravel_index(flat_index[self.atom_ids], self.mesh_dims))
+
+    def dump_frames(self, start, stop, interval, filepath):
+
+        # occupied sites never change, each frame is a permutation of them
+        lines, site_flat = None, None
+        with open(filepath, "wb") as dump:
+            for step, atom_ids, atom_types, site_index in self.iter_frames(start, stop, interval):
+                cur_flat = np.ravel_multi_index(site_index.T, self.mesh_dims)
+                if lines is None:
+                    site_flat = np.sort(cur_flat)
+                    lines = create_atom_lines(atom_ids, atom_types, np.column_stack(np.unravel_index(site_flat, self.mesh_dims)), self.voxel_size)
+                dump.write(format_header(step, len(atom_ids), self.box_lengths).encode())
+                dump.write(format_atom_lines(lines, np.searchsorted(site_flat, cur_flat)))
+
+    def load_keyframe(self, segment):
+
+        start, size = self.segments["keyframe_offset"][segment], self.segments["keyframe_size"][segment]
+        return np.frombuffer(zlib.decompress(self.data[start: start + size]), dtype=np.int64).copy()
+
+    def load_jumps(self, segment):
+
+        start, num_of_jumps = self.segments["jump_offset"][segment], self.segments["num_of_jumps"][segment]
+        return self.data[start: start + 8 * num_of_jumps].view(np.uint32).reshape(-1, 2)
+
+    def replay_jumps(self, flat_index, jumps):
+
+        for vacancy_id, jump_id in jumps.tolist():
+            flat_index[vacancy_id], flat_index[jump_id] = flat_index[jump_id], flat_index[vacancy_id]
+
+
+def split_nnk_log(nnk_log):
+
+    # multi-vacancy log has columns vacancy id, jump id, time; single vacancy log starts with the vacancy id
+    if nnk_log.shape[1] == 3:
+        return nnk_log[:, 0].astype(np.int32), nnk_log[:, 1].astype(np.int32)
+
+    jump_ids = nnk_log[:, 0].astype(np.int32)
+    return np.full_like(jump_ids, jump_ids[0]), jump_ids
 
 def load_map(map_file):
-    return np.load(map_file, allow_pickle=True).item()
+
+    # pickled dicts of earlier versions are converted in memory
+    with open(map_file, "rb") as f:
+        if f.read(len(nnk.log_module.map_magic)) != nnk.log_module.map_magic:
+            return init_map.from_dict(np.load(map_file, allow_pickle=True).item())
+        f.seek(0)
+        header, offset = nnk.log_module.read_header(f, nnk.log_module.map_magic)
+
+    # read-only memory maps share one page-cached copy between processes
+    columns = {name: np.memmap(map_file, dtype=np.dtype(dtype), mode="r", offset=offset + column_offset, shape=(header["num_of_atoms"],)) \
+               for name, dtype, column_offset in header["columns"]}
+
+    return init_map(columns["id"], columns["type"], [columns["ix"], columns["iy"], columns["iz"]], \
+                    np.array(header["box_lengths"]), header["voxel_size"], np.array(header["mesh_dims"]))
 
 def load_nnk_log(nnk_log_file):
+
+    # binary jump logs are converted to the columns of the text log
+    if is_binary_log(nnk_log_file):
+        return binary_log_to_array(*load_binary_log(nnk_log_file))
+
     return np.loadtxt(nnk_log_file, delimiter=" ")
 
+def is_binary_log(nnk_log_file):
+
+    with open(nnk_log_file, "rb") as f:
+        return f.read(len(nnk.log_module.magic)) == nnk.log_module.magic
+
+def load_binary_log(nnk_log_file):
+
+    with open(nnk_log_file, "rb") as f:
+        header, offset = nnk.log_module.read_header(f)
+
+    # a record cut by an interrupted write is ignored
+    num_of_records = (os.path.getsize(nnk_log_file) - offset) // header["dtype"].itemsize
+    if num_of_records == 0:
+        return np.zeros(0, dtype=header["dtype"]), header["multi_vacancy"]
+    records = np.memmap(nnk_log_file, dtype=header["dtype"], mode="r", offset=offset, shape=(num_of_records,))
+
+    return records, header["multi_vacancy"]
+
+def binary_log_to_array(records, multi_vacancy):
+
+    if multi_vacancy == True:
+        return np.column_stack([records["vacancy_id"], records["jump_id"], records["jump_time"]]).astype(np.float64)
+
+    return np.column_stack([records["jump_id"], records["jump_time"]]).astype(np.float64)
+
+def export_text_log(nnk_log_file, text_log_file, chunk_size=1000000):
+
+    # format chunks of records in bulk
+    records, multi_vacancy = load_binary_log(nnk_log_file)
+    fmt = "%.0f %.0f %.2e" if multi_vacancy == True else "%.0f %.2e"
+    with open(text_log_file, "w") as f:
+        for start in range(0, len(records), chunk_size):
+            np.savetxt(f, binary_log_to_array(records[start: start + chunk_size], multi_vacancy), fmt=fmt)
+
 def dump_config(maps, print_f, frame, num_of_atoms, dims, scale):
 
-    # print prefix info
-    print("ITEM: TIMESTEP", file=print_f)
-    print("{:.0f}".format(frame), file=print_f)
-    print("ITEM: NUMBER OF ATOMS", file=print_f)
-    print("{:.0f}".format(num_of_atoms), file=print_f)
-    print("ITEM: BOX BOUNDS pp pp pp", file=print_f)
-    for i in range(3):
-        print("0 {:.2f}".format(dims[i]), file=print_f)
-    print("ITEM: ATOMS id type x y z", file=print_f) 
-
-    # print atomic info
-    for map_id in np.sort([*maps.keys()]):
-        map_val = maps[map_id]
-        atom_id, atom_type, index = map_id, map_val[0], map_val[1]
-        x, y, z = index[0] * scale, index[1] * scale, index[2] * scale
-        print("{:.0f} {:.0f} {:.2f} {:.2f} {:.2f}".format(atom_id, atom_type, x, y, z), file=print_f)
+    atom_ids, atom_types, site_index = create_config_arrays(maps)
+    lines = create_atom_lines(atom_ids, atom_types, site_index, scale)
+    print(format_header(frame, num_of_atoms, dims), end="", file=print_f)
+    print(format_atom_lines(lines, np.arange(len(atom_ids))).decode(), end="", file=print_f)
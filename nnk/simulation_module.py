@@ -0,0 +1,484 @@
+# simulation built once from user input params, reset and run repeatedly in the same process
+
+import os
+import time
+import random
+import numpy as np
+
+import nnk.params
+import nnk.neuron_map
+import nnk.kmc_module
+import nnk.ensemble_module
+import nnk.parallel_module
+import nnk.ml_predict
+import nnk.log_module
+import nnk.analysis_module
+import nnk.timing_module
+import nnk.utils
+
+class Simulation:
+
+    # params fixing lattice, mesh and model, which cannot change between runs
+    static_keys = {"init_config_dump", "ml_model_weight", "model_dtype", "cutoff", "voxel_size", "flatten", "local_map_mode", \
+                   "lattice_layout", "incremental_first_layer", "first_layer_refresh_interval", "barrier_cache_size", \
+                   "num_of_cpus", "dump_cache", "restart", "checkpoint_file"}
+
+    def __init__(self, inp=None):
+        '''
+        Attributes:
+        params: instance of params class;
+        neuron_map: instance of neuron_map class;
+        compiled_model: instance of CompiledModel class;
+        max_error: max absolute error of compiled_model on the initial local neuron maps, float;
+        predict_fn: function predicting energy barriers of a batch of images;
+        cache: instance of barrier_cache class kept warm across runs, None if disabled;
+        init_maps: copies of id/type neuron maps and atom flat index of the initial lattice, None on restart;
+        init_vacancy_ids: vacancies of the initial lattice, list;
+        reset_time: wall time of the last reset, float;
+        num_of_runs: number of finished runs, int;
+        timer: instance of stage_timer class of the current run;
+        kinetics: kinetics module of the current run;
+        checkpoint_modules: modules of the current run holding state stored in checkpoints, list;
+        incremental_model, lookahead, jump_log, trajectory, sro: optional modules of the current run, None if disabled;
+
+        Methods:
+        reset: restore the initial lattice, move vacancies, update run params and res_dir, and reseed random modules and block sampler;
+        run: run one simulation into res_dir from the current lattice and return its summary;
+        create_modules: open outputs and create kinetics, prediction and analysis modules of a run;
+        run_ensemble: run lock-step ensemble of replicas;
+        run_parallel: run synchronous sublattice multi-vacancy kinetics;
+        run_multi_vacancy: run multi-vacancy kinetics with rate catalog;
+        run_single_vacancy: run single-vacancy kinetics;
+        close_modules: write summaries and close outputs of a run;
+        save_checkpoint: write lattice state, progress, random states and module states;
+        restore_checkpoint: restore random states and module states, return kmc time;
+        '''
+
+        # lattice, mesh and compiled model, built once
+        self.params = nnk.params.params(inp)
+        timer = self.params.timer
+        self.neuron_map = nnk.neuron_map.neuron_map(self.params)
+
+        # compile deep neural network and validate it on the initial local neuron maps
+        start = timer.tic()
+        self.compiled_model = nnk.ml_predict.CompiledModel(self.params.model_weight, dtype=self.params.model_dtype)
+        self.neuron_map.create_local_neuron_map()
+        self.max_error = self.compiled_model.validate(self.params.model_weight, self.neuron_map.aggregate_local_neuron_map())
+        timer.toc("compile_model", start, init=True)
+
+        # energy barriers do not depend on temperature, cached barriers stay valid across runs
+        self.predict_fn = self.compiled_model.predict
+        self.cache = None
+        if self.params.barrier_cache_size > 0:
+            self.cache = nnk.ml_predict.barrier_cache(self.predict_fn, self.params.barrier_cache_size)
+            self.predict_fn = self.cache.predict
+
+        # copies of the initial lattice for warm reset
+        self.init_maps = None
+        if self.params.restart == False:
+            self.init_maps = (self.neuron_map.id_neuron_map.copy(), self.neuron_map.type_neuron_map.copy(), \
+                              self.neuron_map.id_to_type_index.flat_index.copy())
+        self.init_vacancy_ids = [self.params.vacancy_id] + list(self.params.vacancy_ids)
+
+        self.reset_time = 0.0
+        self.num_of_runs = 0
+        self.timer = timer
+
+    def reset(self, vacancy_id=None, vacancy_ids=None, seed=None, **updates):
+
+        # a lattice restored from checkpoint has no initial copy
+        assert self.init_maps is not None
+        start = time.perf_counter()
+
+        # lattice, mesh and model are fixed, vacancies are moved by arguments
+        for key, val in updates.items():
+            assert key not in self.static_keys and key not in ("vacancy_id", "vacancy_ids", "random_vacancy")
+            assert hasattr(self.params, key)
+            self.params.add_param(key=key, val=self.params.convert_param(key, val))
+
+        # restore the initial lattice
+        init_id_map, init_type_map, init_flat_index = self.init_maps
+        self.neuron_map.id_neuron_map, self.neuron_map.type_neuron_map = init_id_map.copy(), init_type_map.copy()
+        self.neuron_map.id_to_type_index.flat_index = init_flat_index.copy()
+
+        # move vacancies, the first vacancy acts as the reference vacancy in multi-vacancy simulation
+        if vacancy_ids is not None:
+            self.params.vacancy_ids = list(vacancy_ids)
+            self.params.multi_vacancy = len(self.params.vacancy_ids) > 0
+            if self.params.multi_vacancy == True:
+                vacancy_id = self.params.vacancy_ids[0]
+        if vacancy_id is not None:
+            self.params.vacancy_id = vacancy_id
+        new_vacancy_ids = {self.params.vacancy_id} | set(self.params.vacancy_ids)
+
+        # restore types of initial vacancies, then remove atoms of new vacancies
+        self.params.config = self.params.init_config.copy()
+        for cur_id in sorted(set(self.init_vacancy_ids) - new_vacancy_ids) + sorted(new_vacancy_ids):
+            cur_type = np.int32(self.params.init_config[cur_id-1, 1] if cur_id not in new_vacancy_ids else 0)
+            cur_index = self.neuron_map.id_to_type_index[cur_id][1]
+            self.neuron_map.type_neuron_map[cur_index] = cur_type
+            self.params.config[cur_id-1, 1] = cur_type
+
+        # seed global random modules and the block sampler of the next run
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+            self.params.rng_seed = seed
+
+        self.reset_time = time.perf_counter() - start
+
+    def run(self, hooks=()):
+
+        # stage timer of this run, one-time initialization is reported by the first run only
+        timer = nnk.timing_module.stage_timer(self.params.timing, self.params.timing_interval)
+        if self.num_of_runs == 0:
+            timer.init_times.update(self.params.timer.init_times)
+        elif timer.enabled == True:
+            timer.init_times["reset"] = self.reset_time
+        for hook in hooks:
+            timer.register_hook(hook)
+        self.timer = timer
+
+        self.create_modules()
+
+        kmc_time = 0.0
+        if self.params.num_of_replicas > 0:
+            self.run_ensemble()
+        elif self.params.parallel_kmc == True:
+            self.run_parallel()
+        elif self.params.multi_vacancy == True:
+            kmc_time = self.run_multi_vacancy()
+        else:
+            kmc_time = self.run_single_vacancy()
+
+        self.close_modules()
+
+        # later runs start from a fresh res_dir
+        self.params.restart = False
+        self.num_of_runs += 1
+
+        return {"res_dir": self.params.res_dir, "num_of_steps": self.params.num_of_steps, "kmc_time": float(kmc_time)}
+
+    def create_modules(self):
+
+        params, neuron_map, timer = self.params, self.neuron_map, self.timer
+        params.open_log()
+        if params.restart == False:
+            print("# compiled model: dtype {} max error {:.2e}".format(params.model_dtype, self.max_error), file=params.f)
+
+        # save id to type/index map
+        start = timer.tic()
+        if params.restart == False:
+            nnk.log_module.write_map(os.path.join(params.res_dir, "init_map.bin"), *neuron_map.id_to_type_index.to_columns(), \
+                                     params.box_lengths, params.voxel_size, neuron_map.mesh_info[1])
+        timer.toc("save_init_map", start, init=True)
+
+        # initialize kinetics module, cached rates of superbasin kinetics depend on temperature
+        start = timer.tic()
+        if params.superbasin == True:
+            self.kinetics = nnk.kmc_module.superbasin_kmc(params, neuron_map)
+        else:
+            self.kinetics = nnk.kmc_module.kmc(params, neuron_map)
+        self.checkpoint_modules = []
+        if self.cache is not None:
+            self.checkpoint_modules.append(self.cache)
+
+        # initialize incremental first layer predictor
+        self.incremental_model = None
+        if params.incremental_first_layer == True:
+            self.incremental_model = nnk.ml_predict.IncrementalModel(self.compiled_model, neuron_map.gather_table, \
+                                                                     params.first_layer_refresh_interval)
+            self.checkpoint_modules.append(self.incremental_model)
+
+        # initialize lookahead predictor of candidate next states
+        self.lookahead = None
+        if params.lookahead == True:
+            self.lookahead = nnk.ml_predict.lookahead_model(neuron_map, self.predict_fn)
+            self.lookahead.measure_single_state_time(self.compiled_model.predict)
+            self.checkpoint_modules.append(self.lookahead)
+
+        # initialize binary jump log
+        self.jump_log = None
+        if params.log_format == "binary":
+            restart_size = int(params.checkpoint["binary_log_size"]) if params.restart == True else None
+            self.jump_log = nnk.log_module.binary_log(os.path.join(params.res_dir, os.path.splitext(params.log_file)[0] + ".bin"), \
+                                                      params.multi_vacancy, params.log_details, restart_size=restart_size)
+            self.checkpoint_modules.append(self.jump_log)
+
+        # initialize keyframed binary trajectory
+        self.trajectory = None
+        if params.trajectory_interval > 0:
+            restart_state = params.checkpoint if params.restart == True else None
+            self.trajectory = nnk.log_module.trajectory_writer(params.res_dir, neuron_map, params.trajectory_interval, \
+                                                               params.init_step - 1, restart_state=restart_state)
+            self.checkpoint_modules.append(self.trajectory)
+
+        # initialize short-range order tracker
+        self.sro = None
+        if params.sro_interval > 0:
+            site_index, site_types = nnk.analysis_module.neuron_map_sites(neuron_map)
+            self.sro = nnk.analysis_module.sro_tracker(site_index, site_types, neuron_map.mesh_info[1], params.sro_shells)
+            restart_size = int(params.checkpoint["sro_size"]) if params.restart == True else None
+            self.sro.print_f = nnk.utils.open_output(os.path.join(params.res_dir, "sro.dat"), restart_size)
+            if params.restart == False:
+                print(self.sro.format_header(), file=self.sro.print_f)
+                print(self.sro.format_sample(params.init_step - 1, 0.0, self.sro.sample()), file=self.sro.print_f)
+            self.checkpoint_modules.append(self.sro)
+        timer.toc("init_modules", start, init=True)
+
+    def run_ensemble(self):
+
+        params, timer = self.params, self.timer
+
+        # initialize lock-step ensemble of replicas
+        kmc_ensemble = nnk.ensemble_module.ensemble(params, self.neuron_map, self.predict_fn)
+
+        # simulate diffusion of all replicas
+        for step in range(params.init_step, params.num_of_steps + params.init_step):
+            timer.start_step(step)
+            start = timer.tic()
+            kmc_ensemble.step()
+            timer.toc("step", start)
+
+        kmc_ensemble.close()
+
+    def run_parallel(self):
+
+        params, timer = self.params, self.timer
+
+        # initialize synchronous sublattice kinetics module on shared neuron maps, released even if the run fails
+        with nnk.parallel_module.parallel_kmc(params, self.neuron_map, self.kinetics) as parallel_kinetics:
+
+            # dump vacancies
+            if params.dump_vacancy_id == True:
+                for vacancy_id in params.vacancy_ids:
+                    if self.jump_log is None:
+                        nnk.utils.dump_vacancy_jump(vacancy_id, vacancy_id, 0, params.f)
+                    else:
+                        self.jump_log.append(vacancy_id, vacancy_id, 0)
+
+            # simulate multi-vacancy diffusion in parallel
+            start = timer.tic()
+            parallel_kinetics.run(params.num_of_steps, params.f, self.jump_log)
+            timer.toc("parallel_run", start)
+
+    def run_multi_vacancy(self):
+
+        params, neuron_map, timer = self.params, self.neuron_map, self.timer
+        jump_log, trajectory, sro = self.jump_log, self.trajectory, self.sro
+
+        # initialize multi-vacancy kinetics module with rate catalog
+        self.kinetics = kmc_kinetics = nnk.kmc_module.multi_vacancy_kmc(params, neuron_map, self.predict_fn)
+        self.checkpoint_modules.append(kmc_kinetics)
+
+        # dump vacancies, or restore kinetics from checkpoint
+        kmc_time = 0.0
+        if params.restart == True:
+            kmc_time = self.restore_checkpoint()
+        elif params.dump_vacancy_id == True:
+            for vacancy_id in params.vacancy_ids:
+                if jump_log is None:
+                    nnk.utils.dump_vacancy_jump(vacancy_id, vacancy_id, 0, params.f)
+                else:
+                    jump_log.append(vacancy_id, vacancy_id, 0)
+
+        # simulate multi-vacancy diffusion
+        for step in range(params.init_step, params.num_of_steps + params.init_step):
+            timer.start_step(step)
+            step_start = timer.tic()
+
+            # sample event and re-predict affected vacancies
+            start = timer.tic()
+            vacancy_id, jump_id, jump_time = kmc_kinetics.execute_kmc()
+            timer.toc("execute_kmc", start)
+
+            # dump vacancy id/jump id/time
+            start = timer.tic()
+            if jump_log is None:
+                nnk.utils.dump_vacancy_jump(vacancy_id, jump_id, jump_time, params.f)
+            else:
+                jump_log.append(vacancy_id, jump_id, jump_time, kmc_kinetics.path_index, kmc_kinetics.energy_barrier)
+            if trajectory is not None:
+                trajectory.append(vacancy_id, jump_id, step)
+            timer.toc("dump_id", start)
+            kmc_time += jump_time
+
+            # update short-range order, the atom moved to its current index from the current vacancy index
+            if sro is not None:
+                start = timer.tic()
+                sro.update(neuron_map.id_to_type_index[vacancy_id][1], neuron_map.id_to_type_index[jump_id][1])
+                if step % params.sro_interval == 0:
+                    print(sro.format_sample(step, kmc_time, sro.sample()), file=sro.print_f)
+                timer.toc("sro", start)
+
+            # save checkpoint
+            if params.checkpoint_interval > 0 and step % params.checkpoint_interval == 0:
+                start = timer.tic()
+                self.save_checkpoint(step, kmc_time)
+                timer.toc("checkpoint", start)
+
+            timer.toc("step", step_start)
+            timer.run_hooks(step, vacancy_id, jump_id, jump_time)
+
+        return kmc_time
+
+    def run_single_vacancy(self):
+
+        params, neuron_map, timer = self.params, self.neuron_map, self.timer
+        kmc_kinetics, jump_log, trajectory, sro = self.kinetics, self.jump_log, self.trajectory, self.sro
+
+        # dump vacancy, or restore kinetics from checkpoint
+        self.checkpoint_modules.append(kmc_kinetics)
+        kmc_time = 0.0
+        if params.restart == True:
+            kmc_time = self.restore_checkpoint()
+        elif params.dump_vacancy_id == True:
+            if jump_log is None:
+                nnk.utils.dump_id(params.vacancy_id, 0, params.f)
+            else:
+                jump_log.append(params.vacancy_id, params.vacancy_id, 0)
+
+        # simulate diffusion
+        for step in range(params.init_step, params.num_of_steps + params.init_step):
+            timer.start_step(step)
+            step_start = timer.tic()
+
+            if params.superbasin == True and kmc_kinetics.lookup_state() == True:
+                # rates of revisited states are cached
+                kmc_inp = None
+            elif params.lookahead == True:
+                # current state was predicted as a candidate of the previous step, or with its candidates
+                start = timer.tic()
+                neigh_ids, energy_barriers = self.lookahead.predict()
+                timer.toc("predict", start)
+                kmc_inp = [neigh_ids, energy_barriers]
+            elif params.incremental_first_layer == True:
+                # gather types of mask sites
+                start = timer.tic()
+                neigh_ids, site_vect = neuron_map.gather_local_sites()
+                timer.toc("gather_local_sites", start)
+
+                # neural network prediction from incremental first layer
+                start = timer.tic()
+                energy_barriers = self.incremental_model.predict_sites(site_vect)
+                timer.toc("predict", start)
+                kmc_inp = [neigh_ids, energy_barriers]
+            else:
+                if params.local_map_mode == "gather":
+                    # gather aggregated local neuron maps
+                    start = timer.tic()
+                    neigh_ids, neuron_map_vects = neuron_map.gather_local_neuron_map()
+                    timer.toc("gather_local_neuron_map", start)
+                else:
+                    # update local neuron map
+                    start = timer.tic()
+                    local_id_neuron_map, local_type_neuron_map, neigh_ids = neuron_map.create_local_neuron_map()
+                    timer.toc("create_local_neuron_map", start)
+
+                    # aggragate local neuron maps
+                    start = timer.tic()
+                    neuron_map_vects = neuron_map.aggregate_local_neuron_map()
+                    timer.toc("aggregate_local_neuron_map", start)
+
+                # neural network prediction
+                start = timer.tic()
+                energy_barriers = self.predict_fn(neuron_map_vects)
+                timer.toc("predict", start)
+                kmc_inp = [neigh_ids, energy_barriers]
+
+            # neuron kinetics
+            start = timer.tic()
+            jump_id, jump_time = kmc_kinetics.execute_kmc(kmc_inp)
+            if self.lookahead is not None:
+                self.lookahead.advance(kmc_kinetics.path_index)
+            timer.toc("execute_kmc", start)
+
+            # dump zero-time transit of the vacancy to the exit state of a transient basin
+            start = timer.tic()
+            if params.superbasin == True:
+                for transit_id, path_index, energy_barrier, from_index, to_index in kmc_kinetics.transit_jumps:
+                    if jump_log is None:
+                        nnk.utils.dump_id(transit_id, 0, params.f)
+                    else:
+                        jump_log.append(params.vacancy_id, transit_id, 0, path_index, energy_barrier)
+                    if sro is not None:
+                        sro.update(from_index, to_index)
+
+            # dump jump id/time
+            if jump_log is None:
+                nnk.utils.dump_id(jump_id, jump_time, params.f)
+            else:
+                jump_log.append(params.vacancy_id, jump_id, jump_time, kmc_kinetics.path_index, kmc_kinetics.energy_barrier)
+            if trajectory is not None:
+                trajectory.append(params.vacancy_id, jump_id, step)
+            timer.toc("dump_id", start)
+            kmc_time += jump_time
+
+            # update short-range order, the atom moved to its current index from the current vacancy index
+            if sro is not None:
+                start = timer.tic()
+                sro.update(neuron_map.id_to_type_index[params.vacancy_id][1], neuron_map.id_to_type_index[jump_id][1])
+                if step % params.sro_interval == 0:
+                    print(sro.format_sample(step, kmc_time, sro.sample()), file=sro.print_f)
+                timer.toc("sro", start)
+
+            # save checkpoint
+            if params.checkpoint_interval > 0 and step % params.checkpoint_interval == 0:
+                start = timer.tic()
+                self.save_checkpoint(step, kmc_time)
+                timer.toc("checkpoint", start)
+
+            timer.toc("step", step_start)
+            timer.run_hooks(step, params.vacancy_id, jump_id, jump_time)
+
+        return kmc_time
+
+    def close_modules(self):
+
+        params = self.params
+
+        # dump barrier cache counters as a comment line
+        if self.cache is not None:
+            print("# " + self.cache.summary(), file=params.f)
+        if params.superbasin == True:
+            print("# " + self.kinetics.summary(), file=params.f)
+        if self.lookahead is not None:
+            print("# " + self.lookahead.summary(), file=params.f)
+
+        if self.jump_log is not None:
+            self.jump_log.close()
+        if self.trajectory is not None:
+            self.trajectory.close()
+        if self.sro is not None:
+            self.sro.print_f.close()
+        params.f.close()
+
+        # stage timing summary
+        if self.timer.enabled == True:
+            self.timer.dump(params.res_dir)
+            print(self.timer.summary())
+
+    def save_checkpoint(self, step, kmc_time):
+
+        # lattice state, progress, log size and random states
+        params, neuron_map = self.params, self.neuron_map
+        params.f.flush()
+        state = {"id_neuron_map": neuron_map.id_neuron_map.reshape(-1), "type_neuron_map": neuron_map.type_neuron_map.reshape(-1), \
+                 "lattice_layout": params.lattice_layout, "dims": params.dims, "num_of_atoms": params.num_of_atoms, \
+                 "vacancy_id": params.vacancy_id, "vacancy_ids": np.array(params.vacancy_ids, dtype=np.int64), \
+                 "step": step, "kmc_time": kmc_time, "log_size": os.fstat(params.f.fileno()).st_size}
+        state.update(nnk.utils.get_random_state())
+
+        # states of kinetics and prediction modules
+        for module in self.checkpoint_modules:
+            state.update(module.get_state())
+
+        nnk.utils.save_checkpoint(os.path.join(params.res_dir, params.checkpoint_file), state)
+
+    def restore_checkpoint(self):
+
+        nnk.utils.set_random_state(self.params.checkpoint)
+        for module in self.checkpoint_modules:
+            module.set_state(self.params.checkpoint)
+
+        return float(self.params.checkpoint["kmc_time"])
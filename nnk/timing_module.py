@@ -0,0 +1,102 @@
+# per-stage timing of initialization and simulation steps
+
+import os
+import json
+import time
+
+class stage_timer:
+
+    def __init__(self, enabled=False, sample_interval=1):
+        '''
+        Attributes:
+        enabled: accumulate stage times, int(boolean);
+        sample_interval: time every sample_interval-th step only, int;
+        active: stages of the current step are timed, boolean;
+        init_times: dict mapping initialization stage to seconds;
+        step_times: dict mapping step stage to accumulated seconds over sampled steps;
+        step_calls: dict mapping step stage to number of timed calls;
+        num_of_steps: number of steps, int;
+        num_of_sampled_steps: number of timed steps, int;
+        hooks: list of functions called after every step with step, vacancy id, jump id and jump time;
+        start_time: creation time on the monotonic clock, float;
+
+        Methods:
+        tic: return monotonic clock reading if the current stage is timed, otherwise None;
+        toc: add time since tic to an initialization or step stage;
+        start_step: start a step and decide whether it is sampled;
+        register_hook: add a per-step callback;
+        run_hooks: call per-step callbacks;
+        summary: return a table of initialization and step stages;
+        dump: write the summary table and json to res_dir;
+        '''
+
+        self.enabled = enabled
+        self.sample_interval = max(sample_interval, 1)
+        self.active = enabled
+        self.init_times, self.step_times, self.step_calls = {}, {}, {}
+        self.num_of_steps, self.num_of_sampled_steps = 0, 0
+        self.hooks = []
+        self.start_time = time.perf_counter()
+
+    def tic(self):
+
+        return time.perf_counter() if self.active else None
+
+    def toc(self, stage, start, init=False):
+
+        if start is None:
+            return
+
+        elapsed = time.perf_counter() - start
+        if init == True:
+            self.init_times[stage] = self.init_times.get(stage, 0.0) + elapsed
+        else:
+            self.step_times[stage] = self.step_times.get(stage, 0.0) + elapsed
+            self.step_calls[stage] = self.step_calls.get(stage, 0) + 1
+
+    def start_step(self, step):
+
+        self.num_of_steps += 1
+        self.active = self.enabled and step % self.sample_interval == 0
+        if self.active:
+            self.num_of_sampled_steps += 1
+
+    def register_hook(self, hook):
+
+        self.hooks.append(hook)
+
+    def run_hooks(self, step, vacancy_id, jump_id, jump_time):
+
+        for hook in self.hooks:
+            hook(step, vacancy_id, jump_id, jump_time)
+
+    def summary(self):
+
+        lines = ["# initialization stage, time (s)"]
+        for stage, seconds in self.init_times.items():
+            lines.append("{:<32s} {:>12.4f}".format(stage, seconds))
+
+        # step stages relative to the total time of sampled steps
+        step_total = self.step_times.get("step", 0.0)
+        lines.append("# step stage, calls, total time (s), time per call (ms), fraction of step time")
+        for stage, seconds in self.step_times.items():
+            calls = self.step_calls[stage]
+            lines.append("{:<32s} {:>8d} {:>12.4f} {:>12.4f} {:>8.3f}".format(stage, calls, seconds, 1e3 * seconds / calls, \
+                                                                                 seconds / step_total if step_total > 0 else 0.0))
+        lines.append("# steps {:.0f} sampled {:.0f} sample interval {:.0f} wall time (s) {:.4f}".format( \
+                     self.num_of_steps, self.num_of_sampled_steps, self.sample_interval, time.perf_counter() - self.start_time))
+
+        return "\n".join(lines)
+
+    def dump(self, res_dir):
+
+        with open(os.path.join(res_dir, "timing.txt"), "w") as f:
+            print(self.summary(), file=f)
+
+        res = {"init": self.init_times, \
+               "steps": {stage: {"calls": self.step_calls[stage], "total": seconds, "mean": seconds / self.step_calls[stage]} \
+                         for stage, seconds in self.step_times.items()}, \
+               "num_of_steps": self.num_of_steps, "num_of_sampled_steps": self.num_of_sampled_steps, \
+               "sample_interval": self.sample_interval, "wall_time": time.perf_counter() - self.start_time}
+        with open(os.path.join(res_dir, "timing.json"), "w") as f:
+            json.dump(res, f, indent=2)
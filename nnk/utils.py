@@ -1,19 +1,41 @@
 # utils functions
+import os
+import json
+import random
+import itertools
 import numpy as np
 from scipy import spatial
 
 '''
 create_mesh: create a mesh for building up neural map;
-assign_atom_to_mesh: assign each atom to the corresponding mesh point based on the distance;
+create_mesh_coords: create coordinates of all mesh points;
+assign_atom_to_mesh: assign each atom to the corresponding mesh point, returns uint32 id and int8 type arrays;
+compute_mesh_index: compute flat mesh index of each atom;
+compute_voxel_index: compute flat mesh index of on-lattice atoms arithmetically, None for off-lattice atoms;
 rotate_mirror_data: rotate/mirror local neuron map to align the current diffusion direction with the reference direction;
 compute_neigh_index: compute the index of first nearest neighbors;
+read_dump: read box bounds and id/type/x/y/z columns of a lammps dump file chunk by chunk;
+load_dump: load a lammps dump file through a binary cache keyed by file size and modification time;
 dump_id: write jump atom id and diffusion time to log file;
+dump_vacancy_jump: write vacancy id, jump atom id and diffusion time to log file in multi-vacancy simulation;
+get_random_state: return states of python and numpy global random generators as arrays;
+set_random_state: restore states of python and numpy global random generators;
+save_checkpoint: write checkpoint arrays to a binary file atomically;
+load_checkpoint: load checkpoint arrays into memory;
+open_output: open an output file, or truncate it to its checkpointed size and append on restart;
 '''
 
-def create_mesh(box_lengths, voxel_size):
+def create_mesh(box_lengths, voxel_size, materialize=True):
 
     num_of_voxels = (box_lengths / voxel_size).round(0).astype(np.int32)
     mesh_size = num_of_voxels * voxel_size
+
+    # voxel coordinates are only needed by the kd-tree assignment of off-lattice atoms
+    mesh = create_mesh_coords(num_of_voxels, voxel_size) if materialize == True else None
+
+    return mesh, tuple(num_of_voxels), mesh_size
+
+def create_mesh_coords(num_of_voxels, voxel_size):
     
     x = np.arange(num_of_voxels[0]) * voxel_size
     y = np.arange(num_of_voxels[1]) * voxel_size
@@ -22,31 +44,59 @@ def create_mesh(box_lengths, voxel_size):
     mesh_x, mesh_y, mesh_z = mesh_x.reshape(-1, 1), mesh_y.reshape(-1, 1), mesh_z.reshape(-1, 1)
     mesh = np.c_[mesh_x, mesh_y, mesh_z].round(2)
 
-    return mesh, tuple(num_of_voxels), mesh_size
+    return mesh
 
 def assign_atom_to_mesh(atoms, mesh_args, number_of_cpus=1):
     
     # load mesh information
     mesh, mesh_dims, mesh_size = mesh_args
-    
-    # assign atom to mesh 
-    kdtree = spatial.cKDTree(data=mesh, boxsize=mesh_size)
-    distance, index = kdtree.query(atoms[:, 2: 5], k=1, workers=number_of_cpus)
-    
-    assert np.all(distance < 1e-3) == True
+    index = compute_mesh_index(atoms, mesh_args, number_of_cpus)
     
     # create id_matrix
-    id_vect = np.zeros(len(mesh))
+    id_vect = np.zeros(np.prod(mesh_dims), dtype=np.uint32)
     id_vect[index] = atoms[:, 0] 
 
     # create type_matrix
-    type_vect = np.zeros(len(mesh))
+    type_vect = np.zeros(np.prod(mesh_dims), dtype=np.int8)
     type_vect[index] = atoms[:, 1]
 
-    id_arr, type_arr = id_vect.reshape(mesh_dims).astype(np.int32), type_vect.reshape(mesh_dims).astype(np.int32)
+    id_arr, type_arr = id_vect.reshape(mesh_dims), type_vect.reshape(mesh_dims)
 
     return id_arr, type_arr
 
+def compute_mesh_index(atoms, mesh_args, number_of_cpus=1):
+
+    # load mesh information
+    mesh, mesh_dims, mesh_size = mesh_args
+
+    # assign on-lattice atoms arithmetically, fall back to kd-tree for off-lattice atoms
+    index = compute_voxel_index(atoms[:, 2: 5], mesh_dims, mesh_size)
+    if index is None:
+        if mesh is None:
+            mesh = create_mesh_coords(mesh_dims, mesh_size[0] / mesh_dims[0])
+        kdtree = spatial.cKDTree(data=mesh, boxsize=mesh_size)
+        distance, index = kdtree.query(atoms[:, 2: 5], k=1, workers=number_of_cpus)
+    
+        assert np.all(distance < 1e-3) == True
+
+    return index
+
+def compute_voxel_index(coords, mesh_dims, mesh_size):
+
+    # nearest voxel along each dimension
+    voxel_size = np.array(mesh_size) / np.array(mesh_dims)
+    voxel_index = np.round(coords / voxel_size).astype(np.int64)
+
+    # same snapping tolerance as the kd-tree assignment
+    distance = np.linalg.norm(coords - voxel_index * voxel_size, axis=1)
+    if np.any(distance >= 1e-3):
+        return None
+
+    # flat index in the order of create_mesh_coords, whose meshgrid runs y before x
+    ix, iy, iz = [voxel_index[:, axis] % mesh_dims[axis] for axis in range(3)]
+
+    return (iy * mesh_dims[0] + ix) * mesh_dims[2] + iz
+
 def rotate_mirror_data(data, vect):
     
     # vector to be rotated
@@ -82,10 +132,109 @@ def compute_neigh_index(center, vect):
     return tuple([center[i]+vect[i] for i in range(len(center))])
 
 
+def read_dump(dump_file, chunk_size=1000000):
+
+    with open(dump_file, "r") as f:
+
+        # parse header up to the atoms section
+        line = f.readline()
+        while not line.startswith("ITEM: ATOMS"):
+            assert line != ""
+            if line.startswith("ITEM: NUMBER OF ATOMS"):
+                num_of_atoms = int(f.readline())
+            elif line.startswith("ITEM: BOX BOUNDS"):
+                dims = np.loadtxt([f.readline() for _ in range(3)], ndmin=2)[:, :2]
+            line = f.readline()
+
+        # column layout
+        columns = line.split()[2:]
+        usecols = [columns.index(key) for key in ("id", "type", "x", "y", "z")]
+
+        # parse atoms chunk by chunk
+        atoms = np.empty((num_of_atoms, len(usecols)))
+        for start in range(0, num_of_atoms, chunk_size):
+            lines = list(itertools.islice(f, min(chunk_size, num_of_atoms - start)))
+            atoms[start: start + len(lines)] = np.loadtxt(lines, usecols=usecols, ndmin=2)
+
+    return dims, atoms
+
+def load_dump(dump_file, cache=True):
+
+    # binary cache is valid only for the same file size, modification time and rounding of the stored configs
+    cache_dir = dump_file + ".cache"
+    stat = os.stat(dump_file)
+    key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "decimals": 2}
+
+    if cache == True:
+        try:
+            with open(os.path.join(cache_dir, "key.json"), "r") as f:
+                if json.load(f) == key:
+                    return np.load(os.path.join(cache_dir, "dims.npy")), np.load(os.path.join(cache_dir, "atoms.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            pass
+
+    # round configs once, the cached atoms are handed out read-only as stored
+    dims, atoms = read_dump(dump_file)
+    dims, atoms = dims.round(2), atoms.round(2)
+
+    # the key file is written last so that incomplete caches are never used
+    if cache == True:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(os.path.join(cache_dir, "dims.npy"), dims)
+            np.save(os.path.join(cache_dir, "atoms.npy"), atoms)
+            with open(os.path.join(cache_dir, "key.json"), "w") as f:
+                json.dump(key, f)
+        except OSError:
+            pass
+
+    return dims, atoms
+
 def dump_id(jump_id, jump_time, print_f):
 
     print("{:.0f} {:.2e}".format(jump_id, jump_time), file=print_f)
 
+def dump_vacancy_jump(vacancy_id, jump_id, jump_time, print_f):
+
+    print("{:.0f} {:.0f} {:.2e}".format(vacancy_id, jump_id, jump_time), file=print_f)
+
+def get_random_state():
+
+    _, python_keys, python_gauss = random.getstate()
+    _, numpy_keys, numpy_pos, numpy_has_gauss, numpy_gauss = np.random.get_state()
+
+    return {"python_random_keys": np.array(python_keys, dtype=np.uint64), \
+            "python_random_gauss": np.nan if python_gauss is None else python_gauss, \
+            "numpy_random_keys": numpy_keys, "numpy_random_pos": numpy_pos, \
+            "numpy_random_has_gauss": numpy_has_gauss, "numpy_random_gauss": numpy_gauss}
+
+def set_random_state(state):
+
+    python_gauss = float(state["python_random_gauss"])
+    random.setstate((3, tuple(int(key) for key in state["python_random_keys"]), None if np.isnan(python_gauss) else python_gauss))
+    np.random.set_state(("MT19937", state["numpy_random_keys"], int(state["numpy_random_pos"]), \
+                         int(state["numpy_random_has_gauss"]), float(state["numpy_random_gauss"])))
+
+def save_checkpoint(checkpoint_file, state):
+
+    # replace the previous checkpoint only once the new one is complete
+    with open(checkpoint_file + ".tmp", "wb") as f:
+        np.savez(f, **state)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+def load_checkpoint(checkpoint_file):
+
+    with np.load(checkpoint_file) as data:
+        return {key: data[key] for key in data.files}
+
+def open_output(file_name, restart_size=None):
+
+    if restart_size is None:
+        return open(file_name, "w")
+
+    os.truncate(file_name, restart_size)
+    return open(file_name, "a")
+
 def build_model(lattice_type, lattice_constant, num_of_cells, elements, concs, dump_file):
     
     print_f = open(dump_file, "w")
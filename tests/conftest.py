@@ -0,0 +1,45 @@
+# shared fixtures: small random bcc models and user input params built on them
+
+import os
+import contextlib
+import numpy as np
+import pytest
+
+import nnk.utils
+
+weight_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "example", "weights.npy")
+
+@pytest.fixture(scope="session")
+def model_dump(tmp_path_factory):
+
+    # 10 x 10 x 10 bcc cells, 20 voxels along each dimension
+    dump_file = str(tmp_path_factory.mktemp("model") / "initial.dump")
+    np.random.seed(0)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        nnk.utils.build_model("bcc", 3.24, [10, 10, 10], [1, 2, 3], [1/3, 1/3, 1/3], dump_file)
+
+    return dump_file
+
+@pytest.fixture(scope="session")
+def dilute_model_dump(tmp_path_factory):
+
+    # few mask sites change per jump, so incremental first layer updates are not replaced by full recomputes
+    dump_file = str(tmp_path_factory.mktemp("dilute_model") / "initial.dump")
+    np.random.seed(0)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        nnk.utils.build_model("bcc", 3.24, [10, 10, 10], [1, 2, 3], [0.9, 0.05, 0.05], dump_file)
+
+    return dump_file
+
+@pytest.fixture
+def make_inp(model_dump, tmp_path):
+
+    def make_inp(**updates):
+        inp = {"init_config_dump": model_dump, "cutoff": 7.5, "voxel_size": 1.62, "flatten": 1, "local_map_mode": "gather", \
+               "init_step": 1, "num_of_steps": 1, "dump_vacancy_id": 1, "random_vacancy": 0, "vacancy_id": 1000, \
+               "num_of_cpus": 1, "log_file": "nnk.log", "res_dir": str(tmp_path / "res_data"), "temperature": 1000.0, \
+               "model_dtype": "float64", "ml_model_weight": weight_file, "dump_cache": 0}
+        inp.update(updates)
+        return inp
+
+    return make_inp
@@ -0,0 +1,90 @@
+# block sampler against the linear scan of the global random modules, multi-vacancy rate catalog against a full re-predict
+
+import types
+import random
+import numpy as np
+import pytest
+import scipy.stats
+
+import nnk.params
+import nnk.neuron_map
+import nnk.ml_predict
+import nnk.kmc_module
+
+# rates of 8 paths at 1000 k: similar barriers, one dominant path, and blocked paths next to other vacancies
+kb_t = 8.617333e-5 * 1000
+cases = {"similar": np.exp(- np.linspace(0.9, 1.1, 8) / kb_t), \
+         "dominant": np.exp(- np.array([0.7, 0.9, 0.95, 1.0, 1.0, 1.05, 1.1, 1.1]) / kb_t), \
+         "blocked": np.exp(- np.array([1.0, 0.0, 1.1, 0.0, 0.9, 1.0, 1.2, 1.0]) / kb_t) * np.array([1, 0, 1, 0, 1, 1, 1, 1])}
+
+num_of_samples = 100000
+threshold = 1e-3
+
+def sample_jumps(rates, block_rng, seed):
+
+    # kmc on a stub neuron map whose neighbor ids are the path indexes
+    params = types.SimpleNamespace(block_rng=block_rng, rng_seed=seed, rng_stream=0, rng_block_size=4096)
+    kinetics = nnk.kmc_module.kmc(params, types.SimpleNamespace(neigh_ids=np.arange(len(rates))))
+    random.seed(seed)
+    np.random.seed(seed)
+
+    rates_sum = np.sum(rates)
+    path_index, scaled_time = np.zeros(num_of_samples, dtype=np.int64), np.zeros(num_of_samples)
+    for index in range(num_of_samples):
+        if block_rng:
+            path_index[index] = kinetics.sampler.search(rates)
+        else:
+            path_index[index] = kinetics.compute_jump_id(rates, rates_sum)
+        scaled_time[index] = kinetics.compute_jump_timescale(rates_sum) * rates_sum
+
+    return path_index, scaled_time
+
+@pytest.mark.parametrize("seed, case", list(enumerate(cases)))
+def test_block_sampler_distribution(seed, case):
+
+    rates = cases[case]
+    legacy_path, legacy_time = sample_jumps(rates, 0, seed)
+    block_path, block_time = sample_jumps(rates, 1, seed)
+
+    # paths of zero rate are never chosen and are left out of chi-square tests
+    positive = rates > 0
+    legacy_counts, block_counts = np.bincount(legacy_path, minlength=len(rates)), np.bincount(block_path, minlength=len(rates))
+    assert np.sum(legacy_counts[~positive]) == 0 and np.sum(block_counts[~positive]) == 0
+
+    # path frequencies of both samplers agree with each other and with the rates
+    expected = num_of_samples * rates[positive] / np.sum(rates)
+    assert scipy.stats.chi2_contingency(np.array([legacy_counts[positive], block_counts[positive]]))[1] > threshold
+    assert scipy.stats.chisquare(legacy_counts[positive], expected)[1] > threshold
+    assert scipy.stats.chisquare(block_counts[positive], expected)[1] > threshold
+
+    # rate-scaled residence times are exponential with unit mean
+    assert scipy.stats.ks_2samp(legacy_time, block_time)[1] > threshold
+    assert scipy.stats.kstest(legacy_time, "expon")[1] > threshold
+    assert scipy.stats.kstest(block_time, "expon")[1] > threshold
+
+def test_multi_vacancy_rates(make_inp):
+
+    # vacancies close enough for overlapping local windows and vacancy pairs
+    vacancy_ids = np.random.default_rng(4).choice(np.arange(1, 2001), 20, replace=False).tolist()
+    params = nnk.params.params(make_inp(vacancy_id=vacancy_ids[0], vacancy_ids=vacancy_ids))
+    neuron_map = nnk.neuron_map.neuron_map(params)
+    compiled_model = nnk.ml_predict.CompiledModel(params.model_weight, dtype=params.model_dtype)
+    kinetics = nnk.kmc_module.multi_vacancy_kmc(params, neuron_map, compiled_model.predict)
+    assert kinetics.neigh_ids.dtype == np.int64
+
+    np.random.seed(0)
+    num_of_paths = len(params.path_vects)
+    for step in range(200):
+        kinetics.execute_kmc()
+        if step % 20 != 19:
+            continue
+
+        # rates of each vacancy predicted from scratch, exchanges between two vacancies are not allowed
+        for slot, vacancy_id in enumerate(kinetics.vacancy_ids.tolist()):
+            neigh_ids, img_vects = neuron_map.gather_local_neuron_map(vacancy_id)
+            rates = kinetics.compute_jump_rates(compiled_model.predict(img_vects))
+            rates[np.isin(neigh_ids, kinetics.vacancy_ids)] = 0
+
+            leaves = kinetics.rate_tree.num_of_leaves + slot * num_of_paths + np.arange(num_of_paths)
+            assert np.array_equal(kinetics.neigh_ids[slot], neigh_ids)
+            assert np.allclose(kinetics.rate_tree.tree[leaves], rates, rtol=1e-9, atol=0)
@@ -0,0 +1,80 @@
+# compiled deep neural network against the reference predict function on images saved along a vacancy walk
+
+import numpy as np
+import pytest
+
+import nnk.params
+import nnk.neuron_map
+import nnk.kmc_module
+import nnk.ml_predict
+
+# documented in CompiledModel, eV
+tolerances = {"float64": 1e-10, "float32": 1e-5, "float16": 1e-2, "int8": 1e-1}
+
+@pytest.fixture
+def saved_images(make_inp):
+
+    # local neuron maps of the current vacancy and its neighbors, one batch per step
+    params = nnk.params.params(make_inp())
+    neuron_map = nnk.neuron_map.neuron_map(params)
+    kinetics = nnk.kmc_module.kmc(params, neuron_map)
+
+    rng = np.random.default_rng(2)
+    batches = []
+    for _ in range(200):
+        neigh_ids, img_vects = neuron_map.gather_local_neuron_map()
+        batches.append(img_vects.copy())
+        kinetics.update_neuron_map(int(rng.choice(neigh_ids)))
+
+    return params.model_weight, batches
+
+@pytest.mark.parametrize("dtype", ["float64", "float32", "float16", "int8"])
+def test_replay(saved_images, dtype):
+
+    model_weights, batches = saved_images
+    reference_weights = [np.asarray(parameter, dtype=np.float64) for parameter in model_weights]
+    compiled_model = nnk.ml_predict.CompiledModel(model_weights, dtype=dtype)
+
+    # per step batches reuse the work buffers, the full replay allocates a second set
+    for img_vects in batches:
+        reference = nnk.ml_predict.predict(reference_weights, img_vects.astype(np.float64))
+        assert np.max(np.abs(compiled_model.predict(img_vects) - reference)) < tolerances[dtype]
+
+    img_vects = np.concatenate(batches)
+    assert compiled_model.validate(model_weights, img_vects) < tolerances[dtype]
+
+@pytest.fixture
+def saved_sites(make_inp):
+
+    # types of mask sites and the gather table of a vacancy walk
+    params = nnk.params.params(make_inp())
+    neuron_map = nnk.neuron_map.neuron_map(params)
+    kinetics = nnk.kmc_module.kmc(params, neuron_map)
+
+    rng = np.random.default_rng(3)
+    site_vects = []
+    for _ in range(500):
+        neigh_ids, site_vect = neuron_map.gather_local_sites()
+        site_vects.append(site_vect.copy())
+        kinetics.update_neuron_map(int(rng.choice(neigh_ids)))
+
+    return params.model_weight, neuron_map.gather_table, site_vects
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+@pytest.mark.parametrize("max_changed_fraction", [1.0, 0.2])
+def test_incremental_first_layer(saved_sites, dtype, max_changed_fraction):
+
+    model_weights, gather_table, site_vects = saved_sites
+    compiled_model = nnk.ml_predict.CompiledModel(model_weights, dtype=dtype)
+    incremental_model = nnk.ml_predict.IncrementalModel(compiled_model, gather_table, refresh_interval=100, \
+                                                        max_changed_fraction=max_changed_fraction)
+
+    # accumulator drift between refreshes stays within the dense tolerance
+    num_of_updates = 0
+    for site_vect in site_vects:
+        energy_barriers = incremental_model.predict_sites(site_vect)
+        assert np.max(np.abs(energy_barriers - compiled_model.predict(site_vect[gather_table]))) < tolerances[dtype]
+        num_of_updates = max(num_of_updates, incremental_model.num_of_updates)
+
+    # about two thirds of the sites change per step in the equiatomic model, above the fallback fraction
+    assert num_of_updates == (100 if max_changed_fraction == 1.0 else 0)
@@ -0,0 +1,60 @@
+# gather construction of local neuron maps against the loop construction
+
+import numpy as np
+import pytest
+
+import nnk.params
+import nnk.neuron_map
+import nnk.kmc_module
+
+def build_neuron_map(inp):
+
+    params = nnk.params.params(inp)
+    return params, nnk.neuron_map.neuron_map(params)
+
+def move_vacancy(params, neuron_map, vacancy_id):
+
+    # restore the atom at the current vacancy and remove the new one
+    for cur_id, cur_type in ((params.vacancy_id, params.init_config[params.vacancy_id-1, 1]), (vacancy_id, 0)):
+        neuron_map.type_neuron_map[neuron_map.id_to_type_index[cur_id][1]] = np.int32(cur_type)
+    params.vacancy_id = vacancy_id
+
+def assert_same_as_loop(neuron_map):
+
+    _, _, neigh_ids = neuron_map.create_local_neuron_map()
+    img_vects = neuron_map.aggregate_local_neuron_map()
+    gather_neigh_ids, gather_img_vects = neuron_map.gather_local_neuron_map()
+
+    assert np.array_equal(np.array(neigh_ids), gather_neigh_ids)
+    assert np.array_equal(img_vects, gather_img_vects)
+
+@pytest.mark.parametrize("lattice_layout", ["full", "bcc_packed"])
+def test_vacancy_positions(make_inp, lattice_layout):
+
+    params, neuron_map = build_neuron_map(make_inp(lattice_layout=lattice_layout))
+
+    # atoms on the faces of the box, whose local windows wrap around periodic boundaries, and random atoms
+    atom_ids = np.flatnonzero(neuron_map.id_to_type_index.flat_index >= 0)
+    index = np.column_stack(neuron_map.unravel_index(neuron_map.id_to_type_index.flat_index[atom_ids]))
+    on_face = np.any((index == 0) | (index == np.array(neuron_map.mesh_info[1]) - 1), axis=1)
+    rng = np.random.default_rng(0)
+    positions = np.r_[rng.choice(atom_ids[on_face], 60, replace=False), rng.choice(atom_ids[~on_face], 40, replace=False)]
+
+    assert_same_as_loop(neuron_map)
+    for vacancy_id in positions.tolist():
+        move_vacancy(params, neuron_map, vacancy_id)
+        assert_same_as_loop(neuron_map)
+
+@pytest.mark.parametrize("lattice_layout", ["full", "bcc_packed"])
+def test_random_jumps(make_inp, lattice_layout):
+
+    params, neuron_map = build_neuron_map(make_inp(lattice_layout=lattice_layout))
+    kinetics = nnk.kmc_module.kmc(params, neuron_map)
+
+    # enough jumps for the vacancy to cross periodic boundaries of the 20 voxel box
+    rng = np.random.default_rng(1)
+    for _ in range(400):
+        assert_same_as_loop(neuron_map)
+        neigh_ids, _ = neuron_map.gather_local_neuron_map()
+        kinetics.update_neuron_map(int(rng.choice(neigh_ids)))
+    assert_same_as_loop(neuron_map)
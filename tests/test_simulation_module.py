@@ -0,0 +1,98 @@
+# checkpoint restart against an uninterrupted run, release of parallel kmc resources
+
+import os
+import random
+import contextlib
+import multiprocessing
+import numpy as np
+import pytest
+
+import nnk.utils
+import nnk.simulation_module
+import nnk.parallel_module
+
+num_of_steps = 40
+
+def run_simulation(inp, seed):
+
+    random.seed(seed)
+    np.random.seed(seed)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        nnk.simulation_module.Simulation(inp).run()
+
+    with open(os.path.join(inp["res_dir"], inp["log_file"]), "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("updates", [{}, {"barrier_cache_size": 1000}, \
+                                     {"incremental_first_layer": 1, "model_dtype": "float32"}, {"block_rng": 1}], \
+                         ids=["default", "cache", "incremental_first_layer", "block_rng"])
+def test_restart(make_inp, dilute_model_dump, tmp_path, updates):
+
+    # accumulators of the incremental first layer carry state only when few sites change per jump
+    if "incremental_first_layer" in updates:
+        updates = {"init_config_dump": dilute_model_dump, **updates}
+
+    full_inp = make_inp(num_of_steps=num_of_steps, checkpoint_interval=num_of_steps // 2, res_dir=str(tmp_path / "full"), **updates)
+    full_log = run_simulation(full_inp, 0)
+
+    # checkpoint half way, then restart with a different global seed, random states come from the checkpoint
+    restart_inp = make_inp(num_of_steps=num_of_steps // 2, checkpoint_interval=num_of_steps // 2, res_dir=str(tmp_path / "restart"), **updates)
+    run_simulation(restart_inp, 0)
+    restart_inp.update({"num_of_steps": num_of_steps, "restart": 1})
+    restart_log = run_simulation(restart_inp, 1)
+
+    # the initial vacancy and one line per jump, then summaries of the modules
+    assert len([line for line in full_log.splitlines() if not line.startswith(b"#")]) == num_of_steps + 1
+    assert restart_log == full_log
+
+    # module states at the last step, rounding history included
+    full_state = nnk.utils.load_checkpoint(os.path.join(full_inp["res_dir"], "checkpoint.npz"))
+    restart_state = nnk.utils.load_checkpoint(os.path.join(restart_inp["res_dir"], "checkpoint.npz"))
+    assert full_state.keys() == restart_state.keys()
+    for key in full_state:
+        assert np.array_equal(full_state[key], restart_state[key], equal_nan=full_state[key].dtype.kind == "f"), key
+
+def test_parallel_cleanup(make_inp, monkeypatch):
+
+    # workers and shared neuron maps are released when a run fails
+    def failed_run(self, num_of_events, print_f, jump_log=None):
+        raise RuntimeError("failed run")
+
+    monkeypatch.setattr(nnk.parallel_module.parallel_kmc, "run", failed_run)
+    inp = make_inp(vacancy_ids=[1000, 1500, 1990], parallel_kmc=1, num_of_cpus=2, domain_grid=[1, 1, 1])
+    simulation = nnk.simulation_module.Simulation(inp)
+    shm_names = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    with pytest.raises(RuntimeError):
+        simulation.run()
+
+    assert len(multiprocessing.active_children()) == 0
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) == shm_names
+
+def test_parallel_without_vacancies(make_inp):
+
+    inp = make_inp(parallel_kmc=1, num_of_cpus=2, domain_grid=[1, 1, 1])
+    simulation = nnk.simulation_module.Simulation(inp)
+    with pytest.raises(AssertionError, match="vacancy_ids"):
+        simulation.run()
+
+def test_dump_cache(make_inp, model_dump, tmp_path):
+
+    # the cache is written next to the dump
+    dump_file = str(tmp_path / "initial.dump")
+    with open(model_dump, "r") as src, open(dump_file, "w") as dst:
+        dst.write(src.read())
+
+    uncached = nnk.simulation_module.Simulation(make_inp(init_config_dump=dump_file, res_dir=str(tmp_path / "uncached")))
+    nnk.simulation_module.Simulation(make_inp(init_config_dump=dump_file, dump_cache=1, res_dir=str(tmp_path / "write")))
+    simulation = nnk.simulation_module.Simulation(make_inp(init_config_dump=dump_file, dump_cache=1, res_dir=str(tmp_path / "read")))
+
+    # rounded once when the cache is written, then handed out as the read-only memmap
+    assert isinstance(simulation.params.init_config, np.memmap) and not simulation.params.init_config.flags.writeable
+    assert np.array_equal(simulation.params.init_config, uncached.params.init_config)
+    assert np.array_equal(simulation.params.dims, uncached.params.dims)
+
+    # the current configuration and resets work on writable copies
+    simulation.reset(vacancy_id=1500)
+    assert simulation.params.config.flags.writeable and simulation.params.config[1499, 1] == 0
+    assert simulation.params.init_config[1499, 1] == uncached.params.init_config[1499, 1]